@@ -6,6 +6,8 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import functools
+
 import ga4gh.server.datamodel as datamodel
 import ga4gh.server.exceptions as exceptions
 import ga4gh.server.paging as paging
@@ -23,6 +25,12 @@ class Backend(object):
         self._requestValidation = False
         self._defaultPageSize = 100
         self._maxResponseLength = 2**20  # 1 MiB
+        self._seekablePageTokens = False
+        self._cursorCache = paging.CursorCache()
+        self._pagePrefetcher = paging.PagePrefetcher(
+            initializer=self._initializePrefetchWorker)
+        self._variantConversionPool = paging.VariantConversionPool(
+            dataRepository)
         self._dataRepository = dataRepository
 
     def getDataRepository(self):
@@ -50,6 +58,74 @@ class Backend(object):
         """
         self._maxResponseLength = maxResponseLength
 
+    def setSeekablePageTokens(self, seekablePageTokens):
+        """
+        Sets whether page tokens for interval searches over reads and
+        variants should carry the virtual file offset of the next object,
+        allowing iteration to be resumed by seeking directly to it.
+        """
+        self._seekablePageTokens = seekablePageTokens
+
+    def setCursorCacheMaxSize(self, maxSize):
+        """
+        Sets the maximum number of in-flight interval searches whose
+        iterators are held between pages. A value of 0 disables the
+        cursor cache.
+        """
+        self._cursorCache.setMaxSize(maxSize)
+
+    def setCursorCacheTimeToLive(self, timeToLive):
+        """
+        Sets the number of seconds for which the iterator of an in-flight
+        interval search is held while waiting for the next page request.
+        """
+        self._cursorCache.setTimeToLive(timeToLive)
+
+    def setPrefetchWorkers(self, numWorkers):
+        """
+        Sets the number of worker threads used to compute the next page
+        of interval searches in the background. A value of 0 disables
+        prefetching.
+        """
+        self._pagePrefetcher.setNumWorkers(numWorkers)
+
+    def setPrefetchMaxBytes(self, maxBytes):
+        """
+        Sets the maximum total size in bytes of the prefetched pages held
+        in memory.
+        """
+        self._pagePrefetcher.setMaxBytes(maxBytes)
+
+    def setVariantConversionWorkers(self, numWorkers):
+        """
+        Sets the number of worker processes used to convert the variants
+        of searches over large intervals. A value of 0 disables parallel
+        conversion.
+        """
+        self._variantConversionPool.setNumWorkers(numWorkers)
+
+    def setVariantConversionMinShardSize(self, minShardSize):
+        """
+        Sets the minimum number of bases in the sub-regions of a variants
+        search converted by each worker process.
+        """
+        self._variantConversionPool.setMinShardSize(minShardSize)
+
+    def getPagePrefetcher(self):
+        """
+        Returns the page prefetcher used by this backend, which records
+        the number of pages served from memory.
+        """
+        return self._pagePrefetcher
+
+    def getVariantConversionPool(self):
+        """
+        Returns the variant conversion pool used by this backend, which
+        records how many of the variants converted by its workers were
+        used.
+        """
+        return self._variantConversionPool
+
     def startProfile(self):
         """
         Profiling hook. Called at the start of the runSearchRequest method
@@ -308,10 +384,11 @@ class Backend(object):
             request, variantSet.getNumVariantAnnotationSets(),
             variantSet.getVariantAnnotationSetByIndex)
 
-    def readsGenerator(self, request):
+    def readsGenerator(self, request, readSampler=None):
         """
         Returns a generator over the (read, nextPageToken) pairs defined
-        by the specified request
+        by the specified request, restricted to the reads selected by the
+        specified ReadSampler.
         """
         if not request.reference_id:
             raise exceptions.UnmappedReadsNotSupported()
@@ -319,11 +396,11 @@ class Backend(object):
             raise exceptions.BadRequestException(
                 "At least one readGroupId must be specified")
         elif len(request.read_group_ids) == 1:
-            return self._readsGeneratorSingle(request)
+            return self._readsGeneratorSingle(request, readSampler)
         else:
-            return self._readsGeneratorMultiple(request)
+            return self._readsGeneratorMultiple(request, readSampler)
 
-    def _readsGeneratorSingle(self, request):
+    def _readsGeneratorSingle(self, request, readSampler=None):
         compoundId = datamodel.ReadGroupCompoundId.parse(
             request.read_group_ids[0])
         dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
@@ -335,10 +412,11 @@ class Backend(object):
         reference = referenceSet.getReference(request.reference_id)
         readGroup = readGroupSet.getReadGroup(compoundId.read_group_id)
         intervalIterator = paging.ReadsIntervalIterator(
-            request, readGroup, reference)
+            request, readGroup, reference, self._seekablePageTokens,
+            readSampler)
         return intervalIterator
 
-    def _readsGeneratorMultiple(self, request):
+    def _readsGeneratorMultiple(self, request, readSampler=None):
         compoundId = datamodel.ReadGroupCompoundId.parse(
             request.read_group_ids[0])
         dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
@@ -354,20 +432,23 @@ class Backend(object):
                 "If multiple readGroupIds are specified, "
                 "they must be all of the readGroupIds in a ReadGroupSet")
         intervalIterator = paging.ReadsIntervalIterator(
-            request, readGroupSet, reference)
+            request, readGroupSet, reference, self._seekablePageTokens,
+            readSampler)
         return intervalIterator
 
-    def variantsGenerator(self, request):
+    def variantsGenerator(self, request, variantFilter=None):
         """
         Returns a generator over the (variant, nextPageToken) pairs defined
-        by the specified request.
+        by the specified request, restricted to the variants passing the
+        specified VariantFilter.
         """
         compoundId = datamodel.VariantSetCompoundId \
             .parse(request.variant_set_id)
         dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
         variantSet = dataset.getVariantSet(compoundId.variant_set_id)
         intervalIterator = paging.VariantsIntervalIterator(
-            request, variantSet)
+            request, variantSet, self._seekablePageTokens,
+            self._variantConversionPool, variantFilter)
         return intervalIterator
 
     def genotypeMatrixGenerator(self, request):
@@ -606,7 +687,7 @@ class Backend(object):
         object into its protocol representation.
         """
         protocolElement = obj.toProtocolElement()
-        data = protocol.serialize(protocolElement, return_mimetype)
+        data = response_builder.serialize(protocolElement, return_mimetype)
         return data
 
     def runSearchRequest(
@@ -632,18 +713,175 @@ class Backend(object):
             request.page_size = self._defaultPageSize
         if request.page_size < 0:
             raise exceptions.BadPageSizeException(request.page_size)
+        fingerprint = None
+        if self._cursorCache.isEnabled() or self._pagePrefetcher.isEnabled():
+            fingerprint = self._getRequestFingerprint(
+                request, objectGenerator)
+        if self._pagePrefetcher.isEnabled() and request.page_token:
+            page = self._pagePrefetcher.take(self._getPrefetchKey(
+                fingerprint, request, return_mimetype, request.page_token))
+            if page is not None:
+                # Discard the cursor for this page, if there is one.
+                self._cursorCache.take(fingerprint, request.page_token)
+                responseString, nextPageToken = page
+                self._prefetchNextPage(
+                    fingerprint, request, nextPageToken, nextPageToken,
+                    responseClass, objectGenerator, return_mimetype)
+                self.endProfile()
+                return responseString
+        iterator, request.page_token = self._cursorCache.take(
+            fingerprint, request.page_token)
+        if iterator is not None:
+            try:
+                responseBuilder, nextPageToken = self._fillSearchResponse(
+                    iterator, responseClass, request.page_size,
+                    return_mimetype)
+            except exceptions.FileHandleClosedException:
+                # The file underlying the cursor has been closed, so we
+                # start again from the stateless page token.
+                iterator = None
+        if iterator is None:
+            iterator = objectGenerator(request)
+            responseBuilder, nextPageToken = self._fillSearchResponse(
+                iterator, responseClass, request.page_size, return_mimetype)
+        if (nextPageToken is not None and
+                isinstance(iterator, paging.IntervalIterator)):
+            statelessPageToken = nextPageToken
+            if self._cursorCache.isEnabled():
+                nextPageToken = self._cursorCache.put(
+                    fingerprint, iterator, nextPageToken)
+            self._prefetchNextPage(
+                fingerprint, request, nextPageToken, statelessPageToken,
+                responseClass, objectGenerator, return_mimetype)
+        responseBuilder.setNextPageToken(nextPageToken)
+        responseString = responseBuilder.getSerializedResponse()
+        self.endProfile()
+        return responseString
+
+    def runSearchRequestStream(
+            self, requestStr, requestClass, objectGenerator):
+        """
+        Runs the specified request as runSearchRequest does, but rather
+        than assembling a single page of results, returns an iterator over
+        chunks of newline delimited JSON with one line for each of the
+        objects returned by the specified object generator. All results
+        from the request's page token onwards are returned, regardless of
+        the page size. Errors in the request are raised before the
+        iterator is returned.
+        """
+        try:
+            request = protocol.fromJson(requestStr, requestClass)
+        except protocol.json_format.ParseError:
+            raise exceptions.InvalidJsonException(requestStr)
+        iterator = objectGenerator(request)
+        return self._streamJsonLines(iterator)
+
+    def _streamJsonLines(self, iterator):
+        """
+        Returns an iterator over chunks of newline delimited JSON for the
+        objects in the specified iterator over (object, nextPageToken)
+        pairs. Lines are grouped into chunks of approximately the
+        maximum response length.
+        """
+        lines = []
+        chunkLength = 0
+        for obj, _ in iterator:
+            line = response_builder.toJson(obj) + "\n"
+            lines.append(line)
+            chunkLength += len(line)
+            if chunkLength >= self._maxResponseLength:
+                yield "".join(lines)
+                lines = []
+                chunkLength = 0
+        if len(lines) > 0:
+            yield "".join(lines)
+
+    def _fillSearchResponse(
+            self, iterator, responseClass, pageSize, return_mimetype):
+        """
+        Fills a page of the response from the specified iterator over
+        (object, nextPageToken) pairs, and returns the response builder
+        and the next page token.
+        """
         responseBuilder = response_builder.SearchResponseBuilder(
-            responseClass, request.page_size, self._maxResponseLength,
+            responseClass, pageSize, self._maxResponseLength,
             return_mimetype)
         nextPageToken = None
-        for obj, nextPageToken in objectGenerator(request):
+        for obj, nextPageToken in iterator:
             responseBuilder.addValue(obj)
             if responseBuilder.isFull():
                 break
+        return responseBuilder, nextPageToken
+
+    def _getRequestFingerprint(self, request, objectGenerator):
+        """
+        Returns a value identifying the search defined by the specified
+        request and object generator, ignoring the paging fields.
+        """
+        searchRequest = type(request)()
+        searchRequest.CopyFrom(request)
+        searchRequest.ClearField(b"page_token")
+        searchRequest.ClearField(b"page_size")
+        if isinstance(objectGenerator, functools.partial):
+            # Generators bound to extra search arguments, such as variant
+            # filters, are distinguished by these arguments.
+            return (
+                objectGenerator.func.__name__, objectGenerator.args,
+                tuple(sorted(objectGenerator.keywords.items())),
+                searchRequest.SerializeToString())
+        return objectGenerator.__name__, searchRequest.SerializeToString()
+
+    def _getPrefetchKey(
+            self, fingerprint, request, return_mimetype, pageToken):
+        """
+        Returns the key identifying the prefetched page for the specified
+        page token of the search with the specified fingerprint.
+        """
+        return fingerprint, request.page_size, return_mimetype, pageToken
+
+    def _prefetchNextPage(
+            self, fingerprint, request, nextPageToken, statelessPageToken,
+            responseClass, objectGenerator, return_mimetype):
+        """
+        Schedules the background computation of the page that the client
+        will request using nextPageToken, so that it can be served from
+        memory. The page is computed from the equivalent stateless page
+        token.
+        """
+        if nextPageToken is None or not self._pagePrefetcher.isEnabled():
+            return
+        nextRequest = type(request)()
+        nextRequest.CopyFrom(request)
+        nextRequest.page_token = statelessPageToken
+        self._pagePrefetcher.prefetch(
+            self._getPrefetchKey(
+                fingerprint, request, return_mimetype, nextPageToken),
+            self._runPrefetch, nextRequest, responseClass, objectGenerator,
+            return_mimetype)
+
+    def _runPrefetch(
+            self, request, responseClass, objectGenerator, return_mimetype):
+        """
+        Returns the (responseString, nextPageToken) pair for the page of
+        results defined by the specified request.
+        """
+        iterator = objectGenerator(request)
+        responseBuilder, nextPageToken = self._fillSearchResponse(
+            iterator, responseClass, request.page_size, return_mimetype)
         responseBuilder.setNextPageToken(nextPageToken)
-        responseString = responseBuilder.getSerializedResponse()
-        self.endProfile()
-        return responseString
+        return responseBuilder.getSerializedResponse(), nextPageToken
+
+    def _initializePrefetchWorker(self):
+        """
+        Gives the current prefetch worker thread its own file handles, so
+        that they are never used concurrently with the threads serving
+        requests. The decompression threads of its handles are taken
+        from the budget of the shared cache.
+        """
+        cache = datamodel.PysamFileHandleCache(
+            datamodel.fileHandleCache.getDecompressionThreadBudget())
+        cache.setMaxCacheSize(datamodel.fileHandleCache.getMaxCacheSize())
+        datamodel.setThreadFileHandleCache(cache)
 
     def runListReferenceBases(self, requestJson,
                               return_mimetype="application/json"):
@@ -696,7 +934,10 @@ class Backend(object):
         request arguments.
 
         Can't just use runSearchRequest because we're appending
-        multiple things - the variants and the genotype matrix
+        multiple things - the variants and the genotype matrix. Pages
+        are filled until either the page size or the maximum response
+        length is reached. If the packed genotypes mimetype is
+        requested, the genotype matrix is returned as 2-bit codes.
         """
         self.startProfile()
         requestClass = protocol.SearchGenotypesRequest
@@ -707,34 +948,39 @@ class Backend(object):
             request = protocol.fromJson(requestStr, requestClass)
         except protocol.json_format.ParseError:
             raise exceptions.InvalidJsonException(requestStr)
+        if not request.page_size:
+            request.page_size = self._defaultPageSize
+        if request.page_size < 0:
+            raise exceptions.BadPageSizeException(request.page_size)
 
         response = responseClass()
         response.genotypes.nvariants = 0
         response.genotypes.nindividuals = 0
-
-        # to heck with paging for now
-        # and to heck with call set ids too
-
-        genotyperows = []
-        variants = []
-        callsetIds = None
-        for gt_variant, nextPageToken in objectGenerator(request):
-            genotypemtx, variant, callsetids = gt_variant
-            genotyperows.append(genotypemtx)
+        bufferSize = 0
+        nextPageToken = None
+        for gtVariant, nextPageToken in objectGenerator(request):
+            genotypeMatrix, variant, callSetIds = gtVariant
             variant.ClearField(b"calls")
-            variants.append(variant)
-            if callsetIds is None:
-                callsetIds = callsetids
-
-        for genotyperow in genotyperows:
-            response.genotypes.genotypes.extend(genotyperow.genotypes)
-        response.genotypes.nindividuals = len(genotyperows[0].genotypes)
-        response.genotypes.nvariants = len(variants)
-
-        response.variants.extend(variants)
-        response.call_set_ids.extend(callsetIds)
-
-        return protocol.serialize(response, return_mimetype)
+            if response.genotypes.nvariants == 0:
+                response.call_set_ids.extend(callSetIds)
+                response.genotypes.nindividuals = len(
+                    genotypeMatrix.genotypes)
+            response.variants.add().CopyFrom(variant)
+            response.genotypes.genotypes.extend(genotypeMatrix.genotypes)
+            response.genotypes.nvariants += 1
+            bufferSize += variant.ByteSize() + genotypeMatrix.ByteSize()
+            if (response.genotypes.nvariants >= request.page_size or
+                    bufferSize >= self._maxResponseLength):
+                break
+        if nextPageToken is not None:
+            response.next_page_token = nextPageToken
+        if return_mimetype == response_builder.PACKED_GENOTYPES_MIMETYPE:
+            responseString = response_builder.serializePackedGenotypes(
+                response)
+        else:
+            responseString = protocol.serialize(response, return_mimetype)
+        self.endProfile()
+        return responseString
 
     # Get requests.
 
@@ -820,7 +1066,7 @@ class Backend(object):
         # TODO variant is a special case here, as it's returning a
         # protocol element rather than a datamodel object. We should
         # fix this for consistency.
-        data = protocol.serialize(gaVariant, return_mimetype)
+        data = response_builder.serialize(gaVariant, return_mimetype)
         return data
 
     def runGetBiosample(self, id_, return_mimetype="application/json"):
@@ -850,7 +1096,7 @@ class Backend(object):
         dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
         featureSet = dataset.getFeatureSet(compoundId.feature_set_id)
         gaFeature = featureSet.getFeature(compoundId)
-        data = protocol.serialize(gaFeature, return_mimetype)
+        data = response_builder.serialize(gaFeature, return_mimetype)
         return data
 
     def runGetReadGroupSet(self, id_, return_mimetype="application/json"):
@@ -1014,16 +1260,36 @@ class Backend(object):
             self.biosamplesGenerator,
             return_mimetype)
 
-    def runSearchReads(self, request, return_mimetype):
+    def _getReadsGenerator(self, readSampler):
+        """
+        Returns the object generator for read searches restricted to the
+        reads selected by the specified ReadSampler, if any.
+        """
+        if readSampler is None:
+            return self.readsGenerator
+        return functools.partial(
+            self.readsGenerator, readSampler=readSampler)
+
+    def runSearchReads(self, request, return_mimetype, readSampler=None):
         """
-        Runs the specified SearchReadsRequest.
+        Runs the specified SearchReadsRequest. If a ReadSampler is
+        specified, only the reads it selects are returned.
         """
         return self.runSearchRequest(
             request, protocol.SearchReadsRequest,
             protocol.SearchReadsResponse,
-            self.readsGenerator,
+            self._getReadsGenerator(readSampler),
             return_mimetype)
 
+    def runSearchReadsStream(self, request, readSampler=None):
+        """
+        Runs the specified SearchReadsRequest, returning an iterator over
+        chunks of newline delimited JSON read alignments.
+        """
+        return self.runSearchRequestStream(
+            request, protocol.SearchReadsRequest,
+            self._getReadsGenerator(readSampler))
+
     def runSearchReferenceSets(self, request, return_mimetype):
         """
         Runs the specified SearchReferenceSetsRequest.
@@ -1064,16 +1330,36 @@ class Backend(object):
             self.variantAnnotationSetsGenerator,
             return_mimetype)
 
-    def runSearchVariants(self, request, return_mimetype):
+    def _getVariantsGenerator(self, variantFilter):
         """
-        Runs the specified SearchVariantRequest.
+        Returns the object generator for variant searches restricted to
+        the specified VariantFilter, if any.
+        """
+        if variantFilter is None:
+            return self.variantsGenerator
+        return functools.partial(
+            self.variantsGenerator, variantFilter=variantFilter)
+
+    def runSearchVariants(self, request, return_mimetype, variantFilter=None):
+        """
+        Runs the specified SearchVariantRequest. If a VariantFilter is
+        specified, only the variants passing it are returned.
         """
         return self.runSearchRequest(
             request, protocol.SearchVariantsRequest,
             protocol.SearchVariantsResponse,
-            self.variantsGenerator,
+            self._getVariantsGenerator(variantFilter),
             return_mimetype)
 
+    def runSearchVariantsStream(self, request, variantFilter=None):
+        """
+        Runs the specified SearchVariantsRequest, returning an iterator over
+        chunks of newline delimited JSON variants.
+        """
+        return self.runSearchRequestStream(
+            request, protocol.SearchVariantsRequest,
+            self._getVariantsGenerator(variantFilter))
+
     def runSearchGenotypes(self, request, return_mimetype):
         """
         Runs the specified SearchVariantRequest.
@@ -1155,6 +1441,14 @@ class Backend(object):
             self.featuresGenerator,
             return_mimetype)
 
+    def runSearchFeaturesStream(self, request):
+        """
+        Runs the specified SearchFeaturesRequest, returning an iterator over
+        chunks of newline delimited JSON features.
+        """
+        return self.runSearchRequestStream(
+            request, protocol.SearchFeaturesRequest, self.featuresGenerator)
+
     def runSearchContinuousSets(self, request, return_mimetype):
         """
         Returns a SearchContinuousSetsResponse for the specified
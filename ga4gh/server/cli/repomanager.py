@@ -14,6 +14,7 @@ import traceback
 import urlparse
 
 import ga4gh.server.cli as cli
+import ga4gh.server.datamodel as datamodel
 import ga4gh.server.datamodel.bio_metadata as bio_metadata
 import ga4gh.server.datamodel.datasets as datasets
 import ga4gh.server.datamodel.genotype_phenotype as genotype_phenotype
@@ -216,7 +217,7 @@ class RepoManager(object):
                 raise exceptions.MissingIndexException(dataUrl)
         else:
             if indexFile is None:
-                indexFile = dataUrl + ".bai"
+                indexFile = reads.getDefaultIndexFile(dataUrl)
             dataUrl = self._getFilePath(self._args.dataFile,
                                         self._args.relativePath)
             indexFile = self._getFilePath(indexFile, self._args.relativePath)
@@ -232,8 +233,20 @@ class RepoManager(object):
         referenceSet = self._repo.getReferenceSetByName(referenceSetName)
         readGroupSet.setReferenceSet(referenceSet)
         readGroupSet.setAttributes(json.loads(self._args.attributes))
+        if self._args.readGroupIndex:
+            readGroupSet.writeReadGroupIndex(self._args.binSize)
         self._updateRepo(self._repo.insertReadGroupSet, readGroupSet)
 
+    def indexReadGroupSet(self):
+        """
+        Builds the read group index of a ReadGroupSet.
+        """
+        self._openRepo()
+        dataset = self._repo.getDatasetByName(self._args.datasetName)
+        readGroupSet = dataset.getReadGroupSetByName(
+            self._args.readGroupSetName)
+        readGroupSet.writeReadGroupIndex(self._args.binSize)
+
     def addVariantSet(self):
         """
         Adds a new VariantSet into this repo.
@@ -313,6 +326,14 @@ class RepoManager(object):
             for annotationSet in variantSet.getVariantAnnotationSets():
                 annotationSet.setOntology(ontology)
                 annotationSets.append(annotationSet)
+        if self._args.effectIndex:
+            if len(annotationSets) == 0:
+                raise exceptions.RepoManagerException(
+                    "Cannot build an effect index for a VariantSet without "
+                    "annotations. Please use the --addAnnotationSets option "
+                    "with an annotated VCF file.")
+            for annotationSet in annotationSets:
+                annotationSet.writeEffectIndexes(self._args.binSize)
 
         # Add the annotation sets and the variant set as an atomic update
         def updateRepo():
@@ -321,6 +342,21 @@ class RepoManager(object):
                 self._repo.insertVariantAnnotationSet(annotationSet)
         self._updateRepo(updateRepo)
 
+    def indexVariantSet(self):
+        """
+        Builds the effect indexes of the annotations of a VariantSet.
+        """
+        self._openRepo()
+        dataset = self._repo.getDatasetByName(self._args.datasetName)
+        variantSet = dataset.getVariantSetByName(self._args.variantSetName)
+        annotationSets = variantSet.getVariantAnnotationSets()
+        if len(annotationSets) == 0:
+            raise exceptions.RepoManagerException(
+                "VariantSet '{}' has no annotations to index".format(
+                    variantSet.getLocalId()))
+        for annotationSet in annotationSets:
+            annotationSet.writeEffectIndexes(self._args.binSize)
+
     def addPhenotypeAssociationSet(self):
         """
         Adds a new phenotype association set to this repo.
@@ -757,6 +793,12 @@ class RepoManager(object):
             "variantSetName",
             help="the name of the variant set")
 
+    @classmethod
+    def addBinSizeOption(cls, subparser):
+        subparser.add_argument(
+            "--binSize", type=int, default=datamodel.BinIndex.defaultBinSize,
+            help="the size in bases of the bins of the sidecar index")
+
     @classmethod
     def addFeatureSetNameArgument(cls, subparser):
         subparser.add_argument(
@@ -1026,15 +1068,28 @@ class RepoManager(object):
         cls.addRelativePathOption(addReadGroupSetParser)
         addReadGroupSetParser.add_argument(
             "dataFile",
-            help="The file path or URL of the BAM file for this ReadGroupSet")
+            help=(
+                "The file path or URL of the BAM or CRAM file for this "
+                "ReadGroupSet. CRAM files are decoded with the FASTA file "
+                "of the reference set, and references are never "
+                "downloaded"))
         addReadGroupSetParser.add_argument(
             "-I", "--indexFile", default=None,
             help=(
                 "The file path of the BAM index for this ReadGroupSet. "
                 "If the dataFile argument is a local file, this will "
-                "be automatically inferred by appending '.bai' to the "
-                "file name. If the dataFile is a remote URL the path to "
-                "a local file containing the BAM index must be provided"))
+                "be automatically inferred by appending '.bai' (or '.crai' "
+                "for a CRAM file) to the file name. If the dataFile is a "
+                "remote URL the path to a local file containing the BAM "
+                "index must be provided"))
+        addReadGroupSetParser.add_argument(
+            "-g", "--readGroupIndex", action="store_true",
+            help=(
+                "Build an index of the read groups of the reads in the BAM "
+                "file, so that searches for the reads of one read group "
+                "only read the parts of the file holding them. The index "
+                "is written next to the BAM index."))
+        cls.addBinSizeOption(addReadGroupSetParser)
 
         addOntologyParser = common_cli.addSubparser(
             subparsers, "add-ontology",
@@ -1068,6 +1123,15 @@ class RepoManager(object):
         cls.addReadGroupSetNameArgument(removeReadGroupSetParser)
         cls.addForceOption(removeReadGroupSetParser)
 
+        indexReadGroupSetParser = common_cli.addSubparser(
+            subparsers, "index-readgroupset",
+            "Build or rebuild the read group index of a read group set")
+        indexReadGroupSetParser.set_defaults(runner="indexReadGroupSet")
+        cls.addRepoArgument(indexReadGroupSetParser)
+        cls.addDatasetNameArgument(indexReadGroupSetParser)
+        cls.addReadGroupSetNameArgument(indexReadGroupSetParser)
+        cls.addBinSizeOption(indexReadGroupSetParser)
+
         objectType = "VariantSet"
         addVariantSetParser = common_cli.addSubparser(
             subparsers, "add-variantset",
@@ -1103,6 +1167,15 @@ class RepoManager(object):
             help=(
                 "If the supplied VCF file contains annotations, create the "
                 "corresponding VariantAnnotationSet."))
+        addVariantSetParser.add_argument(
+            "-e", "--effectIndex", action="store_true",
+            help=(
+                "Build an index of the effects in the annotations of the "
+                "VCF files, so that searches for variant annotations with "
+                "particular effects only read the parts of the files "
+                "holding them. The index is written next to the index of "
+                "each VCF file."))
+        cls.addBinSizeOption(addVariantSetParser)
 
         removeVariantSetParser = common_cli.addSubparser(
             subparsers, "remove-variantset",
@@ -1113,6 +1186,16 @@ class RepoManager(object):
         cls.addVariantSetNameArgument(removeVariantSetParser)
         cls.addForceOption(removeVariantSetParser)
 
+        indexVariantSetParser = common_cli.addSubparser(
+            subparsers, "index-variantset",
+            "Build or rebuild the effect indexes of an annotated "
+            "variant set")
+        indexVariantSetParser.set_defaults(runner="indexVariantSet")
+        cls.addRepoArgument(indexVariantSetParser)
+        cls.addDatasetNameArgument(indexVariantSetParser)
+        cls.addVariantSetNameArgument(indexVariantSetParser)
+        cls.addBinSizeOption(indexVariantSetParser)
+
         addFeatureSetParser = common_cli.addSubparser(
             subparsers, "add-featureset", "Add a feature set to the data repo")
         addFeatureSetParser.set_defaults(runner="addFeatureSet")
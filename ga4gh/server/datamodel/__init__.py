@@ -7,30 +7,101 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import base64
+import bisect
 import collections
 import glob
 import json
 import os
+import threading
 
 import ga4gh.server.exceptions as exceptions
 
 import ga4gh.schemas.protocol as protocol
 
 
+class DecompressionThreadBudget(object):
+    """
+    The htslib decompression threads available to the file handles of
+    one or more PysamFileHandleCaches in a process. Each handle opened
+    with threaded decompression takes up to a fixed number of threads
+    from the budget, and returns them when it is closed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._threads = 0
+        self._maxThreads = 0
+        self._threadsInUse = 0
+
+    def set(self, threads, maxThreads):
+        """
+        Sets the number of threads taken by each handle, and the most
+        threads that the handles may hold between them.
+        """
+        if threads < 0 or maxThreads < 0:
+            raise ValueError(
+                "The number of decompression threads must not be negative")
+        with self._lock:
+            self._threads = threads
+            self._maxThreads = maxThreads
+
+    def get(self):
+        """
+        Returns the (threads, maxThreads) pair set by set.
+        """
+        return self._threads, self._maxThreads
+
+    def getThreadsInUse(self):
+        """
+        Returns the number of threads held by the handles opened from
+        this budget.
+        """
+        return self._threadsInUse
+
+    def allocate(self):
+        """
+        Takes the threads for a new handle from the budget and returns
+        their number, which is 0 if the handle should be opened without
+        threaded decompression. Handles opened when the budget is spent
+        get what remains of it.
+        """
+        with self._lock:
+            threads = min(
+                self._threads, self._maxThreads - self._threadsInUse)
+            if threads < 2:
+                threads = 0
+            self._threadsInUse += threads
+        return threads
+
+    def release(self, threads):
+        """
+        Returns the specified number of threads to the budget.
+        """
+        with self._lock:
+            self._threadsInUse -= threads
+
+
 class PysamFileHandleCache(object):
     """
     Cache for opened file handles. We use a deque which has the
     advantage to have push/pop operations in O(1) We always add
     elements on the left of the deque and pop elements from the right.
     When a file is accessed via getFileHandle, its priority gets
-    updated, it is put at the "top" of the deque.
+    updated, it is put at the "top" of the deque. The decompression
+    threads of the handles are taken from the specified
+    DecompressionThreadBudget, which may be shared with other caches.
     """
 
-    def __init__(self):
+    def __init__(self, decompressionThreadBudget=None):
         self._cache = collections.deque()
         self._memoTable = dict()
         # Initialize the value even if it will be set up by the config
         self._maxCacheSize = 50
+        if decompressionThreadBudget is None:
+            decompressionThreadBudget = DecompressionThreadBudget()
+        self._threadBudget = decompressionThreadBudget
+        # The htslib decompression threads of each handle
+        self._handleThreads = dict()
 
     def setMaxCacheSize(self, size):
         """
@@ -41,6 +112,44 @@ class PysamFileHandleCache(object):
                 "The size of the cache must be a strictly positive value")
         self._maxCacheSize = size
 
+    def getMaxCacheSize(self):
+        """
+        Returns the maximum size of the cache
+        """
+        return self._maxCacheSize
+
+    def setDecompressionThreads(self, threads, maxThreads):
+        """
+        Sets the number of htslib decompression threads used by each
+        handle opened with threaded decompression, and the most threads
+        that the handles of the caches sharing this cache's budget may
+        hold between them. Handles opened when the budget is spent get
+        what remains of it. A value of threads less than 2 disables
+        threaded decompression.
+        """
+        self._threadBudget.set(threads, maxThreads)
+
+    def getDecompressionThreads(self):
+        """
+        Returns the (threads, maxThreads) pair set by
+        setDecompressionThreads.
+        """
+        return self._threadBudget.get()
+
+    def getDecompressionThreadBudget(self):
+        """
+        Returns the DecompressionThreadBudget of this cache, so that other
+        caches in the same process can share it.
+        """
+        return self._threadBudget
+
+    def getThreadsInUse(self):
+        """
+        Returns the number of decompression threads held by the handles
+        in the cache.
+        """
+        return sum(self._handleThreads.values())
+
     def _add(self, dataFile, handle):
         """
         Add a file handle to the left of the deque
@@ -63,25 +172,40 @@ class PysamFileHandleCache(object):
         """
         (dataFile, handle) = self._cache.pop()
         handle.close()
+        self._threadBudget.release(self._handleThreads.pop(dataFile, 0))
         return dataFile
 
-    def getFileHandle(self, dataFile, openMethod):
+    def getFileHandle(self, dataFile, openMethod, threaded=False):
         """
         Returns handle associated to the filename. If the file is
         already opened, update its priority in the cache and return
         its handle. Otherwise, open the file using openMethod, store
-        it in the cache and return the corresponding handle.
+        it in the cache and return the corresponding handle. If
+        threaded is True, openMethod is also passed the number of
+        decompression threads to open the file with.
         """
         if dataFile in self._memoTable:
             handle = self._memoTable[dataFile]
             self._update(dataFile, handle)
             return handle
         else:
+            threads = 0
+            if threaded:
+                threads = self._threadBudget.allocate()
             try:
-                handle = openMethod(dataFile)
+                if threaded:
+                    handle = openMethod(dataFile, threads)
+                else:
+                    handle = openMethod(dataFile)
             except ValueError:
+                self._threadBudget.release(threads)
                 raise exceptions.FileOpenFailedException(dataFile)
+            except Exception:
+                self._threadBudget.release(threads)
+                raise
 
+            if threads > 0:
+                self._handleThreads[dataFile] = threads
             self._memoTable[dataFile] = handle
             self._add(dataFile, handle)
             if len(self._memoTable) > self._maxCacheSize:
@@ -93,6 +217,55 @@ class PysamFileHandleCache(object):
 # LRU cache of open file handles
 fileHandleCache = PysamFileHandleCache()
 
+# Per-thread data, holding the file handle caches of threads that must not
+# share file handles with the threads serving requests.
+_threadLocalData = threading.local()
+
+
+def setThreadFileHandleCache(cache):
+    """
+    Sets the file handle cache used by the current thread in place of the
+    shared fileHandleCache. If cache is None, the shared cache is used.
+    """
+    _threadLocalData.fileHandleCache = cache
+
+
+def getFileHandleCache():
+    """
+    Returns the file handle cache used by the current thread.
+    """
+    cache = getattr(_threadLocalData, "fileHandleCache", None)
+    if cache is None:
+        cache = fileHandleCache
+    return cache
+
+
+def acceptsThreadsArgument(fileClass):
+    """
+    Returns True if the specified pysam file class accepts the threads
+    argument, which the files of older releases of pysam do not.
+    """
+    try:
+        fileClass(os.devnull, threads=2).close()
+    except TypeError:
+        return False
+    except Exception:
+        # The argument was accepted, but the empty file cannot be read.
+        pass
+    return True
+
+
+def isFileHandleOpen(fileHandle):
+    """
+    Returns True if the specified pysam file handle has not been closed.
+    """
+    isOpen = fileHandle.is_open
+    # is_open is a method of the file handles of older pysam releases,
+    # and a property of those of newer releases.
+    if callable(isOpen):
+        isOpen = isOpen()
+    return isOpen
+
 
 class CompoundId(object):
     """
@@ -137,10 +310,16 @@ class CompoundId(object):
         parentCompoundId should be set to None.
         """
         index = 0
+        numContainerIds = 0
         if parentCompoundId is not None:
             for field in parentCompoundId.fields:
                 setattr(self, field, getattr(parentCompoundId, field))
                 index += 1
+            # The parent's container IDs are prefixes of ours
+            for idFieldName, _ in parentCompoundId.containerIds:
+                setattr(self, idFieldName, getattr(
+                    parentCompoundId, idFieldName))
+                numContainerIds += 1
         if (self.differentiator is not None and
                 self.differentiatorFieldName in self.fields[index:]):
             # insert a differentiator into the localIds if appropriate
@@ -157,7 +336,7 @@ class CompoundId(object):
         if len(localIds) != len(self.fields) - index:
             raise ValueError(
                 "Incorrect number of fields provided to instantiate ID")
-        for idFieldName, prefix in self.containerIds:
+        for idFieldName, prefix in self.containerIds[numContainerIds:]:
             values = [getattr(self, f) for f in self.fields[:prefix + 1]]
             containerId = self.join(values)
             obfuscated = self.obfuscate(containerId)
@@ -173,13 +352,9 @@ class CompoundId(object):
         """
         Join an array of ids into a compound id string
         """
-        segments = []
-        for split in splits:
-            segments.append('"{}",'.format(split))
-        if len(segments) > 0:
-            segments[-1] = segments[-1][:-1]
-        jsonString = '[{}]'.format(''.join(segments))
-        return jsonString
+        if len(splits) == 0:
+            return '[]'
+        return '["' + '","'.join(splits) + '"]'
 
     @classmethod
     def split(cls, jsonString):
@@ -207,7 +382,8 @@ class CompoundId(object):
     def parse(cls, compoundIdStr):
         """
         Parses the specified compoundId string and returns an instance
-        of this CompoundId class.
+        of this CompoundId class. Parsed instances are shared through a
+        process-wide cache, and so must not be modified.
 
         :raises: An ObjectWithIdNotFoundException if parsing fails. This is
         because this method is a client-facing method, and if a malformed
@@ -216,6 +392,18 @@ class CompoundId(object):
         """
         if not isinstance(compoundIdStr, basestring):
             raise exceptions.BadIdentifierException(compoundIdStr)
+        key = cls, compoundIdStr
+        compoundId = parseCache.get(key)
+        if compoundId is None:
+            compoundId = cls._parse(compoundIdStr)
+            parseCache.put(key, compoundId)
+        return compoundId
+
+    @classmethod
+    def _parse(cls, compoundIdStr):
+        """
+        Parses the specified compoundId string without using the cache.
+        """
         try:
             deobfuscated = cls.deobfuscate(compoundIdStr)
         except TypeError:
@@ -278,6 +466,229 @@ class CompoundId(object):
         return cls.join(['notValid'] * len(cls.fields))
 
 
+class LruCache(object):
+    """
+    A thread-safe least recently used cache, used for example to hold
+    parsed CompoundIds keyed by their class and ID string.
+    """
+    def __init__(self, maxSize=1024):
+        self._maxSize = maxSize
+        self._values = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def setMaxSize(self, maxSize):
+        """
+        Sets the maximum number of values held in the cache. A size of 0
+        disables the cache.
+        """
+        if maxSize < 0:
+            raise ValueError("The cache size must be non-negative")
+        with self._lock:
+            self._maxSize = maxSize
+            while len(self._values) > self._maxSize:
+                self._values.popitem(last=False)
+
+    def getMaxSize(self):
+        return self._maxSize
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, key):
+        """
+        Returns the value for the specified key, or None if it is not in
+        the cache.
+        """
+        with self._lock:
+            value = self._values.pop(key, None)
+            if value is not None:
+                self._values[key] = value
+            return value
+
+    def put(self, key, value):
+        """
+        Adds the specified value to the cache, evicting the least
+        recently used entry if the cache is full.
+        """
+        with self._lock:
+            if self._maxSize == 0:
+                return
+            self._values[key] = value
+            if len(self._values) > self._maxSize:
+                self._values.popitem(last=False)
+
+
+parseCache = LruCache()
+
+
+class BinIndex(object):
+    """
+    A sidecar index of a data file. For each reference, it maps keys,
+    such as the effects or read groups of the records in the file, to
+    the sorted list of the fixed-size bins holding the start of a record
+    with this key. Searches for records with particular keys then only
+    read the regions of the file holding them. The index is stored as
+    JSON next to the index of the data file, and records the size and
+    modification time of that index so that an index made stale by
+    replacing the file is not used. Concrete subclasses set fileSuffix.
+    """
+    version = 1
+    defaultBinSize = 16384
+    fileSuffix = None
+
+    def __init__(self, binSize=defaultBinSize):
+        if binSize <= 0:
+            raise ValueError("Bin size must be positive")
+        self._binSize = binSize
+        # Maps reference names to maps of keys to bins.
+        self._referenceBins = {}
+
+    @classmethod
+    def getIndexPath(cls, indexFile):
+        """
+        Returns the path of the sidecar index for the data file with the
+        specified index, replacing the extension of the index file with
+        fileSuffix.
+        """
+        return os.path.splitext(indexFile)[0] + cls.fileSuffix
+
+    @classmethod
+    def _getIndexFileStat(cls, indexFile):
+        stat = os.stat(indexFile)
+        return [stat.st_size, int(stat.st_mtime)]
+
+    @classmethod
+    def load(cls, indexFile):
+        """
+        Returns the sidecar index for the data file with the specified
+        index, or None if there is no sidecar index or if it is stale.
+        """
+        path = cls.getIndexPath(indexFile)
+        if not os.path.exists(path) or not os.path.exists(indexFile):
+            return None
+        with open(path) as indexFileHandle:
+            values = json.load(indexFileHandle)
+        if (values.get("version") != cls.version or
+                values.get("indexFileStat") !=
+                cls._getIndexFileStat(indexFile)):
+            return None
+        binIndex = cls(values["binSize"])
+        binIndex._referenceBins = values["references"]
+        return binIndex
+
+    def write(self, indexFile):
+        """
+        Writes this sidecar index for the data file with the specified
+        index.
+        """
+        values = {
+            "version": self.version,
+            "binSize": self._binSize,
+            "indexFileStat": self._getIndexFileStat(indexFile),
+            "references": self._referenceBins,
+        }
+        with open(self.getIndexPath(indexFile), "w") as indexFileHandle:
+            json.dump(values, indexFileHandle)
+
+    def getBinSize(self):
+        return self._binSize
+
+    def addRecord(self, referenceName, start, keys):
+        """
+        Adds a record beginning at the specified start position in the
+        specified reference, having the specified keys.
+        """
+        keyBins = self._referenceBins.setdefault(referenceName, {})
+        bin_ = start // self._binSize
+        for key in keys:
+            bins = keyBins.setdefault(key, [])
+            # Records are usually added in order, so the bins are appended.
+            if len(bins) == 0 or bins[-1] < bin_:
+                bins.append(bin_)
+            elif bin_ not in bins:
+                bisect.insort(bins, bin_)
+
+    def getRegions(self, referenceName, keys, start, end):
+        """
+        Returns the sorted list of disjoint (start, end) regions within the
+        specified interval holding the start of all the records with one
+        of the specified keys. Records beginning before start that may
+        overlap it are in the region beginning at start.
+        """
+        keyBins = self._referenceBins.get(referenceName, {})
+        firstBin = start // self._binSize
+        lastBin = (end - 1) // self._binSize
+        bins = set()
+        before = False
+        for key in keys:
+            keyBinList = keyBins.get(key, [])
+            left = bisect.bisect_left(keyBinList, firstBin)
+            right = bisect.bisect_right(keyBinList, lastBin)
+            bins.update(keyBinList[left:right])
+            before = before or left > 0
+        if before and firstBin <= lastBin:
+            bins.add(firstBin)
+        regions = []
+        for bin_ in sorted(bins):
+            regionStart = max(start, bin_ * self._binSize)
+            regionEnd = min(end, (bin_ + 1) * self._binSize)
+            if len(regions) > 0 and regions[-1][1] == regionStart:
+                regions[-1] = regions[-1][0], regionEnd
+            else:
+                regions.append((regionStart, regionEnd))
+        return regions
+
+
+class CompoundIdFormatter(object):
+    """
+    Formats the ID strings of the compoundIdClass children of a given
+    CompoundId. The ID strings are identical to those of the
+    corresponding CompoundId objects, but the part of the ID that comes
+    from the parent is joined and obfuscated only once. As base64
+    encodes each 3 bytes independently, the longest part of this prefix
+    whose length is a multiple of 3 is obfuscated here, and the
+    remaining bytes along with the rest of each ID.
+    """
+    def __init__(self, parentCompoundId, compoundIdClass):
+        self._compoundIdClass = compoundIdClass
+        values = [
+            getattr(parentCompoundId, field)
+            for field in parentCompoundId.fields]
+        childFields = compoundIdClass.fields[len(values):]
+        self._numLocalIds = len(childFields)
+        if (compoundIdClass.differentiator is not None and
+                compoundIdClass.differentiatorFieldName in childFields):
+            # Only a leading differentiator is supported, as for the
+            # children of datasets.
+            if childFields[0] != compoundIdClass.differentiatorFieldName:
+                raise ValueError("Unsupported differentiator position")
+            values.append(compoundIdClass.differentiator)
+            self._numLocalIds -= 1
+        if self._numLocalIds == 0:
+            raise ValueError("No fields to format")
+        prefix = ('["' + '","'.join(values) + '","').encode('utf-8')
+        length = len(prefix) - len(prefix) % 3
+        self._obfuscatedPrefix = unicode(
+            base64.urlsafe_b64encode(prefix[:length]))
+        self._prefixRemainder = prefix[length:]
+
+    def format(self, *localIds):
+        """
+        Returns the ID string for the child with the specified local IDs.
+        """
+        if len(localIds) != self._numLocalIds:
+            raise ValueError(
+                "Incorrect number of fields provided to instantiate ID")
+        for localId in localIds:
+            if not isinstance(localId, basestring):
+                raise exceptions.BadIdentifierNotStringException(localId)
+        encode = self._compoundIdClass.encode
+        suffix = '","'.join(encode(localId) for localId in localIds) + '"]'
+        return self._obfuscatedPrefix + unicode(base64.urlsafe_b64encode(
+            self._prefixRemainder + suffix.encode('utf-8')).replace(
+                b'=', b''))
+
+
 class ReferenceSetCompoundId(CompoundId):
     """
     The compound ID for reference sets.
@@ -499,14 +910,18 @@ class DatamodelObject(object):
         if parentContainer is not None:
             parentId = parentContainer.getCompoundId()
         self._compoundId = self.compoundIdClass(parentId, localId)
+        self._id = None
         self._attributes = {}
+        self._childIdFormatters = {}
 
     def getId(self):
         """
         Returns the string identifying this DatamodelObject within the
         server.
         """
-        return str(self._compoundId)
+        if self._id is None:
+            self._id = str(self._compoundId)
+        return self._id
 
     def getCompoundId(self):
         """
@@ -515,6 +930,18 @@ class DatamodelObject(object):
         """
         return self._compoundId
 
+    def getChildIdFormatter(self, compoundIdClass):
+        """
+        Returns a CompoundIdFormatter for the IDs of the compoundIdClass
+        children of this object.
+        """
+        formatter = self._childIdFormatters.get(compoundIdClass)
+        if formatter is None:
+            formatter = CompoundIdFormatter(
+                self._compoundId, compoundIdClass)
+            self._childIdFormatters[compoundIdClass] = formatter
+        return formatter
+
     def getLocalId(self):
         """
         Returns the localId of this DatamodelObject. The localId of a
@@ -594,6 +1021,12 @@ class PysamDatamodelMixin(object):
 
     maxStringLength = 2**10  # arbitrary
 
+    threadedDecompression = False
+    """
+    True if openFile accepts the number of htslib decompression threads
+    to open the file with.
+    """
+
     @classmethod
     def sanitizeVariantFileFetch(cls, contig=None, start=None, stop=None):
         if contig is not None:
@@ -662,4 +1095,33 @@ class PysamDatamodelMixin(object):
         return attr
 
     def getFileHandle(self, dataFile):
-        return fileHandleCache.getFileHandle(dataFile, self.openFile)
+        return getFileHandleCache().getFileHandle(
+            dataFile, self.openFile, self.threadedDecompression)
+
+    @classmethod
+    def resumableIterator(cls, fileHandle, iterator, virtualOffset=None):
+        """
+        Returns an iterator over (virtualOffset, record) pairs for the
+        records returned by the specified pysam iterator, where
+        virtualOffset is the position of the file handle before the
+        record was read, or None if this is not known. File handles are
+        shared through the fileHandleCache, so before each record is read
+        the file handle is returned to the position at which the previous
+        record ended. This allows the iteration to be suspended while
+        other iterators read from the same file. If the file handle has
+        been closed while the iteration was suspended, for example when
+        it was evicted from the fileHandleCache, a
+        FileHandleClosedException is raised.
+        """
+        while True:
+            if not isFileHandleOpen(fileHandle):
+                raise exceptions.FileHandleClosedException()
+            if (virtualOffset is not None and
+                    fileHandle.tell() != virtualOffset):
+                fileHandle.seek(virtualOffset)
+            record = next(iterator, None)
+            if record is None:
+                break
+            nextOffset = fileHandle.tell()
+            yield virtualOffset, record
+            virtualOffset = nextOffset
@@ -43,6 +43,10 @@ class Ontology(object):
         self._dataUrl = None
         # There can be duplicate names, so we need to store a list of IDs.
         self._nameIdMap = collections.defaultdict(list)
+        # The OntologyTerm for each name, built when the file is read.
+        self._nameTermMap = {}
+        # The names whose OntologyTerm has each ID.
+        self._idNamesMap = collections.defaultdict(list)
 
     def _readFile(self):
         if not os.path.exists(self._dataUrl):
@@ -62,6 +66,12 @@ class Ontology(object):
         # To get prefix, pull out an ID and parse it.
         self._ontologyPrefix = record.id.split(":")[0]
         self._sourceVersion = reader.data_version
+        self._nameTermMap = dict(
+            (name, self._createGaTerm(name, termIds))
+            for name, termIds in self._nameIdMap.items())
+        self._idNamesMap = collections.defaultdict(list)
+        for name, term in self._nameTermMap.items():
+            self._idNamesMap[term.term_id].append(name)
 
     def populateFromFile(self, dataUrl):
         """
@@ -111,15 +121,19 @@ class Ontology(object):
         """
         return self._nameIdMap[termName]
 
-    def getGaTermByName(self, name):
+    def getTermNames(self, termId):
         """
-        Returns a GA4GH OntologyTerm object by name.
+        Returns the list of term names whose GA4GH OntologyTerm has the
+        specified ID. If no term has this ID, return the empty list.
+        """
+        return self._idNamesMap.get(termId, [])
 
-        :param name: name of the ontology term, ex. "gene".
-        :return: GA4GH OntologyTerm object.
+    def _createGaTerm(self, name, termIds):
+        """
+        Returns a new GA4GH OntologyTerm object for the specified name and
+        list of the IDs that it maps to.
         """
         # TODO what is the correct value when we have no mapping??
-        termIds = self.getTermIds(name)
         if len(termIds) == 0:
             termId = ""
             # TODO add logging for missed term translation.
@@ -131,3 +145,29 @@ class Ontology(object):
         term.term = name
         term.term_id = termId
         return term
+
+    def getSharedGaTermByName(self, name):
+        """
+        Returns the GA4GH OntologyTerm object for the specified name that
+        is shared by all callers, and must not be modified. Callers copy
+        the term into their own messages, for example with CopyFrom or
+        by extending a repeated field.
+
+        :param name: name of the ontology term, ex. "gene".
+        :return: GA4GH OntologyTerm object.
+        """
+        term = self._nameTermMap.get(name)
+        if term is None:
+            term = self._createGaTerm(name, [])
+        return term
+
+    def getGaTermByName(self, name):
+        """
+        Returns a GA4GH OntologyTerm object by name.
+
+        :param name: name of the ontology term, ex. "gene".
+        :return: GA4GH OntologyTerm object.
+        """
+        term = protocol.OntologyTerm()
+        term.CopyFrom(self.getSharedGaTermByName(name))
+        return term
@@ -6,10 +6,16 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import collections
 import datetime
+import errno
+import hashlib
 import json
 import os.path
 import random
+import re
+import tempfile
+import zlib
 
 import pysam
 
@@ -40,6 +46,48 @@ def parseMalformedBamHeader(headerDict):
     return ret
 
 
+def isCramFile(dataUrl):
+    """
+    Returns True if the specified alignment file is a CRAM file.
+    """
+    return dataUrl.lower().endswith(".cram")
+
+
+def getDefaultIndexFile(dataUrl):
+    """
+    Returns the usual path of the index of the specified BAM or CRAM file.
+    """
+    if isCramFile(dataUrl):
+        return dataUrl + ".crai"
+    return dataUrl + ".bai"
+
+
+# The REF_PATH entries from which htslib looks up references over a network
+_urlRefPathPattern = re.compile(r"(^|:)(URL=|https?:|ftp:)", re.IGNORECASE)
+
+
+def configureCramReferencePath():
+    """
+    Points htslib's REF_PATH, and REF_CACHE if it is not set, at a new
+    private directory, so that the references of CRAM files that are
+    missing from the FASTA file of their reference set are never looked
+    up elsewhere. Without a REF_PATH, htslib downloads these references
+    from the EBI reference server. A REF_PATH that is already set is
+    kept, unless it looks up references from a URL, in which case a
+    ConfigurationException is raised.
+    """
+    refPath = os.environ.get("REF_PATH")
+    if refPath is not None:
+        if _urlRefPathPattern.search(refPath) is not None:
+            raise exceptions.ConfigurationException(
+                "REF_PATH must not look up CRAM references from a URL")
+    else:
+        directory = tempfile.mkdtemp(prefix="ga4gh-cram-references-")
+        os.environ["REF_PATH"] = os.path.join(directory, "%s")
+        if "REF_CACHE" not in os.environ:
+            os.environ["REF_CACHE"] = os.path.join(directory, "%s")
+
+
 class SamCigar(object):
     """
     Utility class for working with SAM CIGAR strings
@@ -69,6 +117,12 @@ class SamCigar(object):
         return cls.cigarStrings[value]
 
 
+# The values of the ReadAlignment fields derived from SAM flags.
+SamFlagFields = collections.namedtuple(
+    "SamFlagFields",
+    ["readUnmapped", "strand", "mateUnmapped", "mateStrand", "template"])
+
+
 class SamFlags(object):
     """
     Utility class for working with SAM flags
@@ -86,6 +140,10 @@ class SamFlags(object):
     DUPLICATE_READ = 0x400
     SUPPLEMENTARY_ALIGNMENT = 0x800
 
+    # The SamFlagFields of each of the 4096 values of the flags, filled in
+    # as they are first decoded.
+    _decodedFlags = [None] * 4096
+
     @staticmethod
     def isFlagSet(flagAttr, flag):
         return flagAttr & flag == flag
@@ -94,128 +152,594 @@ class SamFlags(object):
     def setFlag(flagAttr, flag):
         return flagAttr | flag
 
+    @classmethod
+    def decodeFlag(cls, flagAttr):
+        """
+        Returns the SamFlagFields holding the values of the ReadAlignment
+        fields derived from the specified flags. The template it holds is
+        shared, and must be copied rather than modified.
+        """
+        flagAttr &= 0xfff
+        flagFields = cls._decodedFlags[flagAttr]
+        if flagFields is None:
+            flagFields = cls._decodeFlag(flagAttr)
+            cls._decodedFlags[flagAttr] = flagFields
+        return flagFields
+
+    @classmethod
+    def _decodeFlag(cls, flagAttr):
+        template = protocol.ReadAlignment()
+        template.duplicate_fragment = cls.isFlagSet(
+            flagAttr, cls.DUPLICATE_READ)
+        template.failed_vendor_quality_checks = cls.isFlagSet(
+            flagAttr, cls.FAILED_QUALITY_CHECK)
+        if cls.isFlagSet(flagAttr, cls.READ_PAIRED):
+            template.number_reads = 2
+        else:
+            template.number_reads = 1
+        template.read_number = -1
+        if cls.isFlagSet(flagAttr, cls.FIRST_IN_PAIR):
+            if cls.isFlagSet(flagAttr, cls.SECOND_IN_PAIR):
+                template.read_number = 2
+            else:
+                template.read_number = 0
+        elif cls.isFlagSet(flagAttr, cls.SECOND_IN_PAIR):
+            template.read_number = 1
+        template.improper_placement = not cls.isFlagSet(
+            flagAttr, cls.READ_PROPER_PAIR)
+        template.secondary_alignment = cls.isFlagSet(
+            flagAttr, cls.SECONDARY_ALIGNMENT)
+        template.supplementary_alignment = cls.isFlagSet(
+            flagAttr, cls.SUPPLEMENTARY_ALIGNMENT)
+        strand = protocol.POS_STRAND
+        if cls.isFlagSet(flagAttr, cls.READ_REVERSE_STRAND):
+            strand = protocol.NEG_STRAND
+        mateStrand = protocol.POS_STRAND
+        if cls.isFlagSet(flagAttr, cls.MATE_REVERSE_STRAND):
+            mateStrand = protocol.NEG_STRAND
+        return SamFlagFields(
+            cls.isFlagSet(flagAttr, cls.READ_UNMAPPED), strand,
+            cls.isFlagSet(flagAttr, cls.MATE_UNMAPPED), mateStrand,
+            template)
+
+
+class ReadGroupIndex(datamodel.BinIndex):
+    """
+    A sidecar index of the read groups in a BAM file. For each reference,
+    it maps the value of the RG tag of the reads to the sorted list of the
+    bins holding the start of a read in this read group. It is stored
+    next to the BAM index, e.g. "sample.bam.rgidx" for "sample.bam.bai".
+    """
+    fileSuffix = ".rgidx"
+
+
+class CramSliceCache(object):
+    """
+    An on-disk cache of the decoded reads of CRAM files. Each reference
+    is divided into bins of binSize bases, and the reads overlapping a
+    bin are decoded once and stored as a BAM file in cacheDir, so that
+    repeated searches over the same regions do not decode the same CRAM
+    containers again. Slices are stored in a directory named after the
+    CRAM file, its index and its reference FASTA file, and are not used
+    once the index changes. A cacheDir of None disables the cache, in
+    which case each search decodes the bins it overlaps into memory.
+    The cache is never pruned; its directory may be emptied at any time.
+    """
+    def __init__(self, cacheDir=None, binSize=100000):
+        self._cacheDir = cacheDir
+        self._binSize = binSize
+
+    def setCacheDir(self, cacheDir):
+        """
+        Sets the directory holding the cached slices, or None to disable
+        the cache.
+        """
+        self._cacheDir = cacheDir
+
+    def getCacheDir(self):
+        """
+        Returns the directory holding the cached slices.
+        """
+        return self._cacheDir
+
+    def setBinSize(self, binSize):
+        """
+        Sets the number of bases in each slice.
+        """
+        if binSize <= 0:
+            raise ValueError(
+                "The CRAM slice cache bin size must be a strictly "
+                "positive value")
+        self._binSize = binSize
+
+    def getBinSize(self):
+        """
+        Returns the number of bases in each slice.
+        """
+        return self._binSize
+
+    def isEnabled(self):
+        """
+        Returns True if decoded slices are stored on disk.
+        """
+        return self._cacheDir is not None
+
+    def getSlicePath(
+            self, dataUrl, indexFile, referenceFile, referenceId, binStart):
+        """
+        Returns the path of the cached slice of the specified CRAM file
+        holding the reads that overlap the bin starting at binStart on
+        the reference with the specified ID.
+        """
+        indexStat = os.stat(indexFile)
+        key = json.dumps([
+            dataUrl, indexFile, indexStat.st_size, int(indexStat.st_mtime),
+            referenceFile, self._binSize])
+        return os.path.join(
+            self._cacheDir, hashlib.md5(key.encode()).hexdigest(),
+            "{}-{}.bam".format(referenceId, binStart))
+
+    def writeSlice(self, path, samFile, readAlignments):
+        """
+        Writes the specified pysam reads of samFile to the slice with
+        the specified path. The slice is written to a temporary file that
+        is renamed once complete, so that concurrent readers never see a
+        partial slice.
+        """
+        sliceDir = os.path.dirname(path)
+        try:
+            os.makedirs(sliceDir)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+        fileDescriptor, tempPath = tempfile.mkstemp(
+            dir=sliceDir, suffix=".tmp")
+        os.close(fileDescriptor)
+        try:
+            sliceFile = pysam.AlignmentFile(tempPath, "wb", template=samFile)
+            try:
+                for readAlignment in readAlignments:
+                    sliceFile.write(readAlignment)
+            finally:
+                sliceFile.close()
+            os.rename(tempPath, path)
+        finally:
+            if os.path.exists(tempPath):
+                os.unlink(tempPath)
+
+
+# On-disk cache of the decoded reads of CRAM files
+cramSliceCache = CramSliceCache()
+
+
+class ReadSampler(object):
+    """
+    Selects a bounded subset of the reads of a search, for clients such
+    as genome browsers that do not need every read of deep regions. If
+    fraction is specified, a read is selected if the hash of its fragment
+    name falls within this fraction of the hash values, so that the same
+    reads, and both reads of a pair, are selected by every search. If
+    maxDepth is specified, at most this many of the reads beginning at
+    each position are selected, in file order. Reads are sampled before
+    they are converted into ReadAlignments, and the choice of each read
+    depends only on the reads beginning at the same position, so page
+    tokens count the selected reads consistently.
+    """
+    _hashRange = 2**32
+
+    def __init__(self, maxDepth=None, fraction=None):
+        if maxDepth is not None and maxDepth < 1:
+            raise exceptions.BadReadSamplerException(
+                "maxDepth={}".format(maxDepth))
+        if fraction is not None and not 0 < fraction <= 1:
+            raise exceptions.BadReadSamplerException(
+                "sampleFraction={}".format(fraction))
+        self._maxDepth = maxDepth
+        self._fraction = fraction
+        self._maxHash = None
+        if fraction is not None:
+            self._maxHash = int(fraction * self._hashRange)
+        self._key = maxDepth, fraction
+
+    def getMaxDepth(self):
+        """
+        Returns the maximum number of reads selected at each position.
+        """
+        return self._maxDepth
+
+    def getFraction(self):
+        """
+        Returns the fraction of the fragments whose reads are selected.
+        """
+        return self._fraction
+
+    def __eq__(self, other):
+        return isinstance(other, ReadSampler) and self._key == other._key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def isFragmentSampled(self, fragmentName):
+        """
+        Returns True if the reads of the fragment with the specified name
+        are within the sampled fraction.
+        """
+        if self._maxHash is None:
+            return True
+        return zlib.crc32(fragmentName) & 0xffffffff < self._maxHash
+
+    def _sample(self, items, getFragmentName, getStart):
+        """
+        Returns an iterator over the selected items of the specified
+        iterator, whose fragment names and start positions are returned
+        by the specified functions.
+        """
+        previousStart = None
+        numSelected = 0
+        for item in items:
+            if (self._maxHash is not None and
+                    not self.isFragmentSampled(getFragmentName(item))):
+                continue
+            if self._maxDepth is not None:
+                start = getStart(item)
+                if start != previousStart:
+                    previousStart = start
+                    numSelected = 0
+                if numSelected >= self._maxDepth:
+                    continue
+                numSelected += 1
+            yield item
+
+    def samplePysamReads(self, readAlignments):
+        """
+        Returns an iterator over the selected (virtualOffset, pysamRead)
+        pairs of the specified iterator.
+        """
+        return self._sample(
+            readAlignments, lambda pair: pair[1].query_name,
+            lambda pair: pair[1].reference_start)
+
+    def sampleReadAlignments(self, readAlignments):
+        """
+        Returns an iterator over the selected GA4GH ReadAlignments of the
+        specified iterator.
+        """
+        def getStart(readAlignment):
+            if readAlignment.alignment.position.position == 0:
+                # unmapped read with mapped mate; see SAM standard 2.4.1
+                return readAlignment.next_mate_position.position
+            return readAlignment.alignment.position.position
+        return self._sample(
+            readAlignments,
+            lambda readAlignment: readAlignment.fragment_name.encode(),
+            getStart)
+
 
 class AlignmentDataMixin(datamodel.PysamDatamodelMixin):
     """
     Mixin class that provides methods for getting read alignments
-    from bam files
+    from BAM and CRAM files
     """
+    threadedDecompression = True
+    # The names of the references in the file, indexed by reference ID.
+    _referenceNames = None
+
+    def _getReferenceNames(self):
+        """
+        Returns the tuple of the reference names in the file, indexed by
+        reference ID.
+        """
+        if self._referenceNames is None:
+            samFile = self.getFileHandle(self._dataUrl)
+            self._referenceNames = tuple(samFile.references)
+        return self._referenceNames
+
+    @staticmethod
+    def _getReadGroupTag(read):
+        """
+        Returns the value of the RG tag of the specified pysam read, or
+        None if it has no RG tag.
+        """
+        try:
+            return read.get_tag(b'RG')
+        except KeyError:
+            return None
+
+    def isCram(self):
+        """
+        Returns True if the reads are stored in a CRAM file.
+        """
+        return isCramFile(self._dataUrl)
+
     def _getReadAlignments(
-            self, reference, start, end, readGroupSet, readGroup):
+            self, reference, start, end, readGroupSet, readGroup,
+            readSampler=None):
         """
         Returns an iterator over the specified reads
         """
+        iterator = self._getSeekableReadAlignments(
+            reference, start, end, readGroupSet, readGroup,
+            readSampler=readSampler)
+        for _, readAlignment in iterator:
+            yield readAlignment
+
+    def _getSeekableReadAlignments(
+            self, reference, start, end, readGroupSet, readGroup,
+            virtualOffset=None, readSampler=None):
+        """
+        Returns an iterator over (virtualOffset, readAlignment) pairs for
+        the specified reads, where virtualOffset is the BGZF virtual file
+        offset at which the read begins, or None if it is not known. If
+        virtualOffset is specified, reads are returned starting from this
+        offset instead of from the start of the interval. If a
+        ReadSampler is specified, only the reads it selects are converted.
+        """
         # TODO If reference is None, return against all references,
         # including unmapped reads.
         samFile = self.getFileHandle(self._dataUrl)
         referenceName = reference.getLocalId().encode()
         # TODO deal with errors from htslib
         start, end = self.sanitizeAlignmentFileFetch(start, end)
-        readAlignments = samFile.fetch(referenceName, start, end)
-        for readAlignment in readAlignments:
-            tags = dict(readAlignment.tags)
-            if readGroup is None:
-                if 'RG' in tags:
-                    alignmentReadGroupLocalId = tags['RG']
-                    readGroupCompoundId = datamodel.ReadGroupCompoundId(
-                        readGroupSet.getCompoundId(),
-                        str(alignmentReadGroupLocalId))
-                yield self.convertReadAlignment(
-                    readAlignment, readGroupSet, str(readGroupCompoundId))
-            else:
-                if self._filterReads:
-                    if 'RG' in tags and tags['RG'] == self._localId:
-                        yield self.convertReadAlignment(
-                            readAlignment, readGroupSet,
-                            str(readGroup.getCompoundId()))
-                else:
-                    yield self.convertReadAlignment(
-                        readAlignment, readGroupSet,
-                        str(readGroup.getCompoundId()))
+        readGroupIndex = None
+        if readGroup is not None and self._filterReads:
+            readGroupIndex = readGroupSet.getReadGroupIndex()
+        if virtualOffset is None and readGroupIndex is not None:
+            readAlignments = self._fetchIndexedPysamReads(
+                samFile, referenceName, start, end, readGroupIndex)
+        elif virtualOffset is None:
+            readAlignments = self._fetchPysamReads(
+                samFile, referenceName, start, end)
+        else:
+            readAlignments = self._seekPysamReads(
+                samFile, referenceName, start, end, virtualOffset)
+        if readSampler is not None:
+            if readGroup is not None and self._filterReads:
+                # Reads of other read groups must not count towards the
+                # depth of the sample.
+                readAlignments = self._filterReadGroupReads(readAlignments)
+            readAlignments = readSampler.samplePysamReads(readAlignments)
+        if readGroup is None:
+            # The IDs of the read groups named by RG tags.
+            readGroupIds = {}
+            for offset, readAlignment in readAlignments:
+                alignmentReadGroupLocalId = self._getReadGroupTag(
+                    readAlignment)
+                readGroupId = ""
+                if alignmentReadGroupLocalId is not None:
+                    readGroupId = readGroupIds.get(alignmentReadGroupLocalId)
+                    if readGroupId is None:
+                        readGroupId = str(datamodel.ReadGroupCompoundId(
+                            readGroupSet.getCompoundId(),
+                            str(alignmentReadGroupLocalId)))
+                        readGroupIds[alignmentReadGroupLocalId] = readGroupId
+                yield offset, self.convertReadAlignment(
+                    readAlignment, readGroupSet, readGroupId)
+        else:
+            readGroupId = str(readGroup.getCompoundId())
+            for offset, readAlignment in readAlignments:
+                if (not self._filterReads or
+                        self._getReadGroupTag(readAlignment) ==
+                        self._localId):
+                    yield offset, self.convertReadAlignment(
+                        readAlignment, readGroupSet, readGroupId)
+
+    def _filterReadGroupReads(self, readAlignments):
+        """
+        Returns an iterator over the (virtualOffset, pysamRead) pairs of
+        the specified iterator whose read belongs to this read group.
+        """
+        for offset, readAlignment in readAlignments:
+            if self._getReadGroupTag(readAlignment) == self._localId:
+                yield offset, readAlignment
+
+    def _fetchPysamReads(self, samFile, referenceName, start, end):
+        """
+        Returns an iterator over (virtualOffset, pysamRead) pairs for the
+        specified interval using the index. The offset of the first read
+        is not known.
+        """
+        if self.isCram():
+            return self._fetchCramReads(samFile, referenceName, start, end)
+        return self.resumableIterator(
+            samFile, samFile.fetch(referenceName, start, end))
+
+    def _fetchCramReads(self, samFile, referenceName, start, end):
+        """
+        Returns an iterator over (None, pysamRead) pairs for the specified
+        interval of a CRAM file, reading the reads of each bin of the
+        cramSliceCache that the interval overlaps. A CRAM iterator cannot
+        be suspended while other iterators use the same file handle, so
+        each bin is decoded in full before its reads are returned.
+        """
+        referenceId = samFile.gettid(referenceName)
+        if referenceId < 0:
+            raise exceptions.ReferenceNameNotFoundException(referenceName)
+        if start is None:
+            start = self.samMin
+        referenceLength = samFile.lengths[referenceId]
+        if end is None or end > referenceLength:
+            end = referenceLength
+        binSize = cramSliceCache.getBinSize()
+        firstBinStart = start - start % binSize
+        for binStart in range(firstBinStart, end, binSize):
+            if not datamodel.isFileHandleOpen(samFile):
+                raise exceptions.FileHandleClosedException()
+            readAlignments = self._getCramSlice(
+                samFile, referenceName, referenceId, binStart,
+                binStart + binSize, start, end)
+            for readAlignment in readAlignments:
+                readStart = readAlignment.reference_start
+                if readStart >= end:
+                    break
+                if binStart == firstBinStart:
+                    # The first bin holds the reads that begin before the
+                    # search but overlap its start.
+                    readEnd = readAlignment.reference_end
+                    if readEnd is None:
+                        readEnd = readStart + 1
+                    if readEnd > start:
+                        yield None, readAlignment
+                elif readStart >= binStart:
+                    # Reads beginning in earlier bins were returned with
+                    # those bins.
+                    yield None, readAlignment
+
+    def _getCramSlice(
+            self, samFile, referenceName, referenceId, binStart, binEnd,
+            start, end):
+        """
+        Returns an iterator over the pysam reads of the CRAM file that
+        overlap the specified bin, decoding them only if they are not in
+        the cramSliceCache. If the cache is disabled, only the reads
+        overlapping the part of the bin within the search interval from
+        start to end are decoded.
+        """
+        if not cramSliceCache.isEnabled():
+            return list(samFile.fetch(
+                referenceName, max(start, binStart), min(end, binEnd)))
+        path = cramSliceCache.getSlicePath(
+            self._dataUrl, self._indexFile, self.getCramReferenceFile(),
+            referenceId, binStart)
+        if not os.path.exists(path):
+            cramSliceCache.writeSlice(
+                path, samFile, samFile.fetch(referenceName, binStart, binEnd))
+        return self._readCramSlice(path)
+
+    def _readCramSlice(self, path):
+        """
+        Returns an iterator over the pysam reads of the cached CRAM slice
+        with the specified path.
+        """
+        sliceFile = pysam.AlignmentFile(path, "rb")
+        try:
+            for readAlignment in sliceFile.fetch(until_eof=True):
+                yield readAlignment
+        finally:
+            sliceFile.close()
+
+    def _fetchIndexedPysamReads(
+            self, samFile, referenceName, start, end, readGroupIndex):
+        """
+        Returns an iterator over (virtualOffset, pysamRead) pairs for the
+        specified interval, reading only the regions that the specified
+        ReadGroupIndex holds reads of this read group in.
+        """
+        if start is None:
+            start = self.samMin
+        if end is None:
+            end = self.samMaxEnd
+        regions = readGroupIndex.getRegions(
+            referenceName, [self._localId], start, end)
+        for regionStart, regionEnd in regions:
+            readAlignments = self._fetchPysamReads(
+                samFile, referenceName, regionStart, regionEnd)
+            for offset, readAlignment in readAlignments:
+                # Reads beginning before the region were returned with
+                # the previous region, unless they overlap the start of
+                # the search.
+                if (readAlignment.reference_start >= regionStart or
+                        regionStart == start):
+                    yield offset, readAlignment
+
+    def _seekPysamReads(
+            self, samFile, referenceName, start, end, virtualOffset):
+        """
+        Returns an iterator over (virtualOffset, pysamRead) pairs by
+        seeking to the specified virtual offset and reading sequentially,
+        applying the same overlap rules as an indexed fetch.
+        """
+        referenceId = samFile.gettid(referenceName)
+        try:
+            samFile.seek(virtualOffset)
+        except (IOError, OSError, ValueError):
+            raise exceptions.BadPageTokenException()
+        readAlignments = self.resumableIterator(
+            samFile, samFile, virtualOffset)
+        for offset, readAlignment in readAlignments:
+            if readAlignment.reference_id != referenceId:
+                break
+            readStart = readAlignment.reference_start
+            if end is not None and readStart >= end:
+                break
+            readEnd = readAlignment.reference_end
+            if readEnd is None:
+                readEnd = readStart + 1
+            if start is None or readEnd > start:
+                yield offset, readAlignment
 
     def convertReadAlignment(self, read, readGroupSet, readGroupId):
         """
         Convert a pysam ReadAlignment to a GA4GH ReadAlignment
         """
-        samFile = self.getFileHandle(self._dataUrl)
+        referenceNames = self._getReferenceNames()
+        flagFields = SamFlags.decodeFlag(read.flag)
         # TODO fill out remaining fields
         # TODO refine in tandem with code in converters module
         ret = protocol.ReadAlignment()
+        # The fields derived from the flags are copied from the template.
+        ret.CopyFrom(flagFields.template)
         # ret.fragmentId = 'TODO'
         ret.aligned_quality.extend(read.query_qualities)
         ret.aligned_sequence = read.query_sequence
-        if SamFlags.isFlagSet(read.flag, SamFlags.READ_UNMAPPED):
-            ret.ClearField(b"alignment")
-        else:
-            ret.alignment.CopyFrom(protocol.LinearAlignment())
-            ret.alignment.mapping_quality = read.mapping_quality
-            ret.alignment.position.CopyFrom(protocol.Position())
-            ret.alignment.position.reference_name = samFile.getrname(
-                read.reference_id)
-            ret.alignment.position.position = read.reference_start
-            ret.alignment.position.strand = protocol.POS_STRAND
-            if SamFlags.isFlagSet(read.flag, SamFlags.READ_REVERSE_STRAND):
-                ret.alignment.position.strand = protocol.NEG_STRAND
-            for operation, length in read.cigar:
-                gaCigarUnit = ret.alignment.cigar.add()
-                gaCigarUnit.operation = SamCigar.int2ga(operation)
-                gaCigarUnit.operation_length = length
-                gaCigarUnit.reference_sequence = ""  # TODO fix this!
-        ret.duplicate_fragment = SamFlags.isFlagSet(
-            read.flag, SamFlags.DUPLICATE_READ)
-        ret.failed_vendor_quality_checks = SamFlags.isFlagSet(
-            read.flag, SamFlags.FAILED_QUALITY_CHECK)
+        if not flagFields.readUnmapped:
+            alignment = ret.alignment
+            alignment.SetInParent()
+            alignment.mapping_quality = read.mapping_quality
+            position = alignment.position
+            position.SetInParent()
+            position.reference_name = referenceNames[read.reference_id]
+            position.position = read.reference_start
+            position.strand = flagFields.strand
+            cigar = alignment.cigar
+            cigarStrings = SamCigar.cigarStrings
+            # TODO fill in the reference_sequence of the cigar units
+            for operation, length in read.cigartuples or ():
+                cigar.add(
+                    operation=cigarStrings[operation],
+                    operation_length=length)
         ret.fragment_length = read.template_length
         ret.fragment_name = read.query_name
-        for key, value in read.tags:
-            # Useful for inspecting the structure of read tags
-            # print("{key} {ktype}: {value}, {vtype}".format(
-            #     key=key, ktype=type(key), value=value, vtype=type(value)))
-            protocol.setAttribute(ret.attributes.attr[key].values, value)
-
-        if SamFlags.isFlagSet(read.flag, SamFlags.MATE_UNMAPPED):
-            ret.next_mate_position.Clear()
-        else:
-            ret.next_mate_position.Clear()
+        tags = read.get_tags()
+        if len(tags) > 0:
+            attr = ret.attributes.attr
+            for key, value in tags:
+                protocol.setAttribute(attr[key].values, value)
+        nextMatePosition = ret.next_mate_position
+        nextMatePosition.Clear()
+        if not flagFields.mateUnmapped:
             if read.next_reference_id != -1:
-                ret.next_mate_position.reference_name = samFile.getrname(
-                    read.next_reference_id)
+                nextMatePosition.reference_name = referenceNames[
+                    read.next_reference_id]
             else:
-                ret.next_mate_position.reference_name = ""
-            ret.next_mate_position.position = read.next_reference_start
-            ret.next_mate_position.strand = protocol.POS_STRAND
-            if SamFlags.isFlagSet(read.flag, SamFlags.MATE_REVERSE_STRAND):
-                ret.next_mate_position.strand = protocol.NEG_STRAND
-        if SamFlags.isFlagSet(read.flag, SamFlags.READ_PAIRED):
-            ret.number_reads = 2
-        else:
-            ret.number_reads = 1
-        ret.read_number = -1
-        if SamFlags.isFlagSet(read.flag, SamFlags.FIRST_IN_PAIR):
-            if SamFlags.isFlagSet(read.flag, SamFlags.SECOND_IN_PAIR):
-                ret.read_number = 2
-            else:
-                ret.read_number = 0
-        elif SamFlags.isFlagSet(read.flag, SamFlags.SECOND_IN_PAIR):
-            ret.read_number = 1
-        ret.improper_placement = not SamFlags.isFlagSet(
-            read.flag, SamFlags.READ_PROPER_PAIR)
+                nextMatePosition.reference_name = ""
+            nextMatePosition.position = read.next_reference_start
+            nextMatePosition.strand = flagFields.mateStrand
         ret.read_group_id = readGroupId
-        ret.secondary_alignment = SamFlags.isFlagSet(
-            read.flag, SamFlags.SECONDARY_ALIGNMENT)
-        ret.supplementary_alignment = SamFlags.isFlagSet(
-            read.flag, SamFlags.SUPPLEMENTARY_ALIGNMENT)
         ret.id = readGroupSet.getReadAlignmentId(ret)
         return ret
 
-    def openFile(self, dataFile):
+    def openFile(self, dataFile, threads=0):
+        kwargs = {}
+        if threads > 0:
+            kwargs["threads"] = threads
+        if self.isCram():
+            kwargs["reference_filename"] = self.getCramReferenceFile()
+        return self._openAlignmentFile(**kwargs)
+
+    def _openAlignmentFile(self, **kwargs):
+        """
+        Opens the alignment file with the specified pysam arguments.
+        """
         # We need to check to see if the path exists here as pysam does
         # not throw an error if the index is missing.
         if not os.path.exists(self._indexFile):
             raise exceptions.FileOpenFailedException(self._indexFile)
         try:
             return pysam.AlignmentFile(
-                self._dataUrl, filepath_index=self._indexFile)
+                self._dataUrl, filepath_index=self._indexFile, **kwargs)
         except IOError as exception:
             # IOError thrown when the index file passed in is not actually
             # an index file... may also happen in other cases?
@@ -311,14 +835,23 @@ class AbstractReadGroupSet(datamodel.DatamodelObject):
         """
         raise NotImplementedError()
 
+    def getSeekableReadAlignments(
+            self, reference, start=None, end=None, virtualOffset=None):
+        """
+        Returns an iterator over (virtualOffset, readAlignment) pairs for
+        the specified reads, or None if this ReadGroupSet cannot resume
+        iteration from a file offset.
+        """
+        return None
+
     def getReadAlignmentId(self, gaAlignment):
         """
         Returns a string ID suitable for use in the specified GA
         ReadAlignment object in this ReadGroupSet.
         """
-        compoundId = datamodel.ReadAlignmentCompoundId(
-            self.getCompoundId(), gaAlignment.fragment_name)
-        return str(compoundId)
+        formatter = self.getChildIdFormatter(
+            datamodel.ReadAlignmentCompoundId)
+        return formatter.format(gaAlignment.fragment_name)
 
     def getStats(self):
         """
@@ -353,9 +886,11 @@ class SimulatedReadGroupSet(AbstractReadGroupSet):
     def getPrograms(self):
         return []
 
-    def getReadAlignments(self, referenceId=None, start=None, end=None):
+    def getReadAlignments(
+            self, referenceId=None, start=None, end=None, readSampler=None):
         for readGroup in self.getReadGroups():
-            iterator = readGroup.getReadAlignments(referenceId, start, end)
+            iterator = readGroup.getReadAlignments(
+                referenceId, start, end, readSampler)
             for alignment in iterator:
                 yield alignment
 
@@ -374,12 +909,66 @@ class HtslibReadGroupSet(AlignmentDataMixin, AbstractReadGroupSet):
         # Used when we populate from a file. Not defined when we populate
         # from the DB.
         self._bamHeaderReferenceSetName = None
+        # The ReadGroupIndex of the BAM file, or None if it has no usable
+        # index. Loaded when first used.
+        self._readGroupIndex = None
+        self._readGroupIndexLoaded = False
 
-    def getReadAlignments(self, reference, start=None, end=None):
+    def getReadAlignments(
+            self, reference, start=None, end=None, readSampler=None):
         """
-        Returns an iterator over the specified reads
+        Returns an iterator over the specified reads, restricted to those
+        selected by the specified ReadSampler, if any.
+        """
+        return self._getReadAlignments(
+            reference, start, end, self, None, readSampler)
+
+    def getSeekableReadAlignments(
+            self, reference, start=None, end=None, virtualOffset=None):
+        """
+        Returns an iterator over (virtualOffset, readAlignment) pairs for
+        the specified reads, or None if the reads are stored in a CRAM
+        file, which cannot be resumed from a BGZF virtual offset.
+        """
+        if self.isCram():
+            return None
+        return self._getSeekableReadAlignments(
+            reference, start, end, self, None, virtualOffset)
+
+    def getReadGroupIndex(self):
+        """
+        Returns the ReadGroupIndex of the BAM file, or None if it has no
+        usable index.
         """
-        return self._getReadAlignments(reference, start, end, self, None)
+        if not self._readGroupIndexLoaded:
+            self._readGroupIndex = ReadGroupIndex.load(self._indexFile)
+            self._readGroupIndexLoaded = True
+        return self._readGroupIndex
+
+    def buildReadGroupIndex(self, binSize=ReadGroupIndex.defaultBinSize):
+        """
+        Returns a new ReadGroupIndex of the reads in the BAM file.
+        """
+        readGroupIndex = ReadGroupIndex(binSize)
+        samFile = self.getFileHandle(self._dataUrl)
+        for referenceName in samFile.references:
+            for readAlignment in samFile.fetch(referenceName):
+                readGroupTag = self._getReadGroupTag(readAlignment)
+                if readGroupTag is not None:
+                    readGroupIndex.addRecord(
+                        referenceName, readAlignment.reference_start,
+                        [readGroupTag])
+        return readGroupIndex
+
+    def writeReadGroupIndex(self, binSize=ReadGroupIndex.defaultBinSize):
+        """
+        Builds the ReadGroupIndex of the BAM file, and writes it next to
+        the index of the file.
+        """
+        readGroupIndex = self.buildReadGroupIndex(binSize)
+        readGroupIndex.write(self._indexFile)
+        self._readGroupIndex = readGroupIndex
+        self._readGroupIndexLoaded = True
 
     def getBamHeaderReferenceSetName(self):
         """
@@ -412,8 +1001,29 @@ class HtslibReadGroupSet(AlignmentDataMixin, AbstractReadGroupSet):
         self._dataUrl = dataUrl
         self._indexFile = indexFile
         if indexFile is None:
-            self._indexFile = dataUrl + ".bai"
-        samFile = self.getFileHandle(self._dataUrl)
+            self._indexFile = getDefaultIndexFile(dataUrl)
+        if self.isCram():
+            # The reference set that a CRAM file is decoded with is not
+            # known until its header has been read, so the header is read
+            # from a handle that is not kept in the file handle cache.
+            # The read counts are left at -1, as a CRAM index does not
+            # hold them and counting would decode every read.
+            samFile = self._openAlignmentFile()
+            try:
+                self._populateFromHeader(samFile)
+            finally:
+                samFile.close()
+        else:
+            samFile = self.getFileHandle(self._dataUrl)
+            self._populateFromHeader(samFile)
+            self._numAlignedReads = samFile.mapped
+            self._numUnalignedReads = samFile.unmapped
+
+    def _populateFromHeader(self, samFile):
+        """
+        Populates the programs, read groups and reference set name of
+        this ReadGroupSet from the header of the specified pysam file.
+        """
         self._setHeaderFields(samFile)
         if 'RG' not in samFile.header or len(samFile.header['RG']) == 0:
             readGroup = HtslibReadGroup(self, self.defaultReadGroupName)
@@ -435,8 +1045,6 @@ class HtslibReadGroupSet(AlignmentDataMixin, AbstractReadGroupSet):
             elif self._bamHeaderReferenceSetName != name:
                 raise exceptions.MultipleReferenceSetsInReadGroupSet(
                     self._dataUrl, name, self._bamFileReferenceName)
-        self._numAlignedReads = samFile.mapped
-        self._numUnalignedReads = samFile.unmapped
 
     def checkConsistency(self, dataRepository):
         pass
@@ -475,6 +1083,17 @@ class HtslibReadGroupSet(AlignmentDataMixin, AbstractReadGroupSet):
         """
         return self._indexFile
 
+    def getCramReferenceFile(self):
+        """
+        Returns the path of the FASTA file of the reference set that the
+        CRAM file of this ReadGroupSet is decoded with. References are
+        only read from this file, and never downloaded.
+        """
+        referenceSet = self.getReferenceSet()
+        if not isinstance(referenceSet, references.HtslibReferenceSet):
+            raise exceptions.CramReferenceNotFoundException(self._dataUrl)
+        return referenceSet.getDataUrl()
+
 
 class AbstractReadGroup(datamodel.DatamodelObject):
     """
@@ -565,6 +1184,15 @@ class AbstractReadGroup(datamodel.DatamodelObject):
         """
         raise NotImplementedError()
 
+    def getSeekableReadAlignments(
+            self, reference, start=None, end=None, virtualOffset=None):
+        """
+        Returns an iterator over (virtualOffset, readAlignment) pairs for
+        the specified reads, or None if this ReadGroup cannot resume
+        iteration from a file offset.
+        """
+        return None
+
     def getBiosampleId(self):
         return self._biosampleId
 
@@ -643,7 +1271,14 @@ class SimulatedReadGroup(AbstractReadGroup):
         self._numAlignedReads = self._parentContainer.getNumAlignedReads()
         self._numUnalignedReads = 0
 
-    def getReadAlignments(self, referenceId=None, start=None, end=None):
+    def getReadAlignments(
+            self, referenceId=None, start=None, end=None, readSampler=None):
+        readAlignments = self._getSimulatedReadAlignments()
+        if readSampler is not None:
+            readAlignments = readSampler.sampleReadAlignments(readAlignments)
+        return readAlignments
+
+    def _getSimulatedReadAlignments(self):
         rng = random.Random(self._randomSeed)
 
         # We seed reads with sequential seeds starting from here. We hope no
@@ -772,12 +1407,34 @@ class HtslibReadGroup(AlignmentDataMixin, AbstractReadGroup):
         self._platformUnit = experiment.platform_unit
         self._runTime = experiment.run_time
 
-    def getReadAlignments(self, reference, start=None, end=None):
+    def getReadAlignments(
+            self, reference, start=None, end=None, readSampler=None):
         """
-        Returns an iterator over the specified reads
+        Returns an iterator over the specified reads, restricted to those
+        selected by the specified ReadSampler, if any.
         """
         return self._getReadAlignments(
-            reference, start, end, self._parentContainer, self)
+            reference, start, end, self._parentContainer, self, readSampler)
+
+    def getSeekableReadAlignments(
+            self, reference, start=None, end=None, virtualOffset=None):
+        """
+        Returns an iterator over (virtualOffset, readAlignment) pairs for
+        the specified reads, or None if the reads are stored in a CRAM
+        file, which cannot be resumed from a BGZF virtual offset.
+        """
+        if self.isCram():
+            return None
+        return self._getSeekableReadAlignments(
+            reference, start, end, self._parentContainer, self,
+            virtualOffset)
+
+    def getCramReferenceFile(self):
+        """
+        Returns the path of the FASTA file that the CRAM file of this
+        ReadGroup is decoded with.
+        """
+        return self._parentContainer.getCramReferenceFile()
 
     def getPrograms(self):
         return self._parentContainer.getPrograms()
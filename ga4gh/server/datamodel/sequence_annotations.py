@@ -208,11 +208,9 @@ class AbstractFeatureSet(datamodel.DatamodelObject):
             Feature object in this FeatureSet.
         """
         if featureId is not None and featureId != "":
-            compoundId = datamodel.FeatureCompoundId(
-                self.getCompoundId(), str(featureId))
-        else:
-            compoundId = ""
-        return str(compoundId)
+            formatter = self.getChildIdFormatter(datamodel.FeatureCompoundId)
+            return str(formatter.format(str(featureId)))
+        return ""
 
 
 class SimulatedFeatureSet(AbstractFeatureSet):
@@ -398,7 +396,7 @@ class Gff3DbFeatureSet(AbstractFeatureSet):
                 self.getCompoundIdForFeatureId,
                 json.loads(feature['child_ids'])))
         gaFeature.feature_type.CopyFrom(
-            self._ontology.getGaTermByName(feature['type']))
+            self._ontology.getSharedGaTermByName(feature['type']))
         attributes = json.loads(feature['attributes'])
         # TODO: Identify which values are ExternalIdentifiers and OntologyTerms
         for key in attributes:
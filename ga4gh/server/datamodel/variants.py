@@ -6,16 +6,30 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import collections
 import datetime
 import glob
 import hashlib
+import itertools
 import json
+import operator
 import os
 import random
 import re
+import threading
 
 import pysam
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import cyvcf2
+except ImportError:
+    cyvcf2 = None
+
 import ga4gh.server.exceptions as exceptions
 import ga4gh.server.datamodel as datamodel
 
@@ -27,6 +41,10 @@ ANNOTATIONS_VEP_V82 = "VEP_v82"
 ANNOTATIONS_VEP_V77 = "VEP_v77"
 ANNOTATIONS_SNPEFF = "SNPEff"
 
+VARIANT_ENGINE_PYSAM = "pysam"
+VARIANT_ENGINE_CYVCF2 = "cyvcf2"
+VARIANT_ENGINES = [VARIANT_ENGINE_PYSAM, VARIANT_ENGINE_CYVCF2]
+
 
 # Utility functions for module
 
@@ -40,12 +58,631 @@ def isUnspecified(str):
 
 _nothing = object()
 
+# The names of the Genotype values for the allele index tuples that
+# pysam returns for the GT field. All other genotypes without missing
+# alleles are OTHER.
+_genotypeNames = {
+    (0, 0): 'HOMOZYGOUS_REF',
+    (0, 1): 'HETEROZYGOUS_ALT',
+    (1, 0): 'HETEROZYGOUS_ALT',
+    (1, 1): 'HOMOZYGOUS_ALT',
+    (1,): 'HEMIZYGOUS_ALT',
+    (0,): 'HEMIZYGOUS_REF',
+}
+
+
+def convertGenotypeAlleles(alleles):
+    """
+    Returns the Genotype value for the specified tuple of allele indexes,
+    in which missing alleles are None.
+    """
+    if len(alleles) == 0 or None in alleles:
+        return protocol.Genotype.Value('NA')
+    return protocol.Genotype.Value(_genotypeNames.get(alleles, 'OTHER'))
+
+
+def getGenotypeAllelePair(alleles):
+    """
+    Returns a (first, second) pair of allele indexes summarising the
+    specified tuple of allele indexes returned by pysam, as read into the
+    arrays passed to convertGenotypeArray. Missing genotypes are (-1, -1),
+    the second allele of haploid genotypes is -2, and allele indexes
+    greater than 1, which are all OTHER genotypes, are 2.
+    """
+    ploidy = len(alleles)
+    if ploidy == 0 or None in alleles:
+        return -1, -1
+    if ploidy > 2:
+        return 2, 2
+    first = min(alleles[0], 2)
+    if ploidy == 1:
+        return first, -2
+    return first, min(alleles[1], 2)
+
+
+def convertGenotypeArray(alleles):
+    """
+    Returns an int8 array of the Genotype values for the specified int8
+    array of allele index pairs, as returned by getGenotypeAllelePair,
+    whose last axis holds the first and second alleles.
+    """
+    first = alleles[..., 0]
+    second = alleles[..., 1]
+    isHaploid = second == -2
+    isDiploid = ~isHaploid & (first >= 0) & (first <= 1) & (second <= 1)
+    alleleSum = first + second
+    codes = numpy.select(
+        [first == -1,
+         isDiploid & (alleleSum == 0),
+         isDiploid & (alleleSum == 1),
+         isDiploid & (alleleSum == 2),
+         isHaploid & (first == 0),
+         isHaploid & (first == 1)],
+        [protocol.Genotype.Value(name) for name in [
+            'NA', 'HOMOZYGOUS_REF', 'HETEROZYGOUS_ALT', 'HOMOZYGOUS_ALT',
+            'HEMIZYGOUS_REF', 'HEMIZYGOUS_ALT']],
+        default=protocol.Genotype.Value('OTHER'))
+    return codes.astype(numpy.int8)
+
 
 def isEmptyIter(it):
     """Return True iff the iterator is empty or exhausted"""
     return next(it, _nothing) is _nothing
 
 
+def checkVariantEngine(engine):
+    """
+    Raises a ConfigurationException if the specified variant engine is
+    not known or cannot be used.
+    """
+    if engine not in VARIANT_ENGINES:
+        raise exceptions.ConfigurationException(
+            "Unknown variant engine '{}'".format(engine))
+    if engine == VARIANT_ENGINE_CYVCF2:
+        if cyvcf2 is None:
+            raise exceptions.ConfigurationException(
+                "The cyvcf2 variant engine requires the cyvcf2 package")
+        if not hasattr(cyvcf2.Variant, "FILTERS"):
+            raise exceptions.ConfigurationException(
+                "The cyvcf2 variant engine requires a release of cyvcf2 "
+                "providing Variant.FILTERS")
+
+
+def setDefaultVariantEngine(engine):
+    """
+    Sets the engine used to read and convert the records of
+    HtslibVariantSets that do not specify their own engine.
+    """
+    checkVariantEngine(engine)
+    HtslibVariantSet.defaultVariantEngine = engine
+
+
+# cyvcf2 uses these values in numeric arrays to represent missing values
+# and the padding after the end of shorter vectors.
+_bcfInt32Missing = -2**31
+_bcfInt32VectorEnd = -2**31 + 1
+_bcfFloatMissingBits = 0x7F800001
+_bcfFloatVectorEndBits = 0x7F800002
+
+
+def _convertCyvcf2FormatValues(values, bits, isScalar):
+    """
+    Converts the specified list of the values of a cyvcf2 numeric format
+    array for a single sample into the value pysam returns. For float
+    arrays, bits is the list of the same values viewed as int32, and is
+    None otherwise.
+    """
+    converted = []
+    for j, value in enumerate(values):
+        if bits is None:
+            if value == _bcfInt32VectorEnd:
+                break
+            if value == _bcfInt32Missing:
+                value = None
+        else:
+            if bits[j] == _bcfFloatVectorEndBits:
+                break
+            if bits[j] == _bcfFloatMissingBits:
+                value = None
+        converted.append(value)
+    if isScalar:
+        if len(converted) == 0:
+            return None
+        return converted[0]
+    return tuple(converted)
+
+
+class Cyvcf2VariantFile(object):
+    """
+    A cyvcf2 reader for an indexed VCF or BCF file, along with the header
+    information needed to convert its records into the same values as
+    pysam.
+    """
+    def __init__(self, dataUrl, indexFile=None):
+        self._processId = os.getpid()
+        self._vcf = cyvcf2.VCF(dataUrl)
+        if indexFile is not None:
+            self._vcf.set_index(indexFile)
+        self._sampleIndexes = dict(
+            (sampleName, index)
+            for index, sampleName in enumerate(self._vcf.samples))
+        self._vectorInfoKeys = set()
+        self._scalarFormatKeys = set()
+        self._stringFormatKeys = set()
+        for headerRecord in self._vcf.header_iter():
+            if headerRecord.type not in ("INFO", "FORMAT"):
+                continue
+            header = headerRecord.info()
+            key = str(header["ID"])
+            isScalar = header["Number"] in ("0", "1")
+            if headerRecord.type == "INFO":
+                if not isScalar:
+                    self._vectorInfoKeys.add(key)
+            else:
+                if isScalar:
+                    self._scalarFormatKeys.add(key)
+                if header["Type"] in ("String", "Character"):
+                    self._stringFormatKeys.add(key)
+
+    def getProcessId(self):
+        """
+        Returns the ID of the process that opened this file.
+        """
+        return self._processId
+
+    def getSampleIndexes(self, sampleNames):
+        """
+        Returns the list of the column indexes of the specified samples.
+        """
+        return [self._sampleIndexes[sampleName] for sampleName in sampleNames]
+
+    def fetch(self, referenceName, start, end):
+        """
+        Returns an iterator over the records overlapping the specified
+        0-based half open interval.
+        """
+        return self._vcf("{}:{}-{}".format(referenceName, start + 1, end))
+
+    def getInfo(self, record):
+        """
+        Returns a list of the (key, value) pairs in the INFO field of the
+        specified record, as pysam returns them.
+        """
+        info = []
+        for key, value in record.INFO:
+            key = str(key)
+            if isinstance(value, unicode):
+                value = str(value)
+            elif isinstance(value, tuple):
+                value = tuple(
+                    str(v) if isinstance(v, unicode) else v for v in value)
+            if key in self._vectorInfoKeys:
+                # cyvcf2 returns vectors of strings as a single string
+                if isinstance(value, str):
+                    value = tuple(value.split(","))
+                elif not isinstance(value, tuple):
+                    value = (value,)
+            info.append((key, value))
+        return info
+
+    def getFilterKeys(self, record):
+        """
+        Returns the list of the filters in the FILTER field of the
+        specified record, as pysam returns them.
+        """
+        # Unlike FILTER, FILTERS distinguishes PASS from missing filters
+        return [str(key) for key in record.FILTERS]
+
+    def getFormatValues(self, record, sampleIndexes):
+        """
+        Returns a list of (key, values) pairs for each of the fields other
+        than GT in the FORMAT of the specified record, in which values is
+        the list of the values pysam returns for the specified samples.
+        """
+        formatValues = []
+        for key in record.FORMAT:
+            key = str(key)
+            if key == "GT":
+                continue
+            array = record.format(key)
+            if array is None:
+                continue
+            array = array[sampleIndexes]
+            if key in self._stringFormatKeys:
+                values = [str(value) for value in array.tolist()]
+            else:
+                rows = array.tolist()
+                bits = [None] * len(rows)
+                if array.dtype.kind == "f":
+                    bits = array.view(numpy.int32).tolist()
+                isScalar = key in self._scalarFormatKeys
+                values = [
+                    _convertCyvcf2FormatValues(row, rowBits, isScalar)
+                    for row, rowBits in zip(rows, bits)]
+            formatValues.append((key, values))
+        return formatValues
+
+    def getAlleleIndexes(self, record, sampleIndexes):
+        """
+        Returns a list of (alleleIndexes, phased) pairs for the specified
+        samples of the specified record, as pysam returns them.
+        """
+        if record.genotype is None:
+            return [((), False)] * len(sampleIndexes)
+        genotypes = record.genotype.array()[sampleIndexes].tolist()
+        alleleIndexes = []
+        for genotype in genotypes:
+            alleles = tuple(
+                None if allele == -1 else allele
+                for allele in genotype[:-1] if allele >= -1)
+            alleleIndexes.append(
+                (alleles, len(alleles) == 1 or bool(genotype[-1])))
+        return alleleIndexes
+
+    def getGenotypeBlock(self, records, sampleIndexes):
+        """
+        Returns an int8 array of the Genotype values of the specified
+        samples in the specified records, with one row per record.
+        """
+        genotypeValues = numpy.array([
+            protocol.Genotype.Value(name) for name in [
+                'NA', 'OTHER', 'HOMOZYGOUS_REF', 'HETEROZYGOUS_ALT',
+                'HOMOZYGOUS_ALT', 'HEMIZYGOUS_REF', 'HEMIZYGOUS_ALT']],
+            dtype=numpy.int8)
+        block = numpy.empty(
+            (len(records), len(sampleIndexes)), dtype=numpy.int8)
+        for j, record in enumerate(records):
+            if record.genotype is None:
+                block[j] = genotypeValues[0]
+                continue
+            alleles = record.genotype.array()[sampleIndexes, :-1]
+            first = alleles[:, 0]
+            if alleles.shape[1] > 1:
+                second = alleles[:, 1]
+                ploidy = (alleles >= -1).sum(axis=1)
+            else:
+                second = numpy.full(len(sampleIndexes), -2, numpy.int16)
+                ploidy = numpy.ones(len(sampleIndexes), numpy.int16)
+            isMissing = (alleles == -1).any(axis=1)
+            isBiallelic = (first >= 0) & (first <= 1)
+            isDiploid = (ploidy == 2) & isBiallelic & (second >= 0) & (
+                second <= 1)
+            isHaploid = (ploidy == 1) & isBiallelic
+            codes = numpy.select(
+                [isMissing,
+                 isDiploid & (first + second == 0),
+                 isDiploid & (first + second == 1),
+                 isDiploid & (first + second == 2),
+                 isHaploid & (first == 0),
+                 isHaploid & (first == 1)],
+                [0, 2, 3, 4, 5, 6], default=1)
+            block[j] = genotypeValues[codes]
+        return block
+
+    def close(self):
+        self._vcf.close()
+
+
+class VariantBlockCache(object):
+    """
+    A thread-safe least recently used cache of the converted variants of
+    fixed-size bins of the references of HtslibVariantSets, so that
+    repeated searches over the same regions are answered without reading
+    and converting the records again. Each block is the list of variants
+    overlapping a bin, keyed by the variant set, its file, the bin and the
+    requested call sets. Blocks are evicted once the total serialized size
+    of the variants exceeds maxBytes; a value of 0 disables the cache.
+    The cached variants are shared between searches and must not be
+    modified.
+    """
+    # Searches spanning more bins than this are not cached, so that scans
+    # of whole references do not evict the blocks of frequent searches.
+    maxSearchBins = 16
+
+    def __init__(self, maxBytes=0, binSize=10000):
+        self._blocks = collections.OrderedDict()
+        self._numBytes = 0
+        self._maxBytes = maxBytes
+        self._binSize = binSize
+        self._lock = threading.Lock()
+        self._numHits = 0
+        self._numMisses = 0
+
+    def setMaxBytes(self, maxBytes):
+        """
+        Sets the maximum total size of the variants held in the cache.
+        """
+        if maxBytes < 0:
+            raise ValueError(
+                "The size of the variant block cache must be non-negative")
+        with self._lock:
+            self._maxBytes = maxBytes
+            self._evict()
+
+    def getMaxBytes(self):
+        """
+        Returns the maximum total size of the variants held in the cache.
+        """
+        return self._maxBytes
+
+    def setBinSize(self, binSize):
+        """
+        Sets the number of bases in each cached block, discarding the
+        blocks that are currently cached.
+        """
+        if binSize <= 0:
+            raise ValueError(
+                "The variant block cache bin size must be a strictly "
+                "positive value")
+        with self._lock:
+            self._binSize = binSize
+            self._clear()
+
+    def getBinSize(self):
+        """
+        Returns the number of bases in each cached block.
+        """
+        return self._binSize
+
+    def isEnabled(self):
+        """
+        Returns True if variant blocks are cached.
+        """
+        return self._maxBytes > 0
+
+    def isCacheable(self, startPosition, endPosition):
+        """
+        Returns True if the variants of a search over the specified
+        interval are read through the cache.
+        """
+        return (
+            self.isEnabled() and startPosition is not None and
+            endPosition is not None and startPosition < endPosition and
+            endPosition - max(startPosition, 0) <=
+            self.maxSearchBins * self._binSize)
+
+    def getNumHits(self):
+        """
+        Returns the number of blocks that were served from the cache.
+        """
+        return self._numHits
+
+    def getNumMisses(self):
+        """
+        Returns the number of blocks that were requested from the cache
+        but not found.
+        """
+        return self._numMisses
+
+    def getNumBytes(self):
+        """
+        Returns the total size of the variants currently in the cache.
+        """
+        return self._numBytes
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def _evict(self):
+        while self._numBytes > self._maxBytes:
+            _, (block, numBytes) = self._blocks.popitem(last=False)
+            self._numBytes -= numBytes
+
+    def _clear(self):
+        self._blocks.clear()
+        self._numBytes = 0
+
+    def clear(self):
+        """
+        Discards all cached blocks.
+        """
+        with self._lock:
+            self._clear()
+
+    def get(self, key):
+        """
+        Returns the list of variants for the specified key, or None if it
+        is not in the cache.
+        """
+        with self._lock:
+            entry = self._blocks.pop(key, None)
+            if entry is None:
+                self._numMisses += 1
+                return None
+            self._blocks[key] = entry
+            self._numHits += 1
+            return entry[0]
+
+    def put(self, key, block):
+        """
+        Adds the specified list of variants to the cache, evicting the
+        least recently used blocks until the cache is within its size.
+        Blocks larger than the cache are not added.
+        """
+        numBytes = sum(variant.ByteSize() for variant in block)
+        with self._lock:
+            if numBytes > self._maxBytes or key in self._blocks:
+                return
+            self._blocks[key] = block, numBytes
+            self._numBytes += numBytes
+            self._evict()
+
+
+# LRU cache of the converted variants of HtslibVariantSets
+variantBlockCache = VariantBlockCache()
+
+
+class VariantFilter(object):
+    """
+    A filter on the INFO and FILTER fields of variant records, which
+    HtslibVariantSets evaluate on the records they read before converting
+    them into Variants. Each INFO predicate is either a key, which must be
+    present (and set, for flags), or a key followed by one of the
+    operators =, !=, <, <=, > or >= and a value. Values are compared as
+    numbers if the predicate value is numeric and as strings otherwise,
+    and a predicate on a key with several values holds if it holds for
+    any of them. If passOnly is True, only records whose FILTER is PASS
+    are included.
+    """
+    _predicatePattern = re.compile(
+        r"^([A-Za-z_][0-9A-Za-z_.]*)(?:(!=|<=|>=|=|<|>)(.+))?$")
+    _operators = {
+        "=": operator.eq,
+        "!=": operator.ne,
+        "<": operator.lt,
+        "<=": operator.le,
+        ">": operator.gt,
+        ">=": operator.ge,
+    }
+
+    def __init__(self, infoPredicates=[], passOnly=False):
+        self._infoPredicates = [
+            self._parsePredicate(predicate) for predicate in infoPredicates]
+        self._passOnly = passOnly
+        self._key = tuple(infoPredicates), passOnly
+
+    def _parsePredicate(self, predicate):
+        """
+        Returns a (key, operator, value, numericValue) tuple for the
+        specified predicate string, in which operator and the values are
+        None for predicates on the presence of a key, and numericValue is
+        None if the value is not a number.
+        """
+        match = self._predicatePattern.match(predicate)
+        if match is None:
+            raise exceptions.BadVariantFilterException(predicate)
+        key, operatorString, value = match.groups()
+        if operatorString is None:
+            return str(key), None, None, None
+        try:
+            numericValue = float(value)
+        except ValueError:
+            numericValue = None
+            if operatorString not in ("=", "!="):
+                raise exceptions.BadVariantFilterException(predicate)
+        return (
+            str(key), self._operators[operatorString], value, numericValue)
+
+    def isPassOnly(self):
+        """
+        Returns True if only records whose FILTER is PASS are included.
+        """
+        return self._passOnly
+
+    def __eq__(self, other):
+        return isinstance(other, VariantFilter) and self._key == other._key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def _matchesValue(self, value, compare, operand, numericOperand):
+        if not isinstance(value, (tuple, list)):
+            value = (value,)
+        for item in value:
+            if isinstance(item, basestring):
+                items = item.split(",")
+            else:
+                items = (item,)
+            for item in items:
+                if item is None:
+                    continue
+                if numericOperand is None:
+                    if compare(unicode(item), operand):
+                        return True
+                    continue
+                try:
+                    if compare(float(item), numericOperand):
+                        return True
+                except ValueError:
+                    pass
+        return False
+
+    def _matches(self, getFilterKeys, getInfoValue):
+        """
+        Returns True if the record whose FILTER keys and INFO values are
+        returned by the specified functions passes this filter.
+        """
+        if self._passOnly and getFilterKeys() != ["PASS"]:
+            return False
+        for key, compare, operand, numericOperand in self._infoPredicates:
+            value = getInfoValue(key)
+            if value is False:
+                # An unset flag is absent from the record, as it is
+                # from the attributes of the converted variant.
+                value = None
+            if compare is None:
+                if value is None:
+                    return False
+            elif value is None or not self._matchesValue(
+                    value, compare, operand, numericOperand):
+                return False
+        return True
+
+    def matchesPysamRecord(self, record):
+        """
+        Returns True if the specified pysam record passes this filter.
+        """
+        def getInfoValue(key):
+            try:
+                return record.info.get(key)
+            except (KeyError, ValueError):
+                return None
+        return self._matches(
+            lambda: list(record.filter.keys()), getInfoValue)
+
+    def matchesCyvcf2Record(self, variantFile, record):
+        """
+        Returns True if the specified cyvcf2 record, read from the
+        specified Cyvcf2VariantFile, passes this filter.
+        """
+        def getInfoValue(key):
+            try:
+                return record.INFO.get(key)
+            except (KeyError, ValueError):
+                return None
+        return self._matches(
+            lambda: variantFile.getFilterKeys(record), getInfoValue)
+
+    def matchesVariant(self, variant):
+        """
+        Returns True if the record that the specified Variant was
+        converted from passes this filter.
+        """
+        def getFilterKeys():
+            if not variant.filters_applied:
+                return []
+            if variant.filters_passed:
+                return ["PASS"]
+            return list(variant.filters_failed)
+
+        def getInfoValue(key):
+            if key in variant.attributes.attr:
+                return [
+                    protocol.getValueFromValue(value)
+                    for value in variant.attributes.attr[key].values]
+            return self._getStructuralVariantValue(variant, key)
+        return self._matches(getFilterKeys, getInfoValue)
+
+    @staticmethod
+    def _getStructuralVariantValue(variant, key):
+        """
+        Returns the value of the specified structural variant INFO key
+        held in the dedicated fields of the specified Variant, or None.
+        """
+        if key == "SVTYPE" and variant.variant_type:
+            return variant.variant_type
+        elif key == "SVLEN" and variant.svlen:
+            return [variant.svlen]
+        elif key == "CIPOS" and len(variant.cipos) > 0:
+            return list(variant.cipos)
+        elif key == "CIEND" and len(variant.ciend) > 0:
+            return list(variant.ciend)
+        return None
+
+
 class CallSet(datamodel.DatamodelObject):
     """
     Class representing a CallSet. A CallSet basically represents the
@@ -113,6 +750,9 @@ class AbstractVariantSet(datamodel.DatamodelObject):
     An abstract base class of a variant set
     """
     compoundIdClass = datamodel.VariantSetCompoundId
+    # The maximum number of distinct (reference, alternates) hashes kept
+    # for generating variant IDs.
+    _maxVariantHashes = 4096
 
     def __init__(self, parentContainer, localId):
         super(AbstractVariantSet, self).__init__(parentContainer, localId)
@@ -126,6 +766,7 @@ class AbstractVariantSet(datamodel.DatamodelObject):
         self._metadata = []
         self._variantAnnotationSetIds = []
         self._variantAnnotationSetIdMap = {}
+        self._variantHashes = {}
 
     def addVariantAnnotationSet(self, variantAnnotationSet):
         """
@@ -269,6 +910,16 @@ class AbstractVariantSet(datamodel.DatamodelObject):
         """
         raise NotImplementedError()
 
+    def getSeekableVariants(
+            self, referenceName, startPosition, endPosition,
+            callSetIds=None, virtualOffset=None, variantFilter=None):
+        """
+        Returns an iterator over (virtualOffset, variant) pairs for the
+        specified variants, or None if this VariantSet cannot resume
+        iteration from a file offset.
+        """
+        return None
+
     def _createGaVariant(self):
         """
         Convenience method to set the common fields in a GA Variant
@@ -287,11 +938,25 @@ class AbstractVariantSet(datamodel.DatamodelObject):
         Returns an ID string suitable for the specified GA Variant
         object in this variant set.
         """
-        md5 = self.hashVariant(gaVariant)
-        compoundId = datamodel.VariantCompoundId(
-            self.getCompoundId(), gaVariant.reference_name,
-            str(gaVariant.start), md5)
-        return str(compoundId)
+        md5 = self._getAllelesHash(
+            gaVariant.reference_bases, gaVariant.alternate_bases)
+        formatter = self.getChildIdFormatter(datamodel.VariantCompoundId)
+        return formatter.format(
+            gaVariant.reference_name, str(gaVariant.start), md5)
+
+    def _getAllelesHash(self, referenceBases, alternateBases):
+        """
+        Returns the hashAlleles value for the specified alleles, memoized
+        for recurring alleles.
+        """
+        key = referenceBases, tuple(alternateBases)
+        md5 = self._variantHashes.get(key)
+        if md5 is None:
+            md5 = self.hashAlleles(*key)
+            if len(self._variantHashes) >= self._maxVariantHashes:
+                self._variantHashes.clear()
+            self._variantHashes[key] = md5
+        return md5
 
     def getCallSetId(self, sampleName):
         """
@@ -308,8 +973,16 @@ class AbstractVariantSet(datamodel.DatamodelObject):
         Produces an MD5 hash of the ga variant object to distinguish
         it from other variants at the same genomic coordinate.
         """
-        hash_str = gaVariant.reference_bases + \
-            str(tuple(gaVariant.alternate_bases))
+        return cls.hashAlleles(
+            gaVariant.reference_bases, gaVariant.alternate_bases)
+
+    @classmethod
+    def hashAlleles(cls, referenceBases, alternateBases):
+        """
+        Produces the MD5 hash of a variant with the specified reference
+        bases and list of alternate bases, as unicode strings.
+        """
+        hash_str = referenceBases + str(tuple(alternateBases))
         return hashlib.md5(hash_str).hexdigest()
 
 
@@ -380,15 +1053,18 @@ class SimulatedVariantSet(AbstractVariantSet):
         return variant
 
     def getVariants(self, referenceName, startPosition, endPosition,
-                    callSetIds=None):
+                    callSetIds=None, variantFilter=None):
         randomNumberGenerator = random.Random()
         randomNumberGenerator.seed(self._randomSeed)
         i = startPosition
         while i < endPosition:
             if randomNumberGenerator.random() < self._variantDensity:
                 randomNumberGenerator.seed(self._randomSeed + i)
-                yield self.generateVariant(
+                variant = self.generateVariant(
                     referenceName, i, randomNumberGenerator)
+                if (variantFilter is None or
+                        variantFilter.matchesVariant(variant)):
+                    yield variant
             i += 1
 
     def generateVariant(self, referenceName, position, randomNumberGenerator):
@@ -439,10 +1115,48 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
     Class representing a single variant set backed by a directory of indexed
     VCF or BCF files.
     """
+    threadedDecompression = True
+    # The number of records whose genotypes are read together by
+    # getGenotypeMatrix.
+    _genotypeBatchSize = 64
+    # The engine used by variant sets that do not set their own.
+    defaultVariantEngine = VARIANT_ENGINE_PYSAM
+    # The maximum number of idle cyvcf2 readers kept open for each file.
+    _maxIdleCyvcf2Files = 4
+    # The maximum number of distinct genotypes whose Call templates are
+    # kept.
+    _maxGenotypeTemplates = 1024
+    # The number of recently requested variants kept by getVariant.
+    _variantCacheSize = 32
+
     def __init__(self, parentContainer, localId):
         super(HtslibVariantSet, self).__init__(parentContainer, localId)
         self._chromFileMap = {}
         self._metadata = None
+        self._created = None
+        self._updated = None
+        self._variantEngine = None
+        self._idleCyvcf2Files = collections.defaultdict(list)
+        self._genotypeTemplates = {}
+        self._variantCache = datamodel.LruCache(self._variantCacheSize)
+
+    def getVariantEngine(self):
+        """
+        Returns the name of the engine used to read and convert the
+        records of this variant set.
+        """
+        if self._variantEngine is None:
+            return self.defaultVariantEngine
+        return self._variantEngine
+
+    def setVariantEngine(self, engine):
+        """
+        Sets the engine used to read and convert the records of this
+        variant set. If engine is None, the default engine is used.
+        """
+        if engine is not None:
+            checkVariantEngine(engine)
+        self._variantEngine = engine
 
     def isAnnotated(self):
         """
@@ -637,30 +1351,78 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
             for sample in variantFile.header.samples:
                 self.addCallSetFromName(sample)
 
-    def openFile(self, dataUrlIndexFilePair):
+    def openFile(self, dataUrlIndexFilePair, threads=0):
         dataUrl, indexFile = dataUrlIndexFilePair
-        return pysam.VariantFile(dataUrl, index_filename=indexFile)
-
-    def _convertGaCall(self, callSet, pysamCall):
-        phaseset = None
-        if pysamCall.phased:
-            phaseset = str(pysamCall.phased)
+        kwargs = {}
+        if threads > 0:
+            kwargs["threads"] = threads
+        return pysam.VariantFile(
+            dataUrl, index_filename=indexFile, **kwargs)
+
+    def _getCallTemplates(self, callSetIds):
+        """
+        Returns a (sampleNames, callTemplates) pair for the specified
+        callSetIds, where sampleNames lists the VCF sample names of the
+        call sets and callTemplates the Calls with their call set name and
+        id filled in. These are computed once per request and used to
+        create the calls of every variant.
+        """
+        sampleNames = []
+        callTemplates = []
+        for callSetId in callSetIds:
+            callSet = self.getCallSet(callSetId)
+            sampleNames.append(str(callSet.getSampleName()))
+            call = protocol.Call()
+            call.call_set_name = callSet.getSampleName()
+            call.call_set_id = callSet.getId()
+            callTemplates.append(call)
+        return sampleNames, callTemplates
+
+    def _getPysamCallColumns(self, fileSampleNames, callSetIds):
+        """
+        Returns a (sampleIndexes, callTemplates) pair for the specified
+        callSetIds, where sampleIndexes lists the columns of the call
+        sets' samples in a file with the specified samples, such as the
+        samples of a pysam record or header.
+        """
+        if len(callSetIds) == 0:
+            return [], []
+        sampleNames, callTemplates = self._getCallTemplates(callSetIds)
+        columns = dict(
+            (sampleName, index)
+            for index, sampleName in enumerate(fileSampleNames))
+        return [columns[name] for name in sampleNames], callTemplates
+
+    def _setGaCall(self, call, alleleIndexes, phased, formatItems):
+        """
+        Sets the genotype and attributes of the specified GA4GH Call from
+        the specified allele indexes, phasing and (key, value) pairs of
+        format values, as returned by pysam.
+        """
+        genotypeKey = alleleIndexes, phased
+        genotypeTemplate = self._genotypeTemplates.get(genotypeKey)
+        if genotypeTemplate is None:
+            phaseset = None
+            if phased:
+                phaseset = str(phased)
+            genotypeTemplate = protocol.Call()
+            genotypeTemplate.genotype.extend(list(alleleIndexes))
+            genotypeTemplate.phaseset = pb.string(phaseset)
+            if len(self._genotypeTemplates) < self._maxGenotypeTemplates:
+                self._genotypeTemplates[genotypeKey] = genotypeTemplate
+        # Merging the genotype from a template avoids building the
+        # ListValue element by element for every call.
+        call.MergeFrom(genotypeTemplate)
         genotypeLikelihood = []
         info = {}
-        for key, value in pysamCall.iteritems():
+        for key, value in formatItems:
             if key == 'GL' and value is not None:
                 genotypeLikelihood = list(value)
             elif key != 'GT':
                 info[key] = protocol.encodeValue(value)
-        call = protocol.Call()
-        call.call_set_name = callSet.getSampleName()
-        call.call_set_id = callSet.getId()
-        call.genotype.extend(list(pysamCall.allele_indices))
-        call.phaseset = pb.string(phaseset)
         call.genotype_likelihood.extend(genotypeLikelihood)
         for key in info:
             call.attributes.attr[key].values.extend(info[key])
-        return call
 
     def convertVariant(self, record, callSetIds):
         """
@@ -668,6 +1430,16 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
         object. Only calls for the specified list of callSetIds will
         be included.
         """
+        sampleIndexes, callTemplates = self._getPysamCallColumns(
+            record.samples, callSetIds)
+        return self._convertPysamRecord(record, sampleIndexes, callTemplates)
+
+    def _convertPysamRecord(self, record, sampleIndexes, callTemplates):
+        """
+        Converts the specified pysam variant record into a GA4GH Variant
+        object, with calls for the samples in the specified columns, as
+        returned by _getPysamCallColumns.
+        """
         variant = self._createGaVariant()
         variant.reference_name = record.contig
         if record.id is not None:
@@ -677,7 +1449,25 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
         variant.reference_bases = record.ref
         if record.alts is not None:
             variant.alternate_bases.extend(list(record.alts))
-        filterKeys = record.filter.keys()
+        self._setVariantFilters(variant, record.filter.keys())
+        self._setVariantInfo(variant, record.info.iteritems())
+        samples = record.samples
+        for sampleIndex, callTemplate in zip(sampleIndexes, callTemplates):
+            pysamCall = samples[sampleIndex]
+            # The calls are new, so merging is equivalent to copying
+            call = variant.calls.add()
+            call.MergeFrom(callTemplate)
+            self._setGaCall(
+                call, pysamCall.allele_indices, pysamCall.phased,
+                pysamCall.iteritems())
+        variant.id = self.getVariantId(variant)
+        return variant
+
+    def _setVariantFilters(self, variant, filterKeys):
+        """
+        Sets the filter fields of the specified variant from the
+        specified list of the filters in the VCF record.
+        """
         if len(filterKeys) == 0:
             variant.filters_applied = False
         else:
@@ -687,8 +1477,15 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
             else:
                 variant.filters_passed = False
                 variant.filters_failed.extend(filterKeys)
+
+    def _setVariantInfo(self, variant, infoItems):
+        """
+        Sets the attributes and structural variant fields of the specified
+        variant from the specified (key, value) pairs of the INFO field of
+        the VCF record, as returned by pysam.
+        """
         # record.qual is also available, when supported by GAVariant.
-        for key, value in record.info.iteritems():
+        for key, value in infoItems:
             if value is None:
                 continue
             if key == 'SVTYPE':
@@ -703,44 +1500,81 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
                 value = value.split(',')
             protocol.setAttribute(
                 variant.attributes.attr[key].values, value)
-        for callSetId in callSetIds:
-            callSet = self.getCallSet(callSetId)
-            pysamCall = record.samples[str(callSet.getSampleName())]
-            variant.calls.add().CopyFrom(
-                self._convertGaCall(callSet, pysamCall))
+
+    def _getCyvcf2CallColumns(self, variantFile, callSetIds):
+        """
+        Returns a (sampleIndexes, callTemplates) pair for the specified
+        callSetIds, where sampleIndexes lists the columns of the call
+        sets' samples in the specified Cyvcf2VariantFile.
+        """
+        sampleNames, callTemplates = self._getCallTemplates(callSetIds)
+        return variantFile.getSampleIndexes(sampleNames), callTemplates
+
+    def convertCyvcf2Variant(self, variantFile, record, callSetIds):
+        """
+        Converts the specified cyvcf2 record, read from the specified
+        Cyvcf2VariantFile, into a GA4GH Variant object identical to that
+        returned by convertVariant for the equivalent pysam record. Only
+        calls for the specified list of callSetIds will be included.
+        """
+        sampleIndexes, callTemplates = self._getCyvcf2CallColumns(
+            variantFile, callSetIds)
+        return self._convertCyvcf2Record(
+            variantFile, record, sampleIndexes, callTemplates)
+
+    def _convertCyvcf2Record(
+            self, variantFile, record, sampleIndexes, callTemplates):
+        """
+        Converts the specified cyvcf2 record into a GA4GH Variant object,
+        with calls for the samples in the specified columns, as returned
+        by _getCyvcf2CallColumns.
+        """
+        variant = self._createGaVariant()
+        variant.reference_name = record.CHROM
+        if record.ID is not None:
+            variant.names.extend(record.ID.split(';'))
+        variant.start = record.start
+        variant.end = record.end
+        variant.reference_bases = record.REF
+        variant.alternate_bases.extend(record.ALT)
+        self._setVariantFilters(variant, variantFile.getFilterKeys(record))
+        self._setVariantInfo(variant, variantFile.getInfo(record))
+        if len(callTemplates) > 0:
+            alleleIndexes = variantFile.getAlleleIndexes(
+                record, sampleIndexes)
+            formatValues = variantFile.getFormatValues(record, sampleIndexes)
+            for j, callTemplate in enumerate(callTemplates):
+                alleles, phased = alleleIndexes[j]
+                formatItems = [
+                    (key, values[j]) for key, values in formatValues]
+                call = variant.calls.add()
+                call.MergeFrom(callTemplate)
+                self._setGaCall(call, alleles, phased, formatItems)
         variant.id = self.getVariantId(variant)
         return variant
 
-    # we can do better than this, but let's get this working first
-    def convertGenotype(self, record, callSetIds, callSetNames):
-        variant = self.convertVariant(record, [])
-        name_gt_dict = {csn: record.samples[csn][b'GT']
-                        for csn in callSetNames}
-
-        gt_other = protocol.Genotype.Value('OTHER')
-        gt_na = protocol.Genotype.Value('NA')
-        gts = {(0, 0): protocol.Genotype.Value('HOMOZYGOUS_REF'),
-               (0, 1): protocol.Genotype.Value('HETEROZYGOUS_ALT'),
-               (1, 0): protocol.Genotype.Value('HETEROZYGOUS_ALT'),
-               (1, 1): protocol.Genotype.Value('HOMOZYGOUS_ALT'),
-               (1): protocol.Genotype.Value('HEMIZYGOUS_ALT'),
-               (0): protocol.Genotype.Value('HEMIZYGOUS_REF')}
-
-        def gtlist_to_gtenum(gttuple):
-            if None in gttuple:
-                return gt_na
-            if gttuple in gts:
-                return gts[gttuple]
-            return gt_other
-
-        gts = [gtlist_to_gtenum(name_gt_dict[callSet])
-               for callSet in callSetNames]
-
-        gtmatrix = protocol.GenotypeMatrix()
-        gtmatrix.nvariants = 1
-        gtmatrix.nindividuals = len(gts)
-        gtmatrix.genotypes.extend(gts)
-        return gtmatrix, variant, callSetNames
+    def _getGenotypeBlock(self, records, sampleIndexes):
+        """
+        Returns a list with one list of Genotype values for each of the
+        specified pysam records, giving the genotypes of the samples in
+        the specified columns. If numpy is available, the allele indexes
+        of the whole block are read into an int8 array and converted
+        together.
+        """
+        if numpy is None:
+            return [
+                [convertGenotypeAlleles(record.samples[index].allele_indices)
+                 for index in sampleIndexes]
+                for record in records]
+        allelePairs = []
+        for record in records:
+            samples = record.samples
+            allelePairs.extend(
+                getGenotypeAllelePair(samples[index].allele_indices)
+                for index in sampleIndexes)
+        alleles = numpy.array(allelePairs, dtype=numpy.int8).reshape(
+            len(records), len(sampleIndexes), 2)
+        return convertGenotypeArray(alleles).tolist()
 
     def getVariant(self, compoundId):
         if compoundId.reference_name in self._chromFileMap:
@@ -751,16 +1585,36 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
         referenceName, startPosition, endPosition = \
             self.sanitizeVariantFileFetch(
                 compoundId.reference_name, start, start + 1)
-        cursor = self.getFileHandle(varFileName).fetch(
-            referenceName, startPosition, endPosition)
-        for record in cursor:
-            variant = self.convertVariant(record, self._callSetIds)
-            if (record.start == start and
-                    compoundId.md5 == self.hashVariant(variant)):
-                return variant
-            elif record.start > start:
-                raise exceptions.ObjectNotFoundException()
-        raise exceptions.ObjectNotFoundException(compoundId)
+        key = compoundId.reference_name, start, compoundId.md5
+        cachedVariant = self._variantCache.get(key)
+        if cachedVariant is None:
+            cursor = self.getFileHandle(varFileName).fetch(
+                referenceName, startPosition, endPosition)
+            for record in cursor:
+                # Only convert the record whose alleles match the ID
+                if (record.start == start and
+                        compoundId.md5 == self._getPysamAllelesHash(record)):
+                    variant = self.convertVariant(record, self._callSetIds)
+                    cachedVariant = protocol.Variant()
+                    cachedVariant.CopyFrom(variant)
+                    self._variantCache.put(key, cachedVariant)
+                    return variant
+                elif record.start > start:
+                    raise exceptions.ObjectNotFoundException()
+            raise exceptions.ObjectNotFoundException(compoundId)
+        variant = protocol.Variant()
+        variant.CopyFrom(cachedVariant)
+        return variant
+
+    def _getPysamAllelesHash(self, record):
+        """
+        Returns the hash of the alleles of the specified pysam record,
+        equal to that of the Variant that it is converted into.
+        """
+        alternateBases = ()
+        if record.alts is not None:
+            alternateBases = [unicode(alt) for alt in record.alts]
+        return self._getAllelesHash(unicode(record.ref), alternateBases)
 
     def getPysamVariants(self, referenceName, startPosition, endPosition):
         """
@@ -772,42 +1626,260 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
             referenceName, startPosition, endPosition = \
                 self.sanitizeVariantFileFetch(
                     referenceName, startPosition, endPosition)
-            cursor = self.getFileHandle(varFileName).fetch(
-                referenceName, startPosition, endPosition)
-            for record in cursor:
+            varFile = self.getFileHandle(varFileName)
+            records = self._fetchPysamVariants(
+                varFile, referenceName, startPosition, endPosition)
+            for _, record in records:
                 yield record
 
-    def getCyvcf2Variants(self, referenceName, startPosition, endPosition):
+    def _takeCyvcf2File(self, dataUrlIndexFilePair):
         """
-        Returns an iterator over the cyvcf2 VCF records corresponding to the
-        specified query.
+        Returns a Cyvcf2VariantFile for the specified file that is not in
+        use by any other iterator, opening a new one if none are idle.
+        """
+        idleFiles = self._idleCyvcf2Files[dataUrlIndexFilePair]
+        while len(idleFiles) > 0:
+            variantFile = idleFiles.pop()
+            # Files inherited from the parent of a forked process share
+            # their file offsets with it, and are abandoned.
+            if variantFile.getProcessId() == os.getpid():
+                return variantFile
+        dataUrl, indexFile = dataUrlIndexFilePair
+        return Cyvcf2VariantFile(dataUrl, indexFile)
+
+    def _releaseCyvcf2File(self, dataUrlIndexFilePair, variantFile):
+        """
+        Returns the specified Cyvcf2VariantFile to the pool of idle files.
+        """
+        idleFiles = self._idleCyvcf2Files[dataUrlIndexFilePair]
+        if len(idleFiles) < self._maxIdleCyvcf2Files:
+            idleFiles.append(variantFile)
+        else:
+            variantFile.close()
+
+    def _getCyvcf2Records(self, referenceName, startPosition, endPosition):
+        """
+        Returns an iterator over (variantFile, record) pairs for the cyvcf2
+        VCF records corresponding to the specified query, where
+        variantFile is the Cyvcf2VariantFile that the record was read
+        from. The file is held by the iterator until it is exhausted or
+        closed, as cyvcf2 readers cannot be shared between iterators.
         """
         if referenceName in self._chromFileMap:
-            varFileName = self._chromFileMap[referenceName]
+            dataUrlIndexFilePair = self._chromFileMap[referenceName]
             referenceName, startPosition, endPosition = \
                 self.sanitizeVariantFileFetch(
                     referenceName, startPosition, endPosition)
-            cursor = self.getFileHandle(varFileName).fetch(
+            if startPosition is None or startPosition < 0:
+                startPosition = 0
+            if endPosition is None:
+                endPosition = self.vcfMax
+            variantFile = self._takeCyvcf2File(dataUrlIndexFilePair)
+            try:
+                for record in variantFile.fetch(
+                        referenceName, startPosition, endPosition):
+                    yield variantFile, record
+            finally:
+                self._releaseCyvcf2File(dataUrlIndexFilePair, variantFile)
+
+    def getCyvcf2Variants(self, referenceName, startPosition, endPosition):
+        """
+        Returns an iterator over the cyvcf2 VCF records corresponding to the
+        specified query.
+        """
+        for _, record in self._getCyvcf2Records(
+                referenceName, startPosition, endPosition):
+            yield record
+
+    def _seekPysamVariants(
+            self, varFile, referenceName, startPosition, endPosition,
+            virtualOffset):
+        """
+        Returns an iterator over (virtualOffset, pysamRecord) pairs by
+        seeking to the specified virtual offset and reading sequentially,
+        applying the same overlap rules as an indexed fetch.
+        """
+        try:
+            varFile.seek(virtualOffset)
+        except (IOError, OSError, ValueError):
+            raise exceptions.BadPageTokenException()
+        records = self.resumableIterator(varFile, varFile, virtualOffset)
+        for offset, record in records:
+            if record.contig != referenceName:
+                break
+            if endPosition is not None and record.start >= endPosition:
+                break
+            if startPosition is None or record.stop > startPosition:
+                yield offset, record
+
+    def _fetchPysamVariants(
+            self, varFile, referenceName, startPosition, endPosition):
+        """
+        Returns an iterator over (virtualOffset, pysamRecord) pairs for the
+        specified interval using the index. The offset of the first record
+        is not known.
+        """
+        return self.resumableIterator(
+            varFile, varFile.fetch(referenceName, startPosition, endPosition))
+
+    def getSeekableVariants(
+            self, referenceName, startPosition, endPosition,
+            callSetIds=None, virtualOffset=None, variantFilter=None):
+        """
+        Returns an iterator over (virtualOffset, variant) pairs, where
+        virtualOffset is the BGZF virtual file offset at which the record
+        begins, or None if it is not known. If virtualOffset is specified,
+        variants are returned starting from this offset rather than from
+        startPosition. Only BCF files can be read from an arbitrary
+        offset, as pysam buffers the lines of text VCF files; None is
+        returned for these. Records rejected by the specified
+        VariantFilter are skipped without being converted.
+        """
+        if referenceName not in self._chromFileMap:
+            return iter([])
+        if self.getVariantEngine() != VARIANT_ENGINE_PYSAM:
+            return None
+        varFile = self.getFileHandle(self._chromFileMap[referenceName])
+        # pysam 0.9.0 reports is_bcf as False for BCF files being read
+        if varFile.format != "BCF":
+            return None
+        callSetIds = self._getRequestedCallSetIds(callSetIds)
+        referenceName, startPosition, endPosition = \
+            self.sanitizeVariantFileFetch(
                 referenceName, startPosition, endPosition)
-            for record in cursor:
-                yield record
+        if virtualOffset is None:
+            records = self._fetchPysamVariants(
+                varFile, referenceName, startPosition, endPosition)
+        else:
+            records = self._seekPysamVariants(
+                varFile, referenceName, startPosition, endPosition,
+                virtualOffset)
+        if variantFilter is not None:
+            records = (
+                (offset, record) for offset, record in records
+                if variantFilter.matchesPysamRecord(record))
+        sampleIndexes, callTemplates = self._getPysamCallColumns(
+            varFile.header.samples, callSetIds)
+        return (
+            (offset, self._convertPysamRecord(
+                record, sampleIndexes, callTemplates))
+            for offset, record in records)
+
+    def _getRequestedCallSetIds(self, callSetIds):
+        """
+        Returns the list of callSetIds to include in variants for the
+        specified request value, checking that they are all in this
+        VariantSet.
+        """
+        if callSetIds is None:
+            return self._callSetIds
+        for callSetId in callSetIds:
+            if callSetId not in self._callSetIds:
+                raise exceptions.CallSetNotInVariantSetException(
+                    callSetId, self.getId())
+        return callSetIds
 
     def getVariants(self, referenceName, startPosition, endPosition,
-                    callSetIds=[]):
+                    callSetIds=[], variantFilter=None):
         """
         Returns an iterator over the specified variants. The parameters
         correspond to the attributes of a GASearchVariantsRequest object.
-        """
-        if callSetIds is None:
-            callSetIds = self._callSetIds
+        If a VariantFilter is specified, only the variants whose records
+        pass it are returned.
+        """
+        callSetIds = self._getRequestedCallSetIds(callSetIds)
+        if (referenceName in self._chromFileMap and
+                variantBlockCache.isCacheable(startPosition, endPosition)):
+            variants = self._getCachedVariants(
+                referenceName, startPosition, endPosition, callSetIds)
+            if variantFilter is not None:
+                variants = (
+                    variant for variant in variants
+                    if variantFilter.matchesVariant(variant))
         else:
-            for callSetId in callSetIds:
-                if callSetId not in self._callSetIds:
-                    raise exceptions.CallSetNotInVariantSetException(
-                        callSetId, self.getId())
-        for record in self.getPysamVariants(
-                referenceName, startPosition, endPosition):
-            yield self.convertVariant(record, callSetIds)
+            variants = self._convertVariants(
+                referenceName, startPosition, endPosition, callSetIds,
+                variantFilter)
+        for variant in variants:
+            yield variant
+
+    def _getCachedVariants(
+            self, referenceName, startPosition, endPosition, callSetIds):
+        """
+        Returns an iterator over the specified variants, read from the
+        blocks of the variantBlockCache that the interval overlaps and
+        converting the blocks that are not cached. The variants starting
+        before a block are left to the blocks preceding it, so that they
+        are returned in the same order as by an indexed fetch. The cached
+        blocks of a variant set are not used once its registry entry or
+        its data file are updated.
+        """
+        self.sanitizeVariantFileFetch(
+            referenceName, startPosition, endPosition)
+        dataUrl, _ = self._chromFileMap[referenceName]
+        try:
+            modificationTime = os.path.getmtime(dataUrl)
+        except OSError:
+            modificationTime = None
+        binSize = variantBlockCache.getBinSize()
+        keyPrefix = (
+            self.getId(), self._updated, dataUrl, modificationTime,
+            referenceName, binSize, tuple(callSetIds))
+        firstBin = max(startPosition, 0) // binSize
+        lastBin = (endPosition - 1) // binSize
+        for binIndex in range(firstBin, lastBin + 1):
+            binStart = binIndex * binSize
+            key = keyPrefix + (binIndex,)
+            block = variantBlockCache.get(key)
+            if block is None:
+                block = list(self._convertVariants(
+                    referenceName, binStart, binStart + binSize,
+                    callSetIds))
+                variantBlockCache.put(key, block)
+            for variant in block:
+                if variant.start >= endPosition:
+                    break
+                if binIndex == firstBin:
+                    if (variant.end > startPosition or
+                            variant.start >= startPosition):
+                        yield variant
+                elif variant.start >= binStart:
+                    yield variant
+
+    def _convertVariants(
+            self, referenceName, startPosition, endPosition, callSetIds,
+            variantFilter=None):
+        """
+        Returns an iterator over the variants in the specified interval,
+        reading and converting the records of the variant file with the
+        engine of this variant set. Records rejected by the specified
+        VariantFilter are skipped without being converted.
+        """
+        if self.getVariantEngine() == VARIANT_ENGINE_CYVCF2:
+            sampleIndexes = None
+            for variantFile, record in self._getCyvcf2Records(
+                    referenceName, startPosition, endPosition):
+                if (variantFilter is not None and
+                        not variantFilter.matchesCyvcf2Record(
+                            variantFile, record)):
+                    continue
+                if sampleIndexes is None:
+                    sampleIndexes, callTemplates = self._getCyvcf2CallColumns(
+                        variantFile, callSetIds)
+                yield self._convertCyvcf2Record(
+                    variantFile, record, sampleIndexes, callTemplates)
+        else:
+            sampleIndexes = None
+            for record in self.getPysamVariants(
+                    referenceName, startPosition, endPosition):
+                if (variantFilter is not None and
+                        not variantFilter.matchesPysamRecord(record)):
+                    continue
+                if sampleIndexes is None:
+                    sampleIndexes, callTemplates = self._getPysamCallColumns(
+                        record.samples, callSetIds)
+                yield self._convertPysamRecord(
+                    record, sampleIndexes, callTemplates)
 
     def getGenotypeMatrix(self, referenceName, startPosition, endPosition,
                           callSetIds=[]):
@@ -825,9 +1897,57 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
         # let's not do this once per record
         callSetNames = [str(self.getCallSet(callId).getSampleName())
                         for callId in callSetIds]
-        for record in self.getPysamVariants(
-                referenceName, startPosition, endPosition):
-            yield self.convertGenotype(record, callSetIds, callSetNames)
+        if self.getVariantEngine() == VARIANT_ENGINE_CYVCF2:
+            return self._getCyvcf2GenotypeMatrix(
+                referenceName, startPosition, endPosition, callSetNames)
+        return self._getPysamGenotypeMatrix(
+            referenceName, startPosition, endPosition, callSetNames)
+
+    def _getPysamGenotypeMatrix(
+            self, referenceName, startPosition, endPosition, callSetNames):
+        records = self.getPysamVariants(
+            referenceName, startPosition, endPosition)
+        sampleIndexes = None
+        while True:
+            batch = list(itertools.islice(records, self._genotypeBatchSize))
+            if len(batch) == 0:
+                break
+            if sampleIndexes is None:
+                columns = dict(
+                    (sampleName, index)
+                    for index, sampleName in enumerate(batch[0].samples))
+                sampleIndexes = [columns[name] for name in callSetNames]
+            block = self._getGenotypeBlock(batch, sampleIndexes)
+            for record, genotypes in zip(batch, block):
+                variant = self._convertPysamRecord(record, [], [])
+                gtmatrix = protocol.GenotypeMatrix()
+                gtmatrix.nvariants = 1
+                gtmatrix.nindividuals = len(genotypes)
+                gtmatrix.genotypes.extend(genotypes)
+                yield gtmatrix, variant, callSetNames
+
+    def _getCyvcf2GenotypeMatrix(
+            self, referenceName, startPosition, endPosition, callSetNames):
+        records = self._getCyvcf2Records(
+            referenceName, startPosition, endPosition)
+        sampleIndexes = None
+        while True:
+            batch = list(itertools.islice(records, self._genotypeBatchSize))
+            if len(batch) == 0:
+                break
+            variantFile = batch[0][0]
+            if sampleIndexes is None:
+                sampleIndexes = variantFile.getSampleIndexes(callSetNames)
+            block = variantFile.getGenotypeBlock(
+                [record for _, record in batch], sampleIndexes).tolist()
+            for (_, record), genotypes in zip(batch, block):
+                variant = self._convertCyvcf2Record(
+                    variantFile, record, [], [])
+                gtmatrix = protocol.GenotypeMatrix()
+                gtmatrix.nvariants = 1
+                gtmatrix.nindividuals = len(genotypes)
+                gtmatrix.genotypes.extend(genotypes)
+                yield gtmatrix, variant, callSetNames
 
     def getMetadataId(self, metadata):
         """
@@ -892,6 +2012,18 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
 #############################################
 
 
+class VariantEffectIndex(datamodel.BinIndex):
+    """
+    A sidecar index of the transcript effects in an annotated VCF or BCF
+    file. For each reference, it maps the effect names found in the
+    transcript effect strings, e.g. "stop_gained", to the sorted list of
+    the bins holding the start of a record with this effect. It is
+    stored next to the tabix or CSI index of the file, e.g.
+    "chr1.vcf.gz.effidx" for "chr1.vcf.gz.tbi".
+    """
+    fileSuffix = ".effidx"
+
+
 class AbstractVariantAnnotationSet(datamodel.DatamodelObject):
     """
     Class representing a variant annotation set derived from an
@@ -992,30 +2124,40 @@ class AbstractVariantAnnotationSet(datamodel.DatamodelObject):
                 effs, gaTranscriptEffect.hgvs_annotation)
             ).hexdigest()
 
-    def hashVariantAnnotation(cls, gaVariant, gaVariantAnnotation):
+    def hashVariantAnnotation(
+            cls, gaVariant, gaVariantAnnotation, transcriptEffectIds=None):
         """
-        Produces an MD5 hash of the gaVariant and gaVariantAnnotation objects
+        Produces an MD5 hash of the gaVariant and gaVariantAnnotation objects.
+        If transcriptEffectIds is specified, it is hashed in place of the
+        IDs of the transcript effects in gaVariantAnnotation.
         """
-        treffs = [treff.id for treff in gaVariantAnnotation.transcript_effects]
+        treffs = transcriptEffectIds
+        if treffs is None:
+            treffs = [
+                treff.id for treff in gaVariantAnnotation.transcript_effects]
         return hashlib.md5(
             "{}\t{}\t{}\t".format(
                 gaVariant.reference_bases, tuple(gaVariant.alternate_bases),
                 treffs)
             ).hexdigest()
 
-    def getVariantAnnotationId(self, gaVariant, gaAnnotation):
+    def getVariantAnnotationId(
+            self, gaVariant, gaAnnotation, transcriptEffectIds=None):
         """
         Produces a stringified compoundId representing a variant
         annotation.
         :param gaVariant:   protocol.Variant
         :param gaAnnotation: protocol.VariantAnnotation
+        :param transcriptEffectIds: IDs of all the transcript effects of
+            the annotation, if some were not converted into gaAnnotation
         :return:  compoundId String
         """
-        md5 = self.hashVariantAnnotation(gaVariant, gaAnnotation)
-        compoundId = datamodel.VariantAnnotationCompoundId(
-            self.getCompoundId(), gaVariant.reference_name,
-            str(gaVariant.start), md5)
-        return str(compoundId)
+        md5 = self.hashVariantAnnotation(
+            gaVariant, gaAnnotation, transcriptEffectIds)
+        formatter = self.getChildIdFormatter(
+            datamodel.VariantAnnotationCompoundId)
+        return formatter.format(
+            gaVariant.reference_name, str(gaVariant.start), md5)
 
 
 class SimulatedVariantAnnotationSet(AbstractVariantAnnotationSet):
@@ -1044,7 +2186,9 @@ class SimulatedVariantAnnotationSet(AbstractVariantAnnotationSet):
         ann = self.generateVariantAnnotation(variant, randomNumberGenerator)
         return ann
 
-    def getVariantAnnotations(self, referenceName, start, end):
+    def getVariantAnnotations(self, referenceName, start, end, effects=None):
+        # Simulated annotations are generated rather than read, so the
+        # requested effects are left for the caller to filter on.
         for variant in self._variantSet.getVariants(referenceName, start, end):
             yield variant, self.generateVariantAnnotation(variant)
 
@@ -1162,12 +2306,25 @@ class HtslibVariantAnnotationSet(AbstractVariantAnnotationSet):
                        "aminos", "codons", "existingVar", "distance",
                        "strand", "symbolSource", "hgncId",
                        "hgvsOffset")
+    # The fields, other than the effects, that the transcript effect ID
+    # is derived from.
+    TRANSCRIPT_EFFECT_ID_FIELDS = ("alternate_bases", "feature_id",
+                                   "hgvs_annotation.transcript",
+                                   "hgvs_annotation.protein")
 
     def __init__(self, variantSet, localId):
         super(HtslibVariantAnnotationSet, self).__init__(variantSet, localId)
+        self._transcriptEffectSetters = []
+        self._transcriptEffectIdSetters = []
+        self._effectsIndex = None
+        self._cdnaPosIndex = None
+        self._protPosIndex = None
+        # The VariantEffectIndex of each (dataUrl, indexFile) pair, or
+        # None if it has no usable index.
+        self._effectIndexes = {}
 
     def populateFromFile(self, varFile, annotationType):
-        self._annotationType = annotationType
+        self._setAnnotationType(annotationType)
         self._analysis = self._getAnnotationAnalysis(varFile)
         self._creationTime = self._analysis.created
         self._updatedTime = datetime.datetime.now().isoformat() + "Z"
@@ -1176,13 +2333,78 @@ class HtslibVariantAnnotationSet(AbstractVariantAnnotationSet):
         """
         Populates this VariantAnnotationSet from the specified DB row.
         """
-        self._annotationType = annotationSetRecord.annotationtype
+        self._setAnnotationType(annotationSetRecord.annotationtype)
         self._analysis = protocol.fromJson(
             annotationSetRecord.analysis, protocol.Analysis)
         self._creationTime = annotationSetRecord.created
         self._updatedTime = annotationSetRecord.updated
         self.setAttributesJson(annotationSetRecord.attributes)
 
+    def _setAnnotationType(self, annotationType):
+        """
+        Sets the type of the annotations in the VCF file, and compiles
+        the setters used to convert its transcript effects.
+        """
+        self._annotationType = annotationType
+        fields = self._getTranscriptEffectFields()
+        self._transcriptEffectSetters = []
+        self._transcriptEffectIdSetters = []
+        for index, key in enumerate(fields):
+            setter = self._getTranscriptEffectSetter(key)
+            if setter is not None:
+                self._transcriptEffectSetters.append((index, setter))
+                if key in self.TRANSCRIPT_EFFECT_ID_FIELDS:
+                    self._transcriptEffectIdSetters.append((index, setter))
+        self._effectsIndex = fields.index("effects")
+        self._cdnaPosIndex = fields.index("cdnaPos")
+        self._protPosIndex = fields.index("protPos")
+
+    def _getTranscriptEffectFields(self):
+        """
+        Returns the names of the fields in the transcript effect strings
+        of this set's annotation type.
+        """
+        if self._annotationType == ANNOTATIONS_SNPEFF:
+            return self.SNPEFF_FIELDS
+        elif self._annotationType == ANNOTATIONS_VEP_V82:
+            return self.VEP_FIELDS
+        else:
+            return self.CSQ_FIELDS
+
+    def _getTranscriptEffectSetter(self, key):
+        """
+        Returns a function setting the value of the transcript effect field
+        with the specified name in a TranscriptEffect. Fields that name a
+        scalar field of the TranscriptEffect, or of one of its messages,
+        are assigned directly; the non-empty values of the other fields
+        are added to its attributes, unless they are excluded, in which
+        case None is returned.
+        """
+        path = key.split(".")
+        descriptor = protocol.TranscriptEffect.DESCRIPTOR
+        field = descriptor.fields_by_name.get(path[0])
+        if (len(path) == 2 and field is not None and
+                field.message_type is not None):
+            field = field.message_type.fields_by_name.get(path[1])
+        elif len(path) != 1:
+            field = None
+        if (field is not None and field.message_type is None and
+                field.label != field.LABEL_REPEATED):
+            name = str(path[-1])
+            if len(path) == 1:
+                return lambda effect, value: setattr(effect, name, value)
+            messageName = str(path[0])
+            return lambda effect, value: setattr(
+                getattr(effect, messageName), name, value)
+        if key in self.EXCLUDED_FIELDS:
+            return None
+
+        def setAttribute(effect, value):
+            if value:
+                protocol.setAttribute(
+                    effect.attributes.attr[key].values, value)
+        return setAttribute
+
     def getAnnotationType(self):
         """
         Returns the type of variant annotations, allowing us to determine
@@ -1242,19 +2464,141 @@ class HtslibVariantAnnotationSet(AbstractVariantAnnotationSet):
             self._compoundId, "analysis"))
         return analysis
 
-    def getVariantAnnotations(self, referenceName, startPosition, endPosition):
+    def getVariantAnnotations(
+            self, referenceName, startPosition, endPosition, effects=None):
         """
         Generator for iterating through variant annotations in this
-        variant annotation set.
+        variant annotation set. If effects are specified, only the
+        annotations with a transcript effect having one of these
+        effects are returned, holding only these transcript effects.
+        The raw transcript effect strings are tested before conversion,
+        so the other records and transcript effects are never converted.
         :param referenceName:
         :param startPosition:
         :param endPosition:
+        :param effects: list of protocol.OntologyTerm
         :return: generator of protocol.VariantAnnotation
         """
-        variantIter = self._variantSet.getPysamVariants(
-            referenceName, startPosition, endPosition)
+        effectNames = None
+        variantIter = None
+        if effects:
+            effectNames = self._getEffectNames(effects)
+            variantIter = self._getIndexedPysamVariants(
+                referenceName, startPosition, endPosition, effectNames)
+        if variantIter is None:
+            variantIter = self._variantSet.getPysamVariants(
+                referenceName, startPosition, endPosition)
         for record in variantIter:
-            yield self.convertVariantAnnotation(record)
+            pair = self.convertVariantAnnotation(record, effectNames)
+            if pair is not None:
+                yield pair
+
+    def _getEffectIndex(self, referenceName):
+        """
+        Returns the VariantEffectIndex of the file holding the specified
+        reference, or None if there is no usable index.
+        """
+        referenceMap = self._variantSet.getReferenceToDataUrlIndexMap()
+        if referenceName not in referenceMap:
+            return None
+        dataUrlIndexFilePair = referenceMap[referenceName]
+        if dataUrlIndexFilePair not in self._effectIndexes:
+            self._effectIndexes[dataUrlIndexFilePair] = \
+                VariantEffectIndex.load(dataUrlIndexFilePair[1])
+        return self._effectIndexes[dataUrlIndexFilePair]
+
+    def _getIndexedPysamVariants(
+            self, referenceName, startPosition, endPosition, effectNames):
+        """
+        Returns an iterator over the pysam VCF records in the specified
+        interval that may have one of the specified effect names, reading
+        only the regions that the effect index of the file holds these
+        effects in. Returns None if there is no usable effect index.
+        """
+        effectIndex = self._getEffectIndex(referenceName)
+        if effectIndex is None:
+            return None
+        if endPosition is None:
+            endPosition = datamodel.PysamDatamodelMixin.vcfMax
+        regions = effectIndex.getRegions(
+            referenceName, effectNames, startPosition, endPosition)
+        return self._getRegionPysamVariants(
+            referenceName, startPosition, regions)
+
+    def _getRegionPysamVariants(self, referenceName, startPosition, regions):
+        for regionStart, regionEnd in regions:
+            for record in self._variantSet.getPysamVariants(
+                    referenceName, regionStart, regionEnd):
+                # Records beginning before the region were returned with
+                # the previous region, unless they overlap the start of
+                # the search.
+                if record.start >= regionStart or regionStart == startPosition:
+                    yield record
+
+    def buildEffectIndex(
+            self, dataUrlIndexFilePair,
+            binSize=VariantEffectIndex.defaultBinSize):
+        """
+        Returns a new VariantEffectIndex of the records in the specified
+        file of the variant set.
+        """
+        effectIndex = VariantEffectIndex(binSize)
+        referenceMap = self._variantSet.getReferenceToDataUrlIndexMap()
+        for referenceName, pair in referenceMap.items():
+            if pair != dataUrlIndexFilePair:
+                continue
+            for record in self._variantSet.getPysamVariants(
+                    referenceName, 0, None):
+                annotations = (
+                    record.info.get(b'ANN') or record.info.get(b'CSQ'))
+                effectNames = set()
+                for ann in annotations or ():
+                    effectNames.update(self._splitEffectNames(ann))
+                effectIndex.addRecord(referenceName, record.start, effectNames)
+        return effectIndex
+
+    def writeEffectIndexes(self, binSize=VariantEffectIndex.defaultBinSize):
+        """
+        Builds the VariantEffectIndex of each file in the variant set, and
+        writes it next to the index of the file.
+        """
+        for dataUrlIndexFilePair in self._variantSet.getDataUrlIndexPairs():
+            effectIndex = self.buildEffectIndex(dataUrlIndexFilePair, binSize)
+            effectIndex.write(dataUrlIndexFilePair[1])
+            self._effectIndexes[dataUrlIndexFilePair] = effectIndex
+
+    def _getEffectNames(self, effects):
+        """
+        Returns the set of the names of the specified sequence ontology
+        terms as they appear in the transcript effect strings. Terms are
+        matched on their IDs, and terms without an ID match nothing.
+        """
+        effectNames = set()
+        for effect in effects:
+            if effect.term_id != "":
+                effectNames.update(self._ontology.getTermNames(effect.term_id))
+        return effectNames
+
+    def _matchesEffectNames(self, annStr, effectNames):
+        """
+        Returns True if the transcript effect string has one of the
+        specified effect names.
+        """
+        # Most strings have none of the names, so reject them with a
+        # substring search before splitting them.
+        if not any(name in annStr for name in effectNames):
+            return False
+        return not effectNames.isdisjoint(self._splitEffectNames(annStr))
+
+    def _splitEffectNames(self, annStr):
+        """
+        Returns the list of the effect names in the transcript effect
+        string.
+        """
+        values = annStr.split("|")
+        if self._effectsIndex >= len(values):
+            return []
+        return values[self._effectsIndex].split("&")
 
     def convertLocation(self, pos):
         """
@@ -1369,56 +2713,96 @@ class HtslibVariantAnnotationSet(AbstractVariantAnnotationSet):
         :return: effect protocol.TranscriptEffect()
         """
         effect = self._createGaTranscriptEffect()
-        effect.hgvs_annotation.CopyFrom(protocol.HGVSAnnotation())
-        annDict = dict()
-        if self._annotationType == ANNOTATIONS_SNPEFF:
-            annDict = dict(zip(self. SNPEFF_FIELDS, annStr.split("|")))
-        elif self._annotationType == ANNOTATIONS_VEP_V82:
-            annDict = dict(zip(self.VEP_FIELDS, annStr.split("|")))
-        else:
-            annDict = dict(zip(self.CSQ_FIELDS, annStr.split("|")))
-        annDict["hgvs_annotation.genomic"] = hgvsG if hgvsG else u''
-        for key, val in annDict.items():
-            try:
-                protocol.deepSetAttr(effect, key, val)
-            except AttributeError:
-                if val and key not in self.EXCLUDED_FIELDS:
-                    protocol.setAttribute(
-                        effect.attributes.attr[key].values, val)
-        effect.effects.extend(self.convertSeqOntology(annDict.get('effects')))
+        effect.hgvs_annotation.genomic = hgvsG if hgvsG else u''
+        values = annStr.split("|")
+        numValues = len(values)
+        for index, setter in self._transcriptEffectSetters:
+            if index >= numValues:
+                break
+            setter(effect, values[index])
+
+        def getValue(index):
+            return values[index] if index < numValues else None
+        effect.effects.extend(
+            self.convertSeqOntology(getValue(self._effectsIndex)))
         self.addLocations(
-            effect, annDict.get('protPos'), annDict.get('cdnaPos'))
+            effect, getValue(self._protPosIndex),
+            getValue(self._cdnaPosIndex))
         effect.id = self.getTranscriptEffectId(effect)
         return effect
 
+    def getTranscriptEffectIdFromString(self, annStr, hgvsG):
+        """
+        Returns the ID of the transcript effect in the specified ANN
+        string, setting only the fields it is derived from. The ID is
+        returned as unicode, as held by the id field of a converted
+        transcript effect, so that it hashes into the annotation ID in
+        the same way.
+        :param annStr: String
+        :param hgvsG: String
+        :return: String
+        """
+        effect = self._createGaTranscriptEffect()
+        effect.hgvs_annotation.genomic = hgvsG if hgvsG else u''
+        values = annStr.split("|")
+        numValues = len(values)
+        for index, setter in self._transcriptEffectIdSetters:
+            if index >= numValues:
+                break
+            setter(effect, values[index])
+        effect.effects.extend(self.convertSeqOntology(
+            values[self._effectsIndex]
+            if self._effectsIndex < numValues else None))
+        return unicode(self.getTranscriptEffectId(effect))
+
     def convertSeqOntology(self, seqOntStr):
         """
-        Splits a string of sequence ontology effects and creates
-        an ontology term record for each, which are built into
-        an array of return soTerms.
+        Splits a string of sequence ontology effects and returns the
+        ontology term record for each, which are built into
+        an array of return soTerms. The terms are shared with the
+        ontology, and must be copied rather than modified.
         :param seqOntStr:
         :return: [protocol.OntologyTerm]
         """
         return [
-            self._ontology.getGaTermByName(soName)
+            self._ontology.getSharedGaTermByName(soName)
             for soName in seqOntStr.split('&')]
 
-    def convertVariantAnnotation(self, record):
+    def convertVariantAnnotation(self, record, effectNames=None):
         """
         Converts the specfied pysam variant record into a GA4GH variant
         annotation object using the specified function to convert the
-        transcripts.
+        transcripts. If a set of effectNames is specified, only the
+        transcript effects having one of these effects are converted,
+        and None is returned if there are none.
         """
+        annotations = record.info.get(b'ANN') or record.info.get(b'CSQ')
+        matches = None
+        if effectNames is not None:
+            matches = [
+                self._matchesEffectNames(ann, effectNames)
+                for ann in annotations or ()]
+            if not any(matches):
+                return None
         variant = self._variantSet.convertVariant(record, [])
         annotation = self._createGaVariantAnnotation()
         annotation.variant_id = variant.id
         gDots = record.info.get(b'HGVS.g')
         # Convert annotations from INFO field into TranscriptEffect
         transcriptEffects = []
-        annotations = record.info.get(b'ANN') or record.info.get(b'CSQ')
+        # The annotation ID is derived from all of its transcript effects,
+        # so we still need the IDs of those we do not convert.
+        transcriptEffectIds = []
         for i, ann in enumerate(annotations):
             hgvsG = gDots[i % len(variant.alternate_bases)] if gDots else None
-            transcriptEffects.append(self.convertTranscriptEffect(ann, hgvsG))
+            if matches is None or matches[i]:
+                effect = self.convertTranscriptEffect(ann, hgvsG)
+                transcriptEffects.append(effect)
+                transcriptEffectIds.append(effect.id)
+            else:
+                transcriptEffectIds.append(
+                    self.getTranscriptEffectIdFromString(ann, hgvsG))
         annotation.transcript_effects.extend(transcriptEffects)
-        annotation.id = self.getVariantAnnotationId(variant, annotation)
+        annotation.id = self.getVariantAnnotationId(
+            variant, annotation, transcriptEffectIds)
         return variant, annotation
@@ -180,6 +180,17 @@ class BadFeatureSetSearchRequestRegularExpression(BadRequestException):
     httpStatus = 400
 
 
+class BadVariantFilterException(BadRequestException):
+    def __init__(self, predicate):
+        self.message = "Malformed variant filter '{}'".format(predicate)
+
+
+class BadReadSamplerException(BadRequestException):
+    def __init__(self, parameter):
+        self.message = "Invalid read sampling parameter '{}'".format(
+            parameter)
+
+
 class DatamodelValidationException(BadRequestException):
     """
     Some bad data was passed to us by the client that made no sense
@@ -561,6 +572,21 @@ class FileOpenFailedException(DataException):
         self.message = "Failed to open file '{}'".format(filename)
 
 
+class FileHandleClosedException(DataException):
+
+    def __init__(self):
+        self.message = (
+            "The file handle of a suspended iteration has been closed")
+
+
+class CramReferenceNotFoundException(DataException):
+
+    def __init__(self, dataUrl):
+        self.message = (
+            "CRAM file '{}' must belong to a reference set read from a "
+            "FASTA file".format(dataUrl))
+
+
 class EmptyDirException(DataException):
 
     def __init__(self, dirname, filetype):
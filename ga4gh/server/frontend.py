@@ -20,6 +20,7 @@ import werkzeug
 import oic
 import oic.oauth2
 import oic.oic.message as message
+import pysam
 import requests
 import logging
 from logging import StreamHandler
@@ -28,14 +29,18 @@ from werkzeug.contrib.cache import FileSystemCache
 import ga4gh.server
 import ga4gh.server.backend as backend
 import ga4gh.server.datamodel as datamodel
+import ga4gh.server.datamodel.reads as reads
+import ga4gh.server.datamodel.variants as variants
 import ga4gh.server.exceptions as exceptions
 import ga4gh.server.datarepo as datarepo
 import ga4gh.server.auth as auth
 import ga4gh.server.network as network
+import ga4gh.server.response_builder as response_builder
 
 import ga4gh.schemas.protocol as protocol
 
 SEARCH_ENDPOINT_METHODS = ['POST', 'OPTIONS']
+NDJSON_MIMETYPE = "application/x-ndjson"
 SECRET_KEY_LENGTH = 24
 
 app = flask.Flask(__name__)
@@ -275,6 +280,16 @@ def _configure_backend(app):
     theBackend.setRequestValidation(app.config["REQUEST_VALIDATION"])
     theBackend.setDefaultPageSize(app.config["DEFAULT_PAGE_SIZE"])
     theBackend.setMaxResponseLength(app.config["MAX_RESPONSE_LENGTH"])
+    theBackend.setSeekablePageTokens(app.config["SEEKABLE_PAGE_TOKENS"])
+    theBackend.setCursorCacheMaxSize(app.config["CURSOR_CACHE_MAX_SIZE"])
+    theBackend.setCursorCacheTimeToLive(
+        app.config["CURSOR_CACHE_TIME_TO_LIVE"])
+    theBackend.setPrefetchWorkers(app.config["PREFETCH_WORKERS"])
+    theBackend.setPrefetchMaxBytes(app.config["PREFETCH_CACHE_MAX_BYTES"])
+    theBackend.setVariantConversionMinShardSize(
+        app.config["VARIANT_CONVERSION_MIN_SHARD_SIZE"])
+    theBackend.setVariantConversionWorkers(
+        app.config["VARIANT_CONVERSION_WORKERS"])
     return theBackend
 
 
@@ -297,6 +312,23 @@ def configure(configFile=None, baseConfig="ProductionConfig",
     # Setup file handle cache max size
     datamodel.fileHandleCache.setMaxCacheSize(
         app.config["FILE_HANDLE_CACHE_MAX_SIZE"])
+    if app.config["HTSLIB_DECOMPRESSION_THREADS"] >= 2:
+        for fileClass in [pysam.AlignmentFile, pysam.VariantFile]:
+            if not datamodel.acceptsThreadsArgument(fileClass):
+                raise exceptions.ConfigurationException(
+                    "HTSLIB_DECOMPRESSION_THREADS requires pysam 0.15.0 "
+                    "or later, whose files accept the threads argument")
+    datamodel.fileHandleCache.setDecompressionThreads(
+        app.config["HTSLIB_DECOMPRESSION_THREADS"],
+        app.config["HTSLIB_DECOMPRESSION_MAX_THREADS"])
+    reads.configureCramReferencePath()
+    reads.cramSliceCache.setCacheDir(app.config["CRAM_SLICE_CACHE_DIR"])
+    reads.cramSliceCache.setBinSize(app.config["CRAM_SLICE_CACHE_BIN_SIZE"])
+    variants.setDefaultVariantEngine(app.config["VARIANT_ENGINE"])
+    variants.variantBlockCache.setBinSize(
+        app.config["VARIANT_BLOCK_CACHE_BIN_SIZE"])
+    variants.variantBlockCache.setMaxBytes(
+        app.config["VARIANT_BLOCK_CACHE_MAX_BYTES"])
     # Setup CORS
     try:
         cors.CORS(app, allow_headers='Content-Type')
@@ -369,12 +401,54 @@ def configure(configFile=None, baseConfig="ProductionConfig",
             app.oidcClient.store_registration_info(response)
 
 
-def chooseReturnMimetype(request):
+def getVariantFilter(request):
+    """
+    Returns the VariantFilter defined by the "info" and "filter" query
+    parameters of the specified flask request, or None if there are none.
+    Each "info" parameter is an INFO field predicate, and "filter=PASS"
+    selects the variants that passed all filters.
+    """
+    infoPredicates = request.args.getlist("info")
+    filterValue = request.args.get("filter")
+    if len(infoPredicates) == 0 and filterValue is None:
+        return None
+    if filterValue not in (None, "PASS"):
+        raise exceptions.BadVariantFilterException("filter=" + filterValue)
+    return variants.VariantFilter(infoPredicates, filterValue == "PASS")
+
+
+def getReadSampler(request):
+    """
+    Returns the ReadSampler defined by the "maxDepth" and "sampleFraction"
+    query parameters of the specified flask request, or None if there are
+    none. At most maxDepth reads beginning at each position are returned,
+    and sampleFraction selects this fraction of the fragments by the hash
+    of their names.
+    """
+    maxDepth = request.args.get("maxDepth")
+    fraction = request.args.get("sampleFraction")
+    if maxDepth is None and fraction is None:
+        return None
+    if maxDepth is not None:
+        try:
+            maxDepth = int(maxDepth)
+        except ValueError:
+            raise exceptions.BadReadSamplerException("maxDepth=" + maxDepth)
+    if fraction is not None:
+        try:
+            fraction = float(fraction)
+        except ValueError:
+            raise exceptions.BadReadSamplerException(
+                "sampleFraction=" + fraction)
+    return reads.ReadSampler(maxDepth, fraction)
+
+
+def chooseReturnMimetype(request, mimetypes=protocol.MIMETYPES):
     mimetype = None
     if hasattr(request, 'accept_mimetypes'):
-        mimetype = request.accept_mimetypes.best_match(protocol.MIMETYPES)
+        mimetype = request.accept_mimetypes.best_match(mimetypes)
     if mimetype is None:
-        mimetype = protocol.MIMETYPES[0]
+        mimetype = mimetypes[0]
     return mimetype
 
 
@@ -386,17 +460,27 @@ def getFlaskResponse(responseString, httpStatus=200,
     return flask.Response(responseString, status=httpStatus, mimetype=mimetype)
 
 
-def handleHttpPost(request, endpoint):
+def handleHttpPost(request, endpoint, streamEndpoint=None,
+                   extraMimetypes=[]):
     """
     Handles the specified HTTP POST request, which maps to the specified
-    protocol handler endpoint and protocol request class.
+    protocol handler endpoint and protocol request class. If a
+    streamEndpoint is specified and the client accepts newline delimited
+    JSON, the results are streamed from this endpoint instead. The
+    endpoint may also return any of the specified extra mimetypes.
     """
     if request.mimetype and request.mimetype not in protocol.MIMETYPES:
         raise exceptions.UnsupportedMediaTypeException()
-    return_mimetype = chooseReturnMimetype(request)
+    mimetypes = protocol.MIMETYPES + extraMimetypes
+    if streamEndpoint is not None:
+        mimetypes = mimetypes + [NDJSON_MIMETYPE]
+    return_mimetype = chooseReturnMimetype(request, mimetypes)
     request = request.get_data()
     if request == '' or request is None:
         request = '{}'
+    if return_mimetype == NDJSON_MIMETYPE:
+        return flask.Response(
+            streamEndpoint(request), mimetype=return_mimetype)
     responseStr = endpoint(request, return_mimetype=return_mimetype)
     return getFlaskResponse(responseStr, mimetype=return_mimetype)
 
@@ -531,13 +615,15 @@ def handleFlaskListRequest(id_, flaskRequest, endpoint):
     return handleList(endpoint, flaskRequest)
 
 
-def handleFlaskPostRequest(flaskRequest, endpoint):
+def handleFlaskPostRequest(flaskRequest, endpoint, streamEndpoint=None,
+                           extraMimetypes=[]):
     """
     Handles the specified flask request for one of the POST URLS
     Invokes the specified endpoint to generate a response.
     """
     if flaskRequest.method == "POST":
-        return handleHttpPost(flaskRequest, endpoint)
+        return handleHttpPost(
+            flaskRequest, endpoint, streamEndpoint, extraMimetypes)
     elif flaskRequest.method == "OPTIONS":
         return handleHttpOptions()
     else:
@@ -684,8 +770,13 @@ def searchReadGroupSets():
 
 @DisplayedRoute('/reads/search', postMethod=True)
 def searchReads():
+    readSampler = getReadSampler(flask.request)
     return handleFlaskPostRequest(
-        flask.request, app.backend.runSearchReads)
+        flask.request,
+        functools.partial(
+            app.backend.runSearchReads, readSampler=readSampler),
+        functools.partial(
+            app.backend.runSearchReadsStream, readSampler=readSampler))
 
 
 @DisplayedRoute('/referencesets/search', postMethod=True)
@@ -708,14 +799,20 @@ def searchVariantSets():
 
 @DisplayedRoute('/variants/search', postMethod=True)
 def searchVariants():
+    variantFilter = getVariantFilter(flask.request)
     return handleFlaskPostRequest(
-        flask.request, app.backend.runSearchVariants)
+        flask.request,
+        functools.partial(
+            app.backend.runSearchVariants, variantFilter=variantFilter),
+        functools.partial(
+            app.backend.runSearchVariantsStream, variantFilter=variantFilter))
 
 
 @DisplayedRoute('/genotypes/search', postMethod=True)
 def searchGenotypes():
     return handleFlaskPostRequest(
-        flask.request, app.backend.runSearchGenotypes)
+        flask.request, app.backend.runSearchGenotypes,
+        extraMimetypes=[response_builder.PACKED_GENOTYPES_MIMETYPE])
 
 
 @DisplayedRoute('/variantannotationsets/search', postMethod=True)
@@ -762,7 +859,8 @@ def searchFeatureSets():
 @requires_auth
 def searchFeatures():
     return handleFlaskPostRequest(
-        flask.request, app.backend.runSearchFeatures)
+        flask.request, app.backend.runSearchFeatures,
+        app.backend.runSearchFeaturesStream)
 
 
 @DisplayedRoute('/continuoussets/search', postMethod=True)
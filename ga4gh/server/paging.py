@@ -6,9 +6,22 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-
+import collections
+import logging
+import multiprocessing
+import Queue
+import threading
+import time
+import traceback
+import uuid
+
+import ga4gh.server.datamodel as datamodel
 import ga4gh.server.exceptions as exceptions
 
+import ga4gh.schemas.protocol as protocol
+
+_logger = logging.getLogger(__name__)
+
 
 def _parsePageToken(pageToken, numValues):
     """
@@ -30,6 +43,23 @@ def _parsePageToken(pageToken, numValues):
     return values
 
 
+def _parseIntervalPageToken(pageToken):
+    """
+    Parses the specified interval pageToken and returns a (searchAnchor,
+    objectsToSkip, virtualOffset) tuple. Interval page tokens consist of
+    a search anchor and a number of objects to skip, optionally followed
+    by the BGZF virtual file offset of the next object. If no virtual
+    offset is present, None is returned in its place.
+    """
+    numValues = 2
+    if pageToken.count(":") == 2:
+        numValues = 3
+    values = _parsePageToken(pageToken, numValues)
+    if len(values) == 2:
+        values.append(None)
+    return tuple(values)
+
+
 def _parseIntegerArgument(args, key, defaultValue):
     """
     Attempts to parse the specified key in the specified argument
@@ -57,12 +87,15 @@ class IntervalIterator(object):
     us to pick up the iteration at any point, and is None for the last
     value in the iterator.
     """
-    def __init__(self, request, parentContainer):
+    def __init__(self, request, parentContainer, seekablePageTokens=False):
         self._request = request
         self._parentContainer = parentContainer
+        self._seekablePageTokens = seekablePageTokens
         self._searchIterator = None
         self._currentObject = None
         self._nextObject = None
+        self._nextObjectOffset = None
+        self._objectOffset = None
         self._searchAnchor = None
         self._distanceFromAnchor = None
         if not request.page_token:
@@ -70,9 +103,9 @@ class IntervalIterator(object):
         else:
             # Set the search start point and the number of records to skip from
             # the page token.
-            searchAnchor, objectsToSkip = _parsePageToken(
-                request.page_token, 2)
-            self._pickUpIteration(searchAnchor, objectsToSkip)
+            searchAnchor, objectsToSkip, virtualOffset = \
+                _parseIntervalPageToken(request.page_token)
+            self._pickUpIteration(searchAnchor, objectsToSkip, virtualOffset)
 
     def _extractProtocolObject(self, obj):
         """
@@ -80,26 +113,87 @@ class IntervalIterator(object):
         """
         return obj
 
+    def _seekableSearch(self, start, end, virtualOffset=None):
+        """
+        Returns an iterator over (virtualOffset, object) pairs, where
+        virtualOffset is the BGZF virtual file offset at which the record
+        for the object begins, or None if this is not known. If
+        virtualOffset is specified, iteration resumes directly from that
+        offset rather than from the start of the search interval. Returns
+        None if the parent container cannot resume iteration from a file
+        offset.
+        """
+        return None
+
+    def _startSearch(self, start, end, virtualOffset=None):
+        """
+        Returns True and starts a new search iterator over the specified
+        interval if possible. When a virtualOffset is specified, the
+        search is resumed from this offset only if this is supported;
+        otherwise False is returned and the iterator is left unchanged.
+        """
+        searchIterator = None
+        if self._seekablePageTokens:
+            searchIterator = self._seekableSearch(start, end, virtualOffset)
+        if searchIterator is None:
+            if virtualOffset is not None:
+                return False
+            searchIterator = (
+                (None, obj) for obj in self._search(start, end))
+        self._searchIterator = searchIterator
+        return True
+
+    def _readObject(self):
+        """
+        Returns the next object from the search iterator, recording
+        the virtual offset of its record. Raises StopIteration if the
+        search iterator is exhausted.
+        """
+        self._objectOffset, obj = next(self._searchIterator)
+        return obj
+
+    def _readObjectOrNone(self):
+        """
+        Returns the next object from the search iterator, or None if
+        the search iterator is exhausted.
+        """
+        try:
+            return self._readObject()
+        except StopIteration:
+            self._objectOffset = None
+            return None
+
+    def _readNextObject(self):
+        """
+        Reads the lookahead object from the search iterator.
+        """
+        self._nextObject = self._readObjectOrNone()
+        self._nextObjectOffset = self._objectOffset
+
+    def _getSearchEnd(self):
+        return self._request.end if self._request.end != 0 else None
+
     def _initialiseIteration(self):
         """
         Starts a new iteration.
         """
-        self._searchIterator = self._search(
-            self._request.start,
-            self._request.end if self._request.end != 0 else None)
-        self._currentObject = next(self._searchIterator, None)
+        self._startSearch(self._request.start, self._getSearchEnd())
+        self._currentObject = self._readObjectOrNone()
         if self._currentObject is not None:
-            self._nextObject = next(self._searchIterator, None)
+            self._readNextObject()
             self._searchAnchor = self._request.start
             self._distanceFromAnchor = 0
             firstObjectStart = self._getStart(self._currentObject)
             if firstObjectStart > self._request.start:
                 self._searchAnchor = firstObjectStart
 
-    def _pickUpIteration(self, searchAnchor, objectsToSkip):
+    def _pickUpIteration(self, searchAnchor, objectsToSkip,
+                         virtualOffset=None):
         """
-        Picks up iteration from a previously provided page token. There are two
-        different phases here:
+        Picks up iteration from a previously provided page token. If
+        the page token carries the virtual offset of the next object and
+        the parent container supports it, we seek directly to this
+        object. Otherwise, there are two different phases here:
         1) We are iterating over the initial set of intervals in which start
         is < the search start coorindate.
         2) We are iterating over the remaining intervals in which start >= to
@@ -107,29 +201,60 @@ class IntervalIterator(object):
         """
         self._searchAnchor = searchAnchor
         self._distanceFromAnchor = objectsToSkip
-        self._searchIterator = self._search(
-            searchAnchor,
-            self._request.end if self._request.end != 0 else None)
-        obj = next(self._searchIterator)
+        if virtualOffset is not None and self._seekToObject(
+                searchAnchor, virtualOffset):
+            return
+        self._startSearch(searchAnchor, self._getSearchEnd())
+        obj = self._readObject()
         if searchAnchor == self._request.start:
             # This is the initial set of intervals, we just skip forward
             # objectsToSkip positions
             for _ in range(objectsToSkip):
-                obj = next(self._searchIterator)
+                obj = self._readObject()
         else:
             # Now, we are past this initial set of intervals.
             # First, we need to skip forward over the intervals where
             # start < searchAnchor, as we've seen these already.
             while self._getStart(obj) < searchAnchor:
-                obj = next(self._searchIterator)
+                obj = self._readObject()
             # Now, we skip over objectsToSkip objects such that
             # start == searchAnchor
             for _ in range(objectsToSkip):
                 if self._getStart(obj) != searchAnchor:
                     raise exceptions.BadPageTokenException
-                obj = next(self._searchIterator)
+                obj = self._readObject()
         self._currentObject = obj
-        self._nextObject = next(self._searchIterator, None)
+        self._readNextObject()
+
+    def _seekToObject(self, searchAnchor, virtualOffset):
+        """
+        Attempts to resume iteration at the object beginning at the
+        specified virtual offset. Returns False if this is not possible,
+        if no record can be read at this offset, or if the object found
+        there is inconsistent with the search anchor, in which case
+        iteration must be picked up by skipping from the search anchor
+        instead.
+        """
+        if virtualOffset < 0 or not self._startSearch(
+                self._request.start, self._getSearchEnd(), virtualOffset):
+            return False
+        try:
+            obj = self._readObjectOrNone()
+        except (IOError, OSError, ValueError):
+            # Offsets are supplied by clients, and an offset that does
+            # not fall on a record boundary makes htslib fail to decode
+            # the first record.
+            return False
+        if obj is None:
+            return False
+        start = self._getStart(obj)
+        if start > searchAnchor or (
+                searchAnchor != self._request.start and
+                start != searchAnchor):
+            return False
+        self._currentObject = obj
+        self._readNextObject()
+        return True
 
     def next(self):
         """
@@ -149,9 +274,12 @@ class IntervalIterator(object):
                 self._distanceFromAnchor += 1
             nextPageToken = "{}:{}".format(
                 self._searchAnchor, self._distanceFromAnchor)
+            if (self._seekablePageTokens and
+                    self._nextObjectOffset is not None):
+                nextPageToken += ":{}".format(self._nextObjectOffset)
         ret = self._extractProtocolObject(self._currentObject), nextPageToken
         self._currentObject = self._nextObject
-        self._nextObject = next(self._searchIterator, None)
+        self._readNextObject()
         return ret
 
     def __iter__(self):
@@ -160,15 +288,28 @@ class IntervalIterator(object):
 
 class ReadsIntervalIterator(IntervalIterator):
     """
-    An interval iterator for reads
+    An interval iterator for reads. If a ReadSampler is specified, only
+    the reads it selects are returned, and page tokens count the selected
+    reads. Sampled searches do not embed virtual offsets in their page
+    tokens, as the reads selected after an offset depend on the reads
+    before it.
     """
-    def __init__(self, request, parentContainer, reference):
+    def __init__(self, request, parentContainer, reference,
+                 seekablePageTokens=False, readSampler=None):
         self._reference = reference
-        super(ReadsIntervalIterator, self).__init__(request, parentContainer)
+        self._readSampler = readSampler
+        super(ReadsIntervalIterator, self).__init__(
+            request, parentContainer, seekablePageTokens)
 
     def _search(self, start, end):
         return self._parentContainer.getReadAlignments(
-            self._reference, start, end)
+            self._reference, start, end, self._readSampler)
+
+    def _seekableSearch(self, start, end, virtualOffset=None):
+        if self._readSampler is not None:
+            return None
+        return self._parentContainer.getSeekableReadAlignments(
+            self._reference, start, end, virtualOffset)
 
     @classmethod
     def _getStart(cls, readAlignment):
@@ -188,12 +329,38 @@ class ReadsIntervalIterator(IntervalIterator):
 
 class VariantsIntervalIterator(IntervalIterator):
     """
-    An interval iterator for variants
+    An interval iterator for variants. If a VariantFilter is specified,
+    only the variants passing it are returned, and page tokens count
+    the filtered variants.
     """
+    def __init__(self, request, parentContainer, seekablePageTokens=False,
+                 conversionPool=None, variantFilter=None):
+        self._conversionPool = conversionPool
+        self._variantFilter = variantFilter
+        super(VariantsIntervalIterator, self).__init__(
+            request, parentContainer, seekablePageTokens)
+
     def _search(self, start, end):
+        if self._conversionPool is not None:
+            numVariants = None
+            if self._request.page_size > 0:
+                # The variants of the page, the one following it, and
+                # those skipped to resume from a page token.
+                numVariants = (
+                    self._request.page_size + 1 +
+                    (self._distanceFromAnchor or 0))
+            return self._conversionPool.getVariants(
+                self._parentContainer, self._request.reference_name,
+                start, end, self._request.call_set_ids, self._variantFilter,
+                numVariants)
         return self._parentContainer.getVariants(
             self._request.reference_name, start, end,
-            self._request.call_set_ids)
+            self._request.call_set_ids, self._variantFilter)
+
+    def _seekableSearch(self, start, end, virtualOffset=None):
+        return self._parentContainer.getSeekableVariants(
+            self._request.reference_name, start, end,
+            self._request.call_set_ids, virtualOffset, self._variantFilter)
 
     @classmethod
     def _getStart(cls, variant):
@@ -226,20 +393,25 @@ class GenotypesIntervalIterator(IntervalIterator):
 
 class VariantAnnotationsIntervalIterator(IntervalIterator):
     """
-    An interval iterator for annotations
+    An interval iterator for annotations. The requested effects are
+    passed to the parent container, which may skip the annotations
+    without them before conversion, in which case page tokens count
+    the matching annotations.
     """
     def __init__(self, request, parentContainer):
-        super(VariantAnnotationsIntervalIterator, self).__init__(
-            request, parentContainer)
+        # The effects are set first, as the search is started by the
+        # superclass.
         # TODO do input validation somewhere more sensible
-        if self._request.effects is None:
+        if request.effects is None:
             self._effects = []
         else:
-            self._effects = self._request.effects
+            self._effects = request.effects
+        super(VariantAnnotationsIntervalIterator, self).__init__(
+            request, parentContainer)
 
     def _search(self, start, end):
         return self._parentContainer.getVariantAnnotations(
-            self._request.reference_name, start, end)
+            self._request.reference_name, start, end, self._effects)
 
     def _extractProtocolObject(self, pair):
         variant, annotation = pair
@@ -493,3 +665,546 @@ class PeerIterator(SequenceIterator):
 
     def _prepare(self, obj):
         return obj.toProtocolElement()
+
+
+class CursorCache(object):
+    """
+    A bounded cache of the live iterators for in-flight searches. When
+    a page of results is returned, the iterator that produced it is
+    stored along with its lookahead object under a new cursor, and the
+    client is given a continuation token identifying the cursor and
+    carrying the stateless page token for the same point. A request for
+    the next page then picks up the stored iterator directly. Cursors are
+    single use, and are evicted after timeToLive seconds or when the
+    cache grows beyond maxSize entries, in which case the stateless page
+    token is used to resume the search as usual.
+    """
+    separator = "@"
+
+    def __init__(self, maxSize=0, timeToLive=60):
+        self._cursors = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._maxSize = maxSize
+        self._timeToLive = timeToLive
+
+    def setMaxSize(self, maxSize):
+        """
+        Sets the maximum number of cursors held in the cache. A size of
+        0 disables the cache.
+        """
+        if maxSize < 0:
+            raise ValueError(
+                "The size of the cursor cache must be a positive value")
+        with self._lock:
+            self._maxSize = maxSize
+            self._evict(time.time())
+
+    def setTimeToLive(self, timeToLive):
+        """
+        Sets the number of seconds for which a cursor is held in the cache.
+        """
+        self._timeToLive = timeToLive
+
+    def isEnabled(self):
+        """
+        Returns True if cursors are held in this cache.
+        """
+        return self._maxSize > 0
+
+    def __len__(self):
+        return len(self._cursors)
+
+    def _evict(self, now):
+        """
+        Removes expired cursors and, if the cache is full, the oldest
+        cursors from the cache. As all cursors share the same lifetime,
+        the cursors are in order of expiry.
+        """
+        while len(self._cursors) > 0:
+            cursorId, (expiryTime, _, _) = next(
+                self._cursors.iteritems())
+            if expiryTime > now and len(self._cursors) <= self._maxSize:
+                break
+            del self._cursors[cursorId]
+
+    def put(self, fingerprint, iterator, pageToken):
+        """
+        Stores the specified iterator for the request with the specified
+        fingerprint, and returns the continuation token to return to the
+        client in place of the specified stateless pageToken.
+        """
+        cursorId = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._cursors[cursorId] = (
+                now + self._timeToLive, fingerprint, iterator)
+            self._evict(now)
+        return "{}{}{}".format(cursorId, self.separator, pageToken)
+
+    def take(self, fingerprint, pageToken):
+        """
+        Returns an (iterator, pageToken) tuple for the specified page
+        token. If the page token is a continuation token whose cursor is
+        still in the cache and was stored for a request with the same
+        fingerprint, the iterator is removed from the cache and returned.
+        Otherwise, the returned iterator is None, and the stateless page
+        token should be used to resume the search.
+        """
+        if self.separator not in pageToken:
+            return None, pageToken
+        cursorId, pageToken = pageToken.split(self.separator, 1)
+        with self._lock:
+            self._evict(time.time())
+            cursor = self._cursors.pop(cursorId, None)
+        if cursor is None or cursor[1] != fingerprint:
+            return None, pageToken
+        return cursor[2], pageToken
+
+
+class PagePrefetcher(object):
+    """
+    Computes pages of search results on a pool of worker threads ahead
+    of the requests for them. Each page is a (responseString,
+    nextPageToken) pair computed by a function submitted with the key
+    that identifies it, typically the search and the page token that
+    requests it. Pages are held in an LRU cache until they are taken,
+    up to a total of maxBytes of serialized responses. Requests for a
+    page that is still being computed wait for it to complete, for at
+    most waitTimeout seconds. If the initializer of a worker thread
+    fails, prefetching is disabled.
+    """
+    def __init__(self, numWorkers=0, maxBytes=64 * 2**20, initializer=None,
+                 waitTimeout=30):
+        self._pages = collections.OrderedDict()
+        self._pending = {}
+        self._numBytes = 0
+        self._maxBytes = maxBytes
+        self._waitTimeout = waitTimeout
+        self._numWorkers = numWorkers
+        self._initializer = initializer
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue()
+        self._workers = []
+        self._numHits = 0
+        self._numMisses = 0
+
+    def setNumWorkers(self, numWorkers):
+        """
+        Sets the number of worker threads computing pages. A value of 0
+        disables prefetching.
+        """
+        if numWorkers < 0:
+            raise ValueError(
+                "The number of prefetch workers must be a positive value")
+        self._numWorkers = numWorkers
+
+    def setMaxBytes(self, maxBytes):
+        """
+        Sets the maximum total size of the pages held in the cache.
+        """
+        with self._lock:
+            self._maxBytes = maxBytes
+            self._evict()
+
+    def isEnabled(self):
+        """
+        Returns True if pages are prefetched.
+        """
+        return self._numWorkers > 0 and self._maxBytes > 0
+
+    def getNumHits(self):
+        """
+        Returns the number of pages that were served from the cache.
+        """
+        return self._numHits
+
+    def getNumMisses(self):
+        """
+        Returns the number of pages that were requested from the cache
+        but not found.
+        """
+        return self._numMisses
+
+    def getNumBytes(self):
+        """
+        Returns the total size of the pages currently in the cache.
+        """
+        return self._numBytes
+
+    def _evict(self):
+        while self._numBytes > self._maxBytes:
+            _, (page, numBytes) = self._pages.popitem(last=False)
+            self._numBytes -= numBytes
+
+    def _startWorkers(self):
+        while len(self._workers) < self._numWorkers:
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        if self._initializer is not None:
+            try:
+                self._initializer()
+            except Exception:
+                _logger.exception("Failed to start prefetch worker")
+                self._disable()
+                return
+        while True:
+            key, function, args = self._queue.get()
+            page = None
+            try:
+                page = function(*args)
+            except Exception:
+                # Prefetching is opportunistic: any error will be raised
+                # again when the page is requested.
+                pass
+            with self._lock:
+                try:
+                    if page is not None:
+                        numBytes = len(page[0])
+                        self._pages[key] = page, numBytes
+                        self._numBytes += numBytes
+                        self._evict()
+                finally:
+                    self._pending.pop(key).set()
+
+    def _disable(self):
+        """
+        Stops prefetching, and releases the requests waiting for the pages
+        that will no longer be computed.
+        """
+        with self._lock:
+            self._numWorkers = 0
+            while True:
+                try:
+                    key, _, _ = self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+                self._pending.pop(key).set()
+
+    def prefetch(self, key, function, *args):
+        """
+        Schedules the computation of the page with the specified key by
+        calling function with the specified arguments on a worker thread.
+        Pages that are already cached or being computed, and pages
+        submitted while all workers are busy with a full backlog, are
+        ignored.
+        """
+        with self._lock:
+            if key in self._pages or key in self._pending:
+                return
+            if self._queue.qsize() >= self._numWorkers:
+                return
+            self._startWorkers()
+            self._pending[key] = threading.Event()
+            self._queue.put((key, function, args))
+
+    def take(self, key):
+        """
+        Returns the (responseString, nextPageToken) pair for the page
+        with the specified key and removes it from the cache, waiting for
+        the page if it is being computed. Returns None if the page is not
+        available, or if it is not computed within the wait timeout.
+        """
+        with self._lock:
+            event = self._pending.get(key)
+        if event is not None:
+            event.wait(self._waitTimeout)
+        with self._lock:
+            page = None
+            if key in self._pages:
+                page, numBytes = self._pages.pop(key)
+                self._numBytes -= numBytes
+                self._numHits += 1
+            else:
+                self._numMisses += 1
+        return page
+
+
+# The data repository used by the variant conversion worker processes.
+_conversionDataRepository = None
+
+
+def _initializeVariantConversionWorker(dataRepository):
+    """
+    Initializes a variant conversion worker process. File handles
+    inherited from the parent process share their file offsets with it,
+    so the worker opens its own, with a decompression thread budget of
+    its own.
+    """
+    global _conversionDataRepository
+    _conversionDataRepository = dataRepository
+    cache = datamodel.PysamFileHandleCache()
+    cache.setMaxCacheSize(datamodel.fileHandleCache.getMaxCacheSize())
+    cache.setDecompressionThreads(
+        *datamodel.fileHandleCache.getDecompressionThreads())
+    datamodel.fileHandleCache = cache
+    datamodel.setThreadFileHandleCache(None)
+
+
+def _convertVariantShard(
+        variantSetId, referenceName, start, end, callSetIds, variantFilter,
+        overlapping):
+    """
+    Returns a (serializedVariants, error) pair, in which serializedVariants
+    is the list of serialized variants starting within the specified
+    interval of the variant set with the specified ID, or overlapping it
+    if overlapping is True. If they cannot be converted in this process,
+    serializedVariants is None and error is the formatted traceback of
+    the failure.
+    """
+    try:
+        compoundId = datamodel.VariantSetCompoundId.parse(variantSetId)
+        dataset = _conversionDataRepository.getDataset(compoundId.dataset_id)
+        variantSet = dataset.getVariantSet(compoundId.variant_set_id)
+        return [
+            variant.SerializeToString() for variant in variantSet.getVariants(
+                referenceName, start, end, callSetIds, variantFilter)
+            if overlapping or variant.start >= start], None
+    except Exception:
+        # Exceptions cannot reliably be sent back to the parent process, so
+        # the shard is converted again there and any error raised then.
+        return None, traceback.format_exc()
+
+
+class VariantConversionPool(object):
+    """
+    Converts the variants of searches over large intervals on a pool of
+    worker processes. The search interval is split into consecutive shards
+    of at least minShardSize bases, which are converted by the workers.
+    The variants of each shard that start before it are left to the shards
+    preceding it, so that the variants are returned in exactly the order of
+    a serial search.
+
+    The pool records the density of the variants of each search it
+    converts. When the caller states how many variants it needs, such as
+    the size of a page, the shards are sized so that these variants are
+    spread over the workers, and no more shards are submitted than are
+    expected to hold them, since the shards of a page that is already
+    full are discarded. Otherwise, up to one shard per worker is kept
+    ahead of the caller. The size of the shards doubles while they are
+    empty, so that the unpopulated end of a search is covered quickly.
+    Shards that a worker fails to convert within shardTimeout seconds
+    are converted by the calling process.
+    """
+    # The maximum number of searches whose variant density is recorded.
+    _maxDensities = 1024
+
+    def __init__(self, dataRepository, numWorkers=0, minShardSize=10000,
+                 shardTimeout=60):
+        self._dataRepository = dataRepository
+        self._numWorkers = 0
+        self._minShardSize = minShardSize
+        self._shardTimeout = shardTimeout
+        self._pool = None
+        self._densities = {}
+        self._lock = threading.Lock()
+        self._numWorkerVariants = 0
+        self._numUsedWorkerVariants = 0
+        self.setNumWorkers(numWorkers)
+
+    def setNumWorkers(self, numWorkers):
+        """
+        Sets the number of worker processes converting variants. A value
+        of 0 disables sharded conversion.
+        """
+        if numWorkers < 0:
+            raise ValueError(
+                "The number of variant conversion workers must be a "
+                "positive value")
+        if numWorkers != self._numWorkers and self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+        self._numWorkers = numWorkers
+        if numWorkers > 0 and self._pool is None:
+            self._pool = multiprocessing.Pool(
+                numWorkers, _initializeVariantConversionWorker,
+                (self._dataRepository,))
+
+    def setMinShardSize(self, minShardSize):
+        """
+        Sets the minimum number of bases in the shards converted by each
+        worker.
+        """
+        if minShardSize <= 0:
+            raise ValueError(
+                "The minimum variant conversion shard size must be a "
+                "positive value")
+        self._minShardSize = minShardSize
+
+    def isEnabled(self):
+        """
+        Returns True if variants are converted on worker processes.
+        """
+        return self._numWorkers > 0
+
+    def getNumWorkerVariants(self):
+        """
+        Returns the number of variants converted by the workers.
+        """
+        return self._numWorkerVariants
+
+    def getNumUsedWorkerVariants(self):
+        """
+        Returns the number of the variants converted by the workers that
+        were returned to the callers.
+        """
+        return self._numUsedWorkerVariants
+
+    def getVariants(self, variantSet, referenceName, start, end, callSetIds,
+                    variantFilter=None, numVariants=None):
+        """
+        Returns an iterator over the variants in the specified interval of
+        the specified variant set, as returned by its getVariants method.
+        If numVariants is specified, the caller is expected to read about
+        this many variants, and shards are only converted ahead of the
+        caller to provide them. Searches that are open ended or span less
+        than two shards are converted by the calling process.
+        """
+        if (not self.isEnabled() or end is None or
+                end - start < 2 * self._minShardSize):
+            return variantSet.getVariants(
+                referenceName, start, end, callSetIds, variantFilter)
+        return self._getShardedVariants(
+            variantSet, referenceName, start, end, list(callSetIds),
+            variantFilter, numVariants)
+
+    def _getDensity(self, densityKey):
+        """
+        Returns the (numVariants, numBases) pair recorded for the search
+        with the specified key, or None if nothing is known about it.
+        """
+        density = self._densities.get(densityKey)
+        if density is None or density[1] == 0:
+            return None
+        return density
+
+    def _addDensity(self, densityKey, numVariants, numBases):
+        """
+        Records that a shard of numBases bases of the search with the
+        specified key held numVariants variants. The counts of the shards
+        recorded earlier are halved, so that the density follows the
+        region that the pages of a search are moving through.
+        """
+        with self._lock:
+            density = self._densities.get(densityKey)
+            if density is None:
+                if len(self._densities) >= self._maxDensities:
+                    self._densities.clear()
+                density = [0, 0]
+                self._densities[densityKey] = density
+            density[0] = density[0] / 2 + numVariants
+            density[1] = density[1] / 2 + numBases
+
+    def _getShardSize(self, densityKey, numVariants):
+        """
+        Returns the number of bases of the shards that spread the
+        specified number of variants of the search with the specified key
+        over the workers, or minShardSize if either is not known.
+        """
+        density = self._getDensity(densityKey)
+        if numVariants is None or density is None or density[0] == 0:
+            return self._minShardSize
+        numBases = int(numVariants * density[1] / (
+            density[0] * self._numWorkers)) + 1
+        return max(numBases, self._minShardSize)
+
+    def _isShardNeeded(self, densityKey, numVariants, numPendingBases):
+        """
+        Returns True if another shard should be submitted for a caller
+        that needs numVariants more variants of the search with the
+        specified key, while shards of numPendingBases are pending.
+        """
+        if numPendingBases == 0:
+            return True
+        density = self._getDensity(densityKey)
+        if numVariants is None or density is None:
+            return True
+        return numPendingBases * density[0] < numVariants * density[1]
+
+    def _getShardedVariants(
+            self, variantSet, referenceName, start, end, callSetIds,
+            variantFilter, numVariants):
+        variantSetId = variantSet.getId()
+        densityKey = variantSetId, referenceName, variantFilter
+        numNeeded = numVariants
+        shardSize = self._getShardSize(densityKey, numNeeded)
+        shards = collections.deque()
+        numPendingBases = 0
+        nextShardStart = start
+        while True:
+            while (nextShardStart < end and
+                    len(shards) < self._numWorkers and
+                    self._isShardNeeded(
+                        densityKey, numNeeded, numPendingBases)):
+                shardEnd = min(nextShardStart + shardSize, end)
+                shards.append((
+                    nextShardStart, shardEnd, self._pool.apply_async(
+                        _convertVariantShard, (
+                            variantSetId, referenceName, nextShardStart,
+                            shardEnd, callSetIds, variantFilter,
+                            nextShardStart == start))))
+                numPendingBases += shardEnd - nextShardStart
+                nextShardStart = shardEnd
+            if len(shards) == 0:
+                break
+            shardStart, shardEnd, result = shards.popleft()
+            numPendingBases -= shardEnd - shardStart
+            variants, isWorkerResult = self._getShardResult(
+                variantSet, referenceName, shardStart, shardEnd, callSetIds,
+                variantFilter, shardStart == start, result)
+            self._addDensity(densityKey, len(variants), shardEnd - shardStart)
+            if numNeeded is not None:
+                numNeeded -= len(variants)
+                if numNeeded <= 0:
+                    # The caller reads on beyond the variants it expected,
+                    # so we provide as many again.
+                    numNeeded = numVariants
+            if len(variants) == 0:
+                shardSize *= 2
+            else:
+                shardSize = self._getShardSize(densityKey, numNeeded)
+            for variant in variants:
+                if isWorkerResult:
+                    with self._lock:
+                        self._numUsedWorkerVariants += 1
+                yield variant
+
+    def _getShardResult(
+            self, variantSet, referenceName, shardStart, shardEnd, callSetIds,
+            variantFilter, overlapping, result):
+        """
+        Returns a (variants, isWorkerResult) pair, in which variants is
+        the list of the variants of the specified shard converted by a
+        worker, or by the calling process if the worker fails or does
+        not complete within shardTimeout seconds, when isWorkerResult is
+        False.
+        """
+        try:
+            serializedVariants, error = result.get(self._shardTimeout)
+        except multiprocessing.TimeoutError:
+            # A worker that dies while converting the shard never
+            # completes it.
+            serializedVariants, error = None, "Timed out after {} s".format(
+                self._shardTimeout)
+        if serializedVariants is not None:
+            variants = []
+            for serializedVariant in serializedVariants:
+                variant = protocol.Variant()
+                variant.ParseFromString(serializedVariant)
+                variants.append(variant)
+            with self._lock:
+                self._numWorkerVariants += len(variants)
+            return variants, True
+        _logger.warning(
+            "Failed to convert variants %s:%d-%d in a worker process, "
+            "converting them in the request process instead:\n%s",
+            referenceName, shardStart, shardEnd, error)
+        variants = [
+            variant for variant in variantSet.getVariants(
+                referenceName, shardStart, shardEnd, callSetIds,
+                variantFilter)
+            if overlapping or variant.start >= shardStart]
+        return variants, False
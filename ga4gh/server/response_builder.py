@@ -5,10 +5,429 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import base64
+import json
+import math
+
 import ga4gh.schemas.pb as pb
 import ga4gh.schemas.protocol as protocol
 
 
+def _encodeVarint(value):
+    """
+    Returns the protobuf base 128 varint encoding of the specified
+    non-negative integer as a byte string.
+    """
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append((value & 0x7f) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _getEnumNames(messageClass, fieldName):
+    """
+    Returns a dictionary mapping the numbers of the values of the
+    specified enum field to their names.
+    """
+    enumType = messageClass.DESCRIPTOR.fields_by_name[fieldName].enum_type
+    return dict((value.number, value.name) for value in enumType.values)
+
+
+_strandNames = _getEnumNames(protocol.Position, "strand")
+_cigarOperationNames = _getEnumNames(protocol.CigarUnit, "operation")
+_expressionUnitNames = _getEnumNames(protocol.ExpressionLevel, "units")
+_attributeNullValueNames = _getEnumNames(
+    protocol.AttributeValue, "null_value")
+
+
+def _floatToJson(value):
+    """
+    Returns the JSON representation of the specified floating point value,
+    encoding infinite and NaN values as strings.
+    """
+    if math.isinf(value):
+        if value < 0.0:
+            return "-Infinity"
+        return "Infinity"
+    if math.isnan(value):
+        return "NaN"
+    return value
+
+
+def _attributeValueToJson(attributeValue):
+    which = attributeValue.WhichOneof("value")
+    if which is None:
+        return {}
+    if which == "string_value":
+        return {"stringValue": attributeValue.string_value}
+    if which == "int64_value":
+        return {"int64Value": str(attributeValue.int64_value)}
+    if which == "int32_value":
+        return {"int32Value": attributeValue.int32_value}
+    if which == "bool_value":
+        return {"boolValue": attributeValue.bool_value}
+    if which == "double_value":
+        return {"doubleValue": _floatToJson(attributeValue.double_value)}
+    if which == "null_value":
+        return {"nullValue": _attributeNullValueNames[
+            attributeValue.null_value]}
+    if which == "attribute_list":
+        return {"attributeList": _attributeValueListToJson(
+            attributeValue.attribute_list)}
+    if which == "attributes":
+        return {"attributes": _attributesToJson(attributeValue.attributes)}
+    return protocol.json_format.MessageToDict(attributeValue, False)
+
+
+def _attributeValueListToJson(attributeValueList):
+    if len(attributeValueList.values) == 0:
+        return {}
+    return {"values": [
+        _attributeValueToJson(value) for value in attributeValueList.values]}
+
+
+def _attributesToJson(attributes):
+    attr = attributes.attr
+    if len(attr) == 0:
+        return {}
+    js = {}
+    for key in attr:
+        js[key] = _attributeValueListToJson(attr[key])
+    return {"attr": js}
+
+
+def _valueToJson(value):
+    which = value.WhichOneof("kind")
+    if which is None or which == "null_value":
+        return None
+    if which == "number_value":
+        return _floatToJson(value.number_value)
+    if which == "string_value":
+        return value.string_value
+    if which == "bool_value":
+        return value.bool_value
+    if which == "list_value":
+        return [_valueToJson(element) for element in value.list_value.values]
+    return protocol.json_format.MessageToDict(value.struct_value, False)
+
+
+def _callToJson(call):
+    js = {}
+    if call.call_set_name:
+        js["callSetName"] = call.call_set_name
+    if call.call_set_id:
+        js["callSetId"] = call.call_set_id
+    if call.phaseset:
+        js["phaseset"] = call.phaseset
+    if len(call.genotype_likelihood) > 0:
+        js["genotypeLikelihood"] = [
+            _floatToJson(value) for value in call.genotype_likelihood]
+    if call.HasField("genotype"):
+        js["genotype"] = [
+            _valueToJson(value) for value in call.genotype.values]
+    if call.HasField("attributes"):
+        js["attributes"] = _attributesToJson(call.attributes)
+    return js
+
+
+def _variantToJson(variant):
+    js = {}
+    if variant.id:
+        js["id"] = variant.id
+    if variant.variant_set_id:
+        js["variantSetId"] = variant.variant_set_id
+    if len(variant.names) > 0:
+        js["names"] = list(variant.names)
+    if variant.created:
+        js["created"] = str(variant.created)
+    if variant.updated:
+        js["updated"] = str(variant.updated)
+    if variant.reference_name:
+        js["referenceName"] = variant.reference_name
+    if variant.start:
+        js["start"] = str(variant.start)
+    if variant.end:
+        js["end"] = str(variant.end)
+    if variant.reference_bases:
+        js["referenceBases"] = variant.reference_bases
+    if len(variant.alternate_bases) > 0:
+        js["alternateBases"] = list(variant.alternate_bases)
+    if len(variant.calls) > 0:
+        js["calls"] = [_callToJson(call) for call in variant.calls]
+    if variant.HasField("attributes"):
+        js["attributes"] = _attributesToJson(variant.attributes)
+    if variant.filters_applied:
+        js["filtersApplied"] = True
+    if variant.filters_passed:
+        js["filtersPassed"] = True
+    if len(variant.filters_failed) > 0:
+        js["filtersFailed"] = list(variant.filters_failed)
+    if variant.variant_type:
+        js["variantType"] = variant.variant_type
+    if variant.svlen:
+        js["svlen"] = str(variant.svlen)
+    if len(variant.cipos) > 0:
+        js["cipos"] = list(variant.cipos)
+    if len(variant.ciend) > 0:
+        js["ciend"] = list(variant.ciend)
+    return js
+
+
+def _positionToJson(position):
+    js = {}
+    if position.reference_name:
+        js["referenceName"] = position.reference_name
+    if position.position:
+        js["position"] = str(position.position)
+    if position.strand:
+        js["strand"] = _strandNames[position.strand]
+    return js
+
+
+def _cigarUnitToJson(cigarUnit):
+    js = {}
+    if cigarUnit.operation:
+        js["operation"] = _cigarOperationNames[cigarUnit.operation]
+    if cigarUnit.operation_length:
+        js["operationLength"] = str(cigarUnit.operation_length)
+    if cigarUnit.reference_sequence:
+        js["referenceSequence"] = cigarUnit.reference_sequence
+    return js
+
+
+def _linearAlignmentToJson(alignment):
+    js = {}
+    if alignment.HasField("position"):
+        js["position"] = _positionToJson(alignment.position)
+    if alignment.mapping_quality:
+        js["mappingQuality"] = alignment.mapping_quality
+    if len(alignment.cigar) > 0:
+        js["cigar"] = [
+            _cigarUnitToJson(cigarUnit) for cigarUnit in alignment.cigar]
+    return js
+
+
+def _readAlignmentToJson(read):
+    js = {}
+    if read.id:
+        js["id"] = read.id
+    if read.read_group_id:
+        js["readGroupId"] = read.read_group_id
+    if read.fragment_name:
+        js["fragmentName"] = read.fragment_name
+    if read.improper_placement:
+        js["improperPlacement"] = True
+    if read.duplicate_fragment:
+        js["duplicateFragment"] = True
+    if read.number_reads:
+        js["numberReads"] = read.number_reads
+    if read.fragment_length:
+        js["fragmentLength"] = read.fragment_length
+    if read.read_number:
+        js["readNumber"] = read.read_number
+    if read.failed_vendor_quality_checks:
+        js["failedVendorQualityChecks"] = True
+    if read.HasField("alignment"):
+        js["alignment"] = _linearAlignmentToJson(read.alignment)
+    if read.secondary_alignment:
+        js["secondaryAlignment"] = True
+    if read.supplementary_alignment:
+        js["supplementaryAlignment"] = True
+    if read.aligned_sequence:
+        js["alignedSequence"] = read.aligned_sequence
+    if len(read.aligned_quality) > 0:
+        js["alignedQuality"] = list(read.aligned_quality)
+    if read.HasField("next_mate_position"):
+        js["nextMatePosition"] = _positionToJson(read.next_mate_position)
+    if read.HasField("attributes"):
+        js["attributes"] = _attributesToJson(read.attributes)
+    return js
+
+
+def _featureToJson(feature):
+    js = {}
+    if feature.id:
+        js["id"] = feature.id
+    if feature.name:
+        js["name"] = feature.name
+    if feature.gene_symbol:
+        js["geneSymbol"] = feature.gene_symbol
+    if feature.parent_id:
+        js["parentId"] = feature.parent_id
+    if len(feature.child_ids) > 0:
+        js["childIds"] = list(feature.child_ids)
+    if feature.feature_set_id:
+        js["featureSetId"] = feature.feature_set_id
+    if feature.reference_name:
+        js["referenceName"] = feature.reference_name
+    if feature.start:
+        js["start"] = str(feature.start)
+    if feature.end:
+        js["end"] = str(feature.end)
+    if feature.strand:
+        js["strand"] = _strandNames[feature.strand]
+    if feature.HasField("feature_type"):
+        featureType = {}
+        if feature.feature_type.term_id:
+            featureType["termId"] = feature.feature_type.term_id
+        if feature.feature_type.term:
+            featureType["term"] = feature.feature_type.term
+        js["featureType"] = featureType
+    if feature.HasField("attributes"):
+        js["attributes"] = _attributesToJson(feature.attributes)
+    return js
+
+
+def _expressionLevelToJson(expressionLevel):
+    js = {}
+    if expressionLevel.id:
+        js["id"] = expressionLevel.id
+    if expressionLevel.name:
+        js["name"] = expressionLevel.name
+    if expressionLevel.rna_quantification_id:
+        js["rnaQuantificationId"] = expressionLevel.rna_quantification_id
+    if expressionLevel.raw_read_count:
+        js["rawReadCount"] = _floatToJson(expressionLevel.raw_read_count)
+    if expressionLevel.expression:
+        js["expression"] = _floatToJson(expressionLevel.expression)
+    if expressionLevel.is_normalized:
+        js["isNormalized"] = True
+    if expressionLevel.units:
+        js["units"] = _expressionUnitNames[expressionLevel.units]
+    if expressionLevel.score:
+        js["score"] = _floatToJson(expressionLevel.score)
+    if expressionLevel.conf_interval_low:
+        js["confIntervalLow"] = _floatToJson(
+            expressionLevel.conf_interval_low)
+    if expressionLevel.conf_interval_high:
+        js["confIntervalHigh"] = _floatToJson(
+            expressionLevel.conf_interval_high)
+    if expressionLevel.HasField("attributes"):
+        js["attributes"] = _attributesToJson(expressionLevel.attributes)
+    return js
+
+
+# Specialised JSON encoders for the most frequently returned protocol
+# classes. These produce exactly the same objects as json_format, with
+# fields inserted in field number order, so that the JSON documents
+# returned are identical.
+_jsonEncoders = {
+    protocol.Variant: _variantToJson,
+    protocol.ReadAlignment: _readAlignmentToJson,
+    protocol.Feature: _featureToJson,
+    protocol.ExpressionLevel: _expressionLevelToJson,
+}
+
+
+def getJsonObject(protocolElement):
+    """
+    Returns the JSON object (as would be returned by
+    json_format.MessageToDict) for the specified protocol element, using
+    a specialised encoder where one is available.
+    """
+    encoder = _jsonEncoders.get(type(protocolElement))
+    if encoder is None:
+        return protocol.json_format.MessageToDict(protocolElement, False)
+    return encoder(protocolElement)
+
+
+def toJson(protocolElement):
+    """
+    Serialises the specified protocol element as JSON. The output is
+    identical to that of protocol.toJson.
+    """
+    return json.dumps(getJsonObject(protocolElement))
+
+
+def serialize(protocolElement, mimetype):
+    """
+    Serialises the specified protocol element according to the specified
+    mimetype, as protocol.serialize.
+    """
+    if mimetype == "application/json":
+        return toJson(protocolElement)
+    return protocolElement.SerializeToString()
+
+
+PACKED_GENOTYPES_MIMETYPE = "application/x-ga4gh-packed-genotypes"
+
+# The 2-bit codes used for packed genotypes. Genotypes without a code are
+# packed as NA and listed separately.
+_packedGenotypeCodes = {
+    'HOMOZYGOUS_REF': 0,
+    'HETEROZYGOUS_ALT': 1,
+    'HOMOZYGOUS_ALT': 2,
+    'NA': 3,
+}
+_packedGenotypeNames = dict(
+    (code, name) for name, code in _packedGenotypeCodes.items())
+
+
+def packGenotypes(genotypes):
+    """
+    Packs the specified list of Genotype values as 2-bit codes, four to a
+    byte, with the first genotype in the least significant bits of the
+    first byte. Returns the packed bytes and a list of [index, name]
+    pairs for the genotypes that have no 2-bit code (OTHER and the
+    hemizygous genotypes), which are packed as NA.
+    """
+    codes = {}
+    packedCodes = []
+    otherGenotypes = []
+    for index, genotype in enumerate(genotypes):
+        code = codes.get(genotype)
+        if code is None:
+            code = _packedGenotypeCodes.get(
+                protocol.Genotype.Name(genotype), -1)
+            codes[genotype] = code
+        if code < 0:
+            otherGenotypes.append([index, protocol.Genotype.Name(genotype)])
+            code = _packedGenotypeCodes['NA']
+        packedCodes.append(code)
+    packedCodes.extend([0] * (-len(packedCodes) % 4))
+    packed = bytearray(
+        a | (b << 2) | (c << 4) | (d << 6) for a, b, c, d in zip(
+            packedCodes[0::4], packedCodes[1::4], packedCodes[2::4],
+            packedCodes[3::4]))
+    return bytes(packed), otherGenotypes
+
+
+def unpackGenotypes(packed, otherGenotypes, numGenotypes):
+    """
+    Returns the list of the specified number of Genotype values packed
+    by packGenotypes.
+    """
+    values = dict(
+        (code, protocol.Genotype.Value(name))
+        for code, name in _packedGenotypeNames.items())
+    genotypes = []
+    for byte in bytearray(packed):
+        for shift in (0, 2, 4, 6):
+            genotypes.append(values[(byte >> shift) & 3])
+    del genotypes[numGenotypes:]
+    for index, name in otherGenotypes:
+        genotypes[index] = protocol.Genotype.Value(name)
+    return genotypes
+
+
+def serializePackedGenotypes(response):
+    """
+    Serialises the specified SearchGenotypesResponse as JSON, with the
+    genotype matrix replaced by the base64 encoded packedGenotypes and
+    the otherGenotypes list returned by packGenotypes. The genotypes
+    field of the specified response is cleared.
+    """
+    packed, otherGenotypes = packGenotypes(response.genotypes.genotypes)
+    response.genotypes.ClearField(b"genotypes")
+    js = getJsonObject(response)
+    genotypeMatrix = js.setdefault("genotypes", {})
+    genotypeMatrix["packedGenotypes"] = base64.b64encode(packed)
+    genotypeMatrix["otherGenotypes"] = otherGenotypes
+    return json.dumps(js)
+
+
 class SearchResponseBuilder(object):
     """
     A class to allow sequential building of SearchResponse objects.
@@ -21,6 +440,12 @@ class SearchResponseBuilder(object):
         maxBufferSize (in bytes). The maxBufferSize is an
         approximate limit on the overall length of the serialised
         response.
+
+        For binary responses, each element is serialised exactly once and
+        its length-delimited bytes appended directly to an output buffer,
+        so that no intermediate response message is built. Similarly,
+        JSON responses are assembled from the JSON objects for each
+        element.
         """
         self._pageSize = pageSize
         self._maxBufferSize = maxBufferSize
@@ -30,6 +455,17 @@ class SearchResponseBuilder(object):
         self._valueListName = protocol.getValueListName(responseClass)
         self._bufferSize = self._protoObject.ByteSize()
         self._return_mimetype = return_mimetype
+        self._isBinary = return_mimetype != "application/json"
+        self._serializedValues = []
+        self._jsonValues = []
+        valueListField = responseClass.DESCRIPTOR.fields_by_name[
+            self._valueListName]
+        tokenField = responseClass.DESCRIPTOR.fields_by_name[
+            "next_page_token"]
+        # Length-delimited fields are tagged with wire type 2
+        self._valueListTag = _encodeVarint((valueListField.number << 3) | 2)
+        self._tokenBeforeValues = tokenField.number < valueListField.number
+        self._valueListJsonName = valueListField.json_name
 
     def getPageSize(self):
         """
@@ -66,10 +502,15 @@ class SearchResponseBuilder(object):
         response.
         """
         self._numElements += 1
+        if self._isBinary:
+            serialized = protocolElement.SerializeToString()
+            self._bufferSize += len(serialized)
+            self._serializedValues.extend([
+                self._valueListTag, _encodeVarint(len(serialized)),
+                serialized])
+            return
         self._bufferSize += protocolElement.ByteSize()
-        attr = getattr(self._protoObject, self._valueListName)
-        obj = attr.add()
-        obj.CopyFrom(protocolElement)
+        self._jsonValues.append(getJsonObject(protocolElement))
 
     def isFull(self):
         """
@@ -91,6 +532,26 @@ class SearchResponseBuilder(object):
         Returns a string version of the SearchResponse that has
         been built by this SearchResponseBuilder.
         """
-        self._protoObject.next_page_token = pb.string(self._nextPageToken)
-        s = protocol.serialize(self._protoObject, self._return_mimetype)
-        return s
+        if self._isBinary:
+            return self._getBinaryResponse()
+        js = {}
+        if len(self._jsonValues) > 0:
+            js[self._valueListJsonName] = self._jsonValues
+        nextPageToken = pb.string(self._nextPageToken)
+        if nextPageToken:
+            js["nextPageToken"] = nextPageToken
+        return json.dumps(js)
+
+    def _getBinaryResponse(self):
+        """
+        Returns the binary serialisation of the response by concatenating
+        the pre-serialised values with the encoded next_page_token. The
+        fields are written in field number order, so that the result is
+        identical to serialising the equivalent response message.
+        """
+        tokenObject = self._protoObject.__class__()
+        tokenObject.next_page_token = pb.string(self._nextPageToken)
+        serializedToken = tokenObject.SerializeToString()
+        if self._tokenBeforeValues:
+            return serializedToken + b"".join(self._serializedValues)
+        return b"".join(self._serializedValues) + serializedToken
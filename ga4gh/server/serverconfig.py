@@ -20,6 +20,17 @@ class BaseConfig(object):
     REQUEST_VALIDATION = True
     DEFAULT_PAGE_SIZE = 100
     DATA_SOURCE = "empty://"
+    # Include BGZF virtual file offsets in read and variant page tokens
+    SEEKABLE_PAGE_TOKENS = False
+    # Hold the iterators of in-flight read and variant searches between pages
+    CURSOR_CACHE_MAX_SIZE = 0
+    CURSOR_CACHE_TIME_TO_LIVE = 60
+    # Compute the next page of read and variant searches in the background
+    PREFETCH_WORKERS = 0
+    PREFETCH_CACHE_MAX_BYTES = 64 * 1024 * 1024  # 64MB
+    # Convert the variants of large searches on a pool of worker processes
+    VARIANT_CONVERSION_WORKERS = 0
+    VARIANT_CONVERSION_MIN_SHARD_SIZE = 10000
 
     # Options for the simulated backend.
     SIMULATED_BACKEND_RANDOM_SEED = 0
@@ -36,6 +47,20 @@ class BaseConfig(object):
     SIMULATED_BACKEND_NUM_EXPRESSION_LEVELS_PER_RNA_QUANT_SET = 2
 
     FILE_HANDLE_CACHE_MAX_SIZE = 50
+    # Open BAM and VCF/BCF files with this many htslib decompression
+    # threads each, using at most HTSLIB_DECOMPRESSION_MAX_THREADS between
+    # all the open files. Values less than 2 disable threaded decompression.
+    # Threaded decompression requires pysam 0.15.0 or later.
+    HTSLIB_DECOMPRESSION_THREADS = 0
+    HTSLIB_DECOMPRESSION_MAX_THREADS = 16
+    # Store the decoded reads of CRAM files in this directory
+    CRAM_SLICE_CACHE_DIR = None
+    CRAM_SLICE_CACHE_BIN_SIZE = 100000
+    # The library used to read and convert VCF/BCF records
+    VARIANT_ENGINE = "pysam"
+    # Cache converted variants of frequently searched regions
+    VARIANT_BLOCK_CACHE_MAX_BYTES = 0
+    VARIANT_BLOCK_CACHE_BIN_SIZE = 10000
 
     LANDING_MESSAGE_HTML = "landing_message.html"
     INITIAL_PEERS = "ga4gh/server/templates/initial_peers.txt"
@@ -0,0 +1,109 @@
+"""
+Benchmarks htslib multi-threaded BGZF decompression, timing wide-region
+searches of a BAM file and of a VCF/BCF file opened with increasing
+numbers of decompression threads.
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import time
+
+import glue
+
+glue.ga4ghImportGlue()
+import ga4gh.server.datamodel as datamodel  # noqa
+import ga4gh.server.datamodel.datasets as datasets  # noqa
+import ga4gh.server.datamodel.reads as reads  # noqa
+import ga4gh.server.datamodel.references as references  # noqa
+import ga4gh.server.datamodel.variants as variants  # noqa
+
+
+def timeIteration(iterator):
+    """
+    Returns the wall clock time taken to exhaust the specified iterator,
+    and the number of objects it returned.
+    """
+    startTime = time.time()
+    numObjects = 0
+    for _ in iterator:
+        numObjects += 1
+    return time.time() - startTime, numObjects
+
+
+def readSearch(readGroupSet, referenceName, start, end):
+    referenceSet = references.AbstractReferenceSet("benchmark")
+    reference = references.AbstractReference(referenceSet, referenceName)
+    return readGroupSet.getReadAlignments(reference, start, end)
+
+
+def variantSearch(variantSet, referenceName, start, end):
+    return variantSet.getVariants(referenceName, start, end)
+
+
+def benchmarkThreads(search, dataObject, args, threads):
+    """
+    Returns the minimum wall clock time taken to run the specified search
+    with files opened with the specified number of decompression threads,
+    and the number of objects it returned.
+    """
+    times = []
+    for _ in range(args.repeatLimit):
+        # Use a new cache for each run, so that the files are reopened
+        # with the requested threads and no blocks are already read.
+        cache = datamodel.PysamFileHandleCache()
+        cache.setDecompressionThreads(threads, threads)
+        datamodel.setThreadFileHandleCache(cache)
+        elapsedTime, numObjects = timeIteration(search(
+            dataObject, args.referenceName, args.start, args.end))
+        times.append(elapsedTime)
+    datamodel.setThreadFileHandleCache(None)
+    return min(times), numObjects
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="GA4GH decompression threads benchmark")
+    parser.add_argument(
+        "--bamFile", default=None, help="The indexed BAM file to search")
+    parser.add_argument(
+        "--vcfFile", default=None,
+        help="The indexed VCF or BCF file to search")
+    parser.add_argument(
+        "--referenceName", default="1", help="The reference to search")
+    parser.add_argument(
+        "--start", type=int, default=0, help="The start of the search")
+    parser.add_argument(
+        "--end", type=int, default=10**7, help="The end of the search")
+    parser.add_argument(
+        "--threads", type=int, nargs="+", default=[0, 2, 4, 8],
+        help="The numbers of decompression threads to run each search "
+        "with (default: %(default)s)")
+    parser.add_argument(
+        "--repeatLimit", type=int, default=3, metavar='N',
+        help="How many times to run each search (default: %(default)s)")
+    args = parser.parse_args()
+    if args.bamFile is None and args.vcfFile is None:
+        parser.error("At least one of --bamFile and --vcfFile is required")
+
+    dataset = datasets.Dataset("benchmark")
+    searches = []
+    if args.bamFile is not None:
+        readGroupSet = reads.HtslibReadGroupSet(dataset, "benchmark")
+        readGroupSet.populateFromFile(args.bamFile)
+        searches.append(("reads", readSearch, readGroupSet))
+    if args.vcfFile is not None:
+        variantSet = variants.HtslibVariantSet(dataset, "benchmark")
+        indexFile = args.vcfFile + (
+            ".csi" if args.vcfFile.endswith(".bcf") else ".tbi")
+        variantSet.populateFromFile([args.vcfFile], [indexFile])
+        searches.append(("variants", variantSearch, variantSet))
+    print("search\tthreads\tseconds\tobjects\tobjects/second")
+    for name, search, dataObject in searches:
+        for threads in args.threads:
+            elapsedTime, numObjects = benchmarkThreads(
+                search, dataObject, args, threads)
+            print("{}\t{}\t{:.3f}\t{}\t{:.0f}".format(
+                name, threads, elapsedTime, numObjects,
+                numObjects / elapsedTime))
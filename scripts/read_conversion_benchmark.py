@@ -0,0 +1,76 @@
+"""
+Benchmarks the conversion of the reads in a region of a BAM file into
+GA4GH ReadAlignments, timing the iteration over the pysam reads alone
+and with their conversion.
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import time
+
+import glue
+
+glue.ga4ghImportGlue()
+import ga4gh.server.datamodel.datasets as datasets  # noqa
+import ga4gh.server.datamodel.reads as reads  # noqa
+import ga4gh.server.datamodel.references as references  # noqa
+
+
+def timeIteration(iterator):
+    """
+    Returns the wall clock time taken to exhaust the specified iterator,
+    and the number of objects it returned.
+    """
+    startTime = time.time()
+    numObjects = 0
+    for _ in iterator:
+        numObjects += 1
+    return time.time() - startTime, numObjects
+
+
+def pysamReads(readGroupSet, referenceName, start, end):
+    samFile = readGroupSet.getFileHandle(readGroupSet.getDataUrl())
+    return samFile.fetch(referenceName.encode(), start, end)
+
+
+def convertedReads(readGroupSet, referenceName, start, end):
+    referenceSet = references.AbstractReferenceSet("benchmark")
+    reference = references.AbstractReference(referenceSet, referenceName)
+    return readGroupSet.getReadAlignments(reference, start, end)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="GA4GH read conversion benchmark")
+    parser.add_argument(
+        "bamFile", help="The indexed BAM file to read")
+    parser.add_argument(
+        "--indexFile", default=None,
+        help="The index of the BAM file (default: bamFile.bai)")
+    parser.add_argument(
+        "--referenceName", default="1", help="The reference to search")
+    parser.add_argument(
+        "--start", type=int, default=0, help="The start of the search")
+    parser.add_argument(
+        "--end", type=int, default=10**6, help="The end of the search")
+    parser.add_argument(
+        "--repeatLimit", type=int, default=3, metavar='N',
+        help="How many times to run each search (default: %(default)s)")
+    args = parser.parse_args()
+
+    dataset = datasets.Dataset("benchmark")
+    readGroupSet = reads.HtslibReadGroupSet(dataset, "benchmark")
+    readGroupSet.populateFromFile(args.bamFile, args.indexFile)
+    print("search\tseconds\treads\treads/second")
+    for name, function in [
+            ("pysam", pysamReads), ("converted", convertedReads)]:
+        times = []
+        for _ in range(args.repeatLimit):
+            elapsedTime, numReads = timeIteration(function(
+                readGroupSet, args.referenceName, args.start, args.end))
+            times.append(elapsedTime)
+        elapsedTime = min(times)
+        print("{}\t{:.3f}\t{}\t{:.0f}".format(
+            name, elapsedTime, numReads, numReads / elapsedTime))
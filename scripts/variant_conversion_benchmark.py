@@ -0,0 +1,138 @@
+"""
+Benchmarks the conversion of variants on a pool of worker processes,
+timing the same variants search with increasing numbers of workers.
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import json
+import multiprocessing
+import time
+
+import glue
+
+import ga4gh.schemas.protocol as protocol
+
+glue.ga4ghImportGlue()
+import ga4gh.server.backend as backend  # noqa
+import ga4gh.server.datamodel as datamodel  # noqa
+import ga4gh.server.datamodel.variants as variants  # noqa
+import ga4gh.server.datarepo as datarepo  # noqa
+
+
+def runSearch(theBackend, request):
+    """
+    Runs the specified search to completion, returning the number of
+    variants and pages returned.
+    """
+    request = protocol.SearchVariantsRequest.FromString(
+        request.SerializeToString())
+    numVariants = 0
+    numPages = 0
+    while True:
+        responseString = theBackend.runSearchRequest(
+            protocol.toJson(request), protocol.SearchVariantsRequest,
+            protocol.SearchVariantsResponse, theBackend.variantsGenerator)
+        # The page is read as plain JSON rather than parsed into a
+        # response message, which would take longer than the search.
+        response = json.loads(responseString)
+        numVariants += len(response.get("variants", []))
+        numPages += 1
+        if not response.get("nextPageToken"):
+            return numVariants, numPages
+        request.page_token = response["nextPageToken"]
+
+
+def benchmarkWorkers(theBackend, request, numWorkers, repeatLimit):
+    """
+    Returns the minimum wall clock time taken to run the specified search
+    with the specified number of workers, its number of variants and
+    pages, and the number of variants converted by the workers over all
+    runs and how many of these were returned.
+    """
+    theBackend.setVariantConversionWorkers(numWorkers)
+    pool = theBackend.getVariantConversionPool()
+    numWorkerVariants = pool.getNumWorkerVariants()
+    numUsedWorkerVariants = pool.getNumUsedWorkerVariants()
+    times = []
+    for _ in range(repeatLimit):
+        startTime = time.time()
+        numVariants, numPages = runSearch(theBackend, request)
+        times.append(time.time() - startTime)
+    theBackend.setVariantConversionWorkers(0)
+    numWorkerVariants = pool.getNumWorkerVariants() - numWorkerVariants
+    numUsedWorkerVariants = (
+        pool.getNumUsedWorkerVariants() - numUsedWorkerVariants)
+    return (
+        min(times), numVariants, numPages, numWorkerVariants,
+        numUsedWorkerVariants)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="GA4GH variant conversion worker benchmark")
+    parser.add_argument(
+        "registryDb", help="The registry database to use")
+    parser.add_argument(
+        "variantSetId", help="The variant set ID to run the query against")
+    parser.add_argument(
+        "--referenceName", default="1", help="The reference to search")
+    parser.add_argument(
+        "--start", type=int, default=0, help="The start of the search")
+    parser.add_argument(
+        "--end", type=int, default=10**7, help="The end of the search")
+    parser.add_argument(
+        "--pageSize", type=int, default=1000,
+        help="The number of variants per page (default: %(default)s)")
+    parser.add_argument(
+        "--minShardSize", type=int, default=10000,
+        help="The minimum number of bases converted by each worker "
+             "(default: %(default)s)")
+    parser.add_argument(
+        "--maxWorkers", type=int, default=multiprocessing.cpu_count(),
+        help="The largest number of workers to time "
+             "(default: %(default)s)")
+    parser.add_argument(
+        "--repeatLimit", type=int, default=3, metavar='N',
+        help="How many times to run each search (default: %(default)s)")
+    parser.add_argument(
+        "--engine", default="pysam",
+        help="The variant engine to use (default: %(default)s)")
+    parser.add_argument(
+        "--allCallSets", action="store_true",
+        help="Request the calls of all call sets in the variant set")
+    args = parser.parse_args()
+
+    repo = datarepo.SqlDataRepository(args.registryDb)
+    repo.open(datarepo.MODE_READ)
+    variants.setDefaultVariantEngine(args.engine)
+    theBackend = backend.Backend(repo)
+    theBackend.setMaxResponseLength(2**30)
+    theBackend.setVariantConversionMinShardSize(args.minShardSize)
+    request = protocol.SearchVariantsRequest()
+    request.variant_set_id = args.variantSetId
+    request.reference_name = args.referenceName
+    request.start = args.start
+    request.end = args.end
+    request.page_size = args.pageSize
+    if args.allCallSets:
+        compoundId = datamodel.VariantSetCompoundId.parse(args.variantSetId)
+        variantSet = repo.getDataset(compoundId.dataset_id).getVariantSet(
+            compoundId.variant_set_id)
+        request.call_set_ids.extend(
+            callSet.getId() for callSet in variantSet.getCallSets())
+
+    serialTime = None
+    print("workers\tseconds\tspeedup\tvariants\tpages\tworker variants"
+          "\tused")
+    for numWorkers in range(args.maxWorkers + 1):
+        (elapsedTime, numVariants, numPages, numWorkerVariants,
+            numUsedWorkerVariants) = benchmarkWorkers(
+                theBackend, request, numWorkers, args.repeatLimit)
+        if serialTime is None:
+            serialTime = elapsedTime
+        print("{}\t{:.3f}\t{:.2f}\t{}\t{}\t{}\t{}".format(
+            numWorkers, elapsedTime, serialTime / elapsedTime, numVariants,
+            numPages, numWorkerVariants, numUsedWorkerVariants))
@@ -58,3 +58,27 @@ class OntologyTest(datadriven.DataDrivenTest):
     def testBadMappings(self):
         for badName in ["Not a term", None, 1234]:
             self.assertEqual(0, len(self._gaObject.getTermIds(badName)))
+
+    def testSharedTerms(self):
+        ontology = self._gaObject
+        for term in self._oboReader:
+            sharedTerm = ontology.getSharedGaTermByName(term.name)
+            self.assertIs(
+                ontology.getSharedGaTermByName(term.name), sharedTerm)
+            gaTerm = ontology.getGaTermByName(term.name)
+            self.assertEqual(gaTerm, sharedTerm)
+            self.assertEqual(sharedTerm.term_id, ontology.getTermIds(
+                term.name)[0])
+            # Changes to the returned term do not affect the shared term
+            gaTerm.term_id = "changed"
+            self.assertNotEqual(gaTerm, sharedTerm)
+        unknownTerm = ontology.getSharedGaTermByName("Not a term")
+        self.assertEqual(unknownTerm.term, "Not a term")
+        self.assertEqual(unknownTerm.term_id, "")
+
+    def testTermNames(self):
+        ontology = self._gaObject
+        for term in self._oboReader:
+            termId = ontology.getSharedGaTermByName(term.name).term_id
+            self.assertIn(term.name, ontology.getTermNames(termId))
+        self.assertEqual(ontology.getTermNames("Not an ID"), [])
@@ -14,6 +14,7 @@ import ga4gh.server.datamodel.datasets as datasets
 import ga4gh.server.datamodel.reads as reads
 import ga4gh.server.datamodel.references as references
 import ga4gh.server.datarepo as datarepo
+import ga4gh.server.paging as paging
 import tests.datadriven as datadriven
 import tests.paths as paths
 
@@ -301,6 +302,100 @@ class ReadGroupSetTest(datadriven.DataDrivenTest):
                 self.assertGetReadAlignmentsRangeResult(
                     readGroup, reference, begin, begin, 0)
 
+    def testSeekablePageTokens(self):
+        # test that resuming from seekable page tokens gives the same
+        # alignments as resuming from the equivalent standard tokens
+        readGroupSet = self._gaObject
+        for readGroup in readGroupSet.getReadGroups():
+            readGroupInfo = self._readGroupInfos[readGroup.getLocalId()]
+            for name in readGroupInfo.mappedReads.keys():
+                reference = self._referenceSet.getReferenceByName(name)
+                request = protocol.SearchReadsRequest()
+                request.start = 0
+                request.end = 2**30
+                expected = list(paging.ReadsIntervalIterator(
+                    request, readGroup, reference))
+                seekable = list(paging.ReadsIntervalIterator(
+                    request, readGroup, reference, seekablePageTokens=True))
+                self.assertEqual(
+                    [read for read, _ in expected],
+                    [read for read, _ in seekable])
+                step = max(1, len(seekable) // 10)
+                for index in range(0, len(seekable) - 1, step):
+                    pageToken = seekable[index][1]
+                    self.assertEqual(len(pageToken.split(":")), 3)
+                    self.assertEqual(
+                        pageToken.rsplit(":", 1)[0], expected[index][1])
+                    request.page_token = pageToken
+                    resumed = paging.ReadsIntervalIterator(
+                        request, readGroup, reference,
+                        seekablePageTokens=True)
+                    self.assertEqual(
+                        [read for read, _ in expected[index + 1:]],
+                        [read for read, _ in resumed])
+
+    def testReadGroupIndex(self):
+        # test that searches through a read group index give the same
+        # alignments as searches that filter every read in the range
+        readGroupSet = self._gaObject
+        for readGroup in readGroupSet.getReadGroups():
+            readGroupInfo = self._readGroupInfos[readGroup.getLocalId()]
+            for name in readGroupInfo.mappedReads.keys():
+                reference = self._referenceSet.getReferenceByName(name)
+                readGroupSet._readGroupIndex = None
+                readGroupSet._readGroupIndexLoaded = True
+                expected = list(readGroup.getReadAlignments(reference))
+                readGroupSet._readGroupIndex = \
+                    readGroupSet.buildReadGroupIndex(100)
+                self.assertEqual(
+                    expected,
+                    list(readGroup.getReadAlignments(reference)))
+                if len(expected) < 2:
+                    continue
+                start = expected[1].alignment.position.position
+                readGroupSet._readGroupIndex = None
+                expected = list(readGroup.getReadAlignments(
+                    reference, start, 2**30))
+                readGroupSet._readGroupIndex = \
+                    readGroupSet.buildReadGroupIndex(100)
+                self.assertEqual(
+                    expected,
+                    list(readGroup.getReadAlignments(
+                        reference, start, 2**30)))
+        readGroupSet._readGroupIndex = None
+        readGroupSet._readGroupIndexLoaded = False
+
+    def testReadSampler(self):
+        # test that sampled searches return the sampled reads of the
+        # unsampled search, and that their page tokens resume them
+        readGroupSet = self._gaObject
+        for readSampler in [
+                reads.ReadSampler(maxDepth=1),
+                reads.ReadSampler(fraction=0.5),
+                reads.ReadSampler(maxDepth=2, fraction=0.5)]:
+            for readGroup in readGroupSet.getReadGroups():
+                readGroupInfo = self._readGroupInfos[readGroup.getLocalId()]
+                for name in readGroupInfo.mappedReads.keys():
+                    reference = self._referenceSet.getReferenceByName(name)
+                    request = protocol.SearchReadsRequest()
+                    request.start = 0
+                    request.end = 2**30
+                    expected = list(readSampler.sampleReadAlignments(
+                        readGroup.getReadAlignments(reference)))
+                    sampled = list(paging.ReadsIntervalIterator(
+                        request, readGroup, reference, True, readSampler))
+                    self.assertEqual(
+                        expected, [read for read, _ in sampled])
+                    step = max(1, len(sampled) // 10)
+                    for index in range(0, len(sampled) - 1, step):
+                        request.page_token = sampled[index][1]
+                        resumed = paging.ReadsIntervalIterator(
+                            request, readGroup, reference, True,
+                            readSampler)
+                        self.assertEqual(
+                            expected[index + 1:],
+                            [read for read, _ in resumed])
+
     def assertGetReadAlignmentsRangeResult(
             self, readGroup, reference, start, end, result):
         alignments = list(readGroup.getReadAlignments(reference, start, end))
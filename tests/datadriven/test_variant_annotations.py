@@ -335,3 +335,74 @@ class VariantAnnotationSetTest(datadriven.DataDrivenTest):
             self.assertTrue(
                 self._pyvcfVariantAnnotationIsInGaVariantAnnotations(
                     variant, variantEnd-1, variantEnd+1))
+
+    def testEffectFilter(self):
+        end = datamodel.PysamDatamodelMixin.vcfMax
+        for referenceName in self._referenceNames:
+            ontology = self._gaObject.getOntology()
+            pairs = list(self._gaObject.getVariantAnnotations(
+                referenceName, 0, end))
+            effectTerms = {}
+            for gaVariant, gaAnnotation in pairs:
+                for gaEffect in gaAnnotation.transcript_effects:
+                    for term in gaEffect.effects:
+                        if term.term_id != "":
+                            effectTerms[term.term_id] = term
+            for termId, term in effectTerms.items():
+                requestedEffect = ontology.getGaTermByName(term.term)
+                expected = []
+                for gaVariant, gaAnnotation in pairs:
+                    gaEffects = [
+                        gaEffect for gaEffect in
+                        gaAnnotation.transcript_effects
+                        if termId in [t.term_id for t in gaEffect.effects]]
+                    if len(gaEffects) > 0:
+                        expected.append((gaAnnotation.id, gaEffects))
+                filtered = list(self._gaObject.getVariantAnnotations(
+                    referenceName, 0, end, [requestedEffect]))
+                self.assertEqual(len(filtered), len(expected))
+                for (gaVariant, gaAnnotation), (annotationId, gaEffects) in \
+                        zip(filtered, expected):
+                    # Filtering does not change the annotation ID
+                    self.assertEqual(gaAnnotation.id, annotationId)
+                    self.assertEqual(
+                        list(gaAnnotation.transcript_effects), gaEffects)
+            unknownEffect = protocol.OntologyTerm()
+            unknownEffect.term_id = "NOT:AN_ID"
+            self.assertEqual(0, len(list(self._gaObject.getVariantAnnotations(
+                referenceName, 0, end, [unknownEffect]))))
+
+    def testEffectIndex(self):
+        end = datamodel.PysamDatamodelMixin.vcfMax
+        annotationSet = self._gaObject
+        for referenceName in self._referenceNames:
+            effectNames = set()
+            for gaVariant, gaAnnotation in annotationSet.getVariantAnnotations(
+                    referenceName, 0, end):
+                for gaEffect in gaAnnotation.transcript_effects:
+                    for term in gaEffect.effects:
+                        if term.term_id != "":
+                            effectNames.add(term.term)
+            ontology = annotationSet.getOntology()
+            searches = [
+                ([ontology.getGaTermByName(name)], start, searchEnd)
+                for name in effectNames
+                for start, searchEnd in [(0, end), (100000, 20000000)]]
+            expected = [
+                list(annotationSet.getVariantAnnotations(
+                    referenceName, start, searchEnd, effects))
+                for effects, start, searchEnd in searches]
+            # Small bins so that searches read many regions.
+            pairs = annotationSet.getVariantSet().getDataUrlIndexPairs()
+            for pair in pairs:
+                annotationSet._effectIndexes[pair] = \
+                    annotationSet.buildEffectIndex(pair, 1000)
+            try:
+                for (effects, start, searchEnd), expectedPairs in zip(
+                        searches, expected):
+                    self.assertEqual(
+                        list(annotationSet.getVariantAnnotations(
+                            referenceName, start, searchEnd, effects)),
+                        expectedPairs)
+            finally:
+                annotationSet._effectIndexes.clear()
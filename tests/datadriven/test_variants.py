@@ -8,6 +8,7 @@ from __future__ import unicode_literals
 import os
 import glob
 import hashlib
+import unittest
 
 import vcf
 
@@ -473,6 +474,58 @@ class VariantSetTest(datadriven.DataDrivenTest):
                 for call, someId in zip(record.calls, somecall_set_ids):
                     self.assertEqual(call.call_set_id, someId)
 
+    def testGetGenotypeMatrix(self):
+        variantSet = self._gaObject
+        end = datamodel.PysamDatamodelMixin.vcfMax
+        callSets = variantSet.getCallSets()[::-1]
+        callSetIds = [callSet.getId() for callSet in callSets]
+        for reference_name in self._reference_names:
+            pyvcfVariants = self._getPyvcfVariants(reference_name)
+            gtVariants = list(variantSet.getGenotypeMatrix(
+                reference_name, 0, end, callSetIds))
+            self.assertEqual(len(gtVariants), len(pyvcfVariants))
+            for gtVariant, pyvcfVariant in zip(gtVariants, pyvcfVariants):
+                genotypeMatrix, variant, _ = gtVariant
+                self.assertEqual(variant.start, pyvcfVariant.start)
+                self.assertEqual(len(variant.calls), 0)
+                expected = []
+                for callSet in callSets:
+                    genotype = convertVCFGenotype(pyvcfVariant.genotype(
+                        callSet.getSampleName()).data.GT)
+                    expected.append(variants.convertGenotypeAlleles(tuple(
+                        None if allele == -1 else allele
+                        for allele in genotype)))
+                self.assertEqual(list(genotypeMatrix.genotypes), expected)
+
+    @unittest.skipIf(variants.cyvcf2 is None, "cyvcf2 not installed")
+    def testCyvcf2EngineParity(self):
+        variantSet = self._gaObject
+        end = datamodel.PysamDatamodelMixin.vcfMax
+        callSetIds = [
+            callSet.getId() for callSet in variantSet.getCallSets()][::-1]
+        for reference_name in self._reference_names:
+            expected = []
+            for engine in variants.VARIANT_ENGINES:
+                variantSet.setVariantEngine(engine)
+                gaVariants = list(variantSet.getVariants(
+                    reference_name, 0, end, callSetIds))
+                genotypes = [
+                    list(genotypeMatrix.genotypes)
+                    for genotypeMatrix, _, _ in variantSet.getGenotypeMatrix(
+                        reference_name, 0, end, callSetIds)]
+                if len(expected) == 0:
+                    expected = [gaVariants, genotypes]
+                else:
+                    self.assertEqual([gaVariants, genotypes], expected)
+        variantSet.setVariantEngine(None)
+
+    def testVariantEngine(self):
+        variantSet = self._gaObject
+        self.assertEqual(
+            variantSet.getVariantEngine(), variants.VARIANT_ENGINE_PYSAM)
+        with self.assertRaises(exceptions.ConfigurationException):
+            variantSet.setVariantEngine("vcflib")
+
     def testGetVariant(self):
         variantSet = self._gaObject
         for reference_name in self._reference_names:
@@ -511,6 +564,79 @@ class VariantSetTest(datadriven.DataDrivenTest):
                 with self.assertRaises(exceptions.ObjectNotFoundException):
                     variantSet.getVariant(compoundId)
 
+    def testGetVariantCached(self):
+        variantSet = self._gaObject
+        end = datamodel.PysamDatamodelMixin.vcfMax
+        for reference_name in self._reference_names:
+            for variant in variantSet.getVariants(
+                    reference_name, 0, end, variantSet._callSetIds):
+                compoundId = datamodel.VariantCompoundId.parse(variant.id)
+                gotVariant = variantSet.getVariant(compoundId)
+                self.assertEqual(gotVariant, variant)
+                # Changes to the returned variant do not affect the cache
+                gotVariant.names.append("changed")
+                self.assertEqual(variantSet.getVariant(compoundId), variant)
+
+    def testVariantBlockCache(self):
+        variantSet = self._gaObject
+        callSetIds = [
+            callSet.getId() for callSet in variantSet.getCallSets()][:2]
+        cache = variants.variantBlockCache
+        try:
+            for reference_name in self._reference_names:
+                allVariants = list(variantSet.getVariants(
+                    reference_name, 0, 2**30, callSetIds))
+                for variant in allVariants[::7]:
+                    for start, end in [
+                            (variant.start, variant.end),
+                            (variant.start - 150, variant.start + 1400),
+                            (variant.end - 1, variant.end + 40)]:
+                        cache.setMaxBytes(0)
+                        expected = list(variantSet.getVariants(
+                            reference_name, start, end, callSetIds))
+                        cache.setMaxBytes(2**20)
+                        cache.setBinSize(100)
+                        for _ in range(2):
+                            self.assertEqual(list(variantSet.getVariants(
+                                reference_name, start, end, callSetIds)),
+                                expected)
+            self.assertGreater(cache.getNumHits(), 0)
+        finally:
+            cache.setMaxBytes(0)
+            cache.setBinSize(10000)
+
+    def testVariantFilter(self):
+        variantSet = self._gaObject
+        end = datamodel.PysamDatamodelMixin.vcfMax
+        for reference_name in self._reference_names:
+            allVariants = list(variantSet.getVariants(
+                reference_name, 0, end, []))
+            predicates = []
+            for key, value in allVariants[0].attributes.attr.items():
+                value = protocol.getValueFromValue(value.values[0])
+                if isinstance(value, bool):
+                    predicates.append(key)
+                elif isinstance(value, (int, float)):
+                    predicates.append("{}<={}".format(key, value))
+                else:
+                    predicates.append("{}={}".format(key, value))
+            for infoPredicates in [[], predicates[:1], predicates]:
+                for passOnly in [False, True]:
+                    variantFilter = variants.VariantFilter(
+                        infoPredicates, passOnly)
+                    expected = [
+                        variant for variant in allVariants
+                        if variantFilter.matchesVariant(variant)]
+                    self.assertEqual(list(variantSet.getVariants(
+                        reference_name, 0, end, [], variantFilter)),
+                        expected)
+                    seekableVariants = variantSet.getSeekableVariants(
+                        reference_name, 0, end, [], None, variantFilter)
+                    if seekableVariants is not None:
+                        self.assertEqual(
+                            [variant for _, variant in seekableVariants],
+                            expected)
+
     def _hashVariant(self, record):
         if record.ALT[0] is None:
             alts = tuple()
@@ -128,6 +128,70 @@ class TestCompoundIds(unittest.TestCase):
             with self.assertRaises(exceptions.BadIdentifierException):
                 ExampleCompoundId.parse(badType)
 
+    def testParseCache(self):
+        obfuscated = datamodel.CompoundId.obfuscate('["a","b","c"]')
+        parseCache = datamodel.LruCache(maxSize=1)
+        self.assertIsNone(parseCache.get((ExampleCompoundId, obfuscated)))
+        compoundId = ExampleCompoundId.parse(obfuscated)
+        parseCache.put((ExampleCompoundId, obfuscated), compoundId)
+        self.assertIs(
+            parseCache.get((ExampleCompoundId, obfuscated)), compoundId)
+        parseCache.put((ExampleCompoundId, "other"), compoundId)
+        self.assertEqual(len(parseCache), 1)
+        self.assertIsNone(parseCache.get((ExampleCompoundId, obfuscated)))
+        parseCache.setMaxSize(0)
+        self.assertEqual(len(parseCache), 0)
+        parseCache.put((ExampleCompoundId, obfuscated), compoundId)
+        self.assertEqual(len(parseCache), 0)
+        with self.assertRaises(ValueError):
+            parseCache.setMaxSize(-1)
+
+    def testParseCached(self):
+        obfuscated = datamodel.CompoundId.obfuscate('["a","b","c"]')
+        compoundId = ExampleCompoundId.parse(obfuscated)
+        self.assertIs(ExampleCompoundId.parse(obfuscated), compoundId)
+        self.assertEqual(compoundId.baz, "c")
+        # The cache is keyed by class as well as the ID string
+        obfuscated = datamodel.CompoundId.obfuscate('["a","vs","b"]')
+        self.assertIsInstance(
+            datamodel.VariantSetCompoundId.parse(obfuscated),
+            datamodel.VariantSetCompoundId)
+        with self.assertRaises(exceptions.ObjectWithIdNotFoundException):
+            datamodel.DatasetCompoundId.parse(obfuscated)
+
+    def testFormatter(self):
+        # The name lengths cover each alignment of the base64 encoding
+        for name in ["a", "ab", "abc", 'q"uote', "\u00fcni"]:
+            dataset = datasets.Dataset(name)
+            readGroupSet = reads.AbstractReadGroupSet(dataset, name)
+            featureSet = sequence_annotations.AbstractFeatureSet(
+                dataset, name)
+            variantSet = variants.AbstractVariantSet(dataset, name)
+            for localId in ["x", 'y"', "\u00e9t\u00e9"]:
+                for parent, compoundIdClass, localIds in [
+                        (dataset, datamodel.VariantSetCompoundId,
+                         [localId]),
+                        (readGroupSet, datamodel.ReadAlignmentCompoundId,
+                         [localId]),
+                        (featureSet, datamodel.FeatureCompoundId,
+                         [localId]),
+                        (variantSet, datamodel.VariantCompoundId,
+                         [localId, "100", "md5"])]:
+                    compoundId = compoundIdClass(
+                        parent.getCompoundId(), *localIds)
+                    formatter = parent.getChildIdFormatter(compoundIdClass)
+                    self.assertEqual(
+                        formatter.format(*localIds), str(compoundId))
+                    self.assertIs(
+                        parent.getChildIdFormatter(compoundIdClass),
+                        formatter)
+        formatter = variantSet.getChildIdFormatter(
+            datamodel.VariantCompoundId)
+        with self.assertRaises(ValueError):
+            formatter.format("a")
+        with self.assertRaises(exceptions.BadIdentifierNotStringException):
+            formatter.format("a", 100, "md5")
+
     def verifyParseFailure(self, idStr, compoundIdClass):
         """
         Verifies that substrings and superstrings of the specified parsing
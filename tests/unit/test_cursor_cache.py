@@ -0,0 +1,227 @@
+"""
+Tests for the cursor cache used to hold in-flight searches
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+import ga4gh.server.backend as backend
+import ga4gh.server.datamodel as datamodel
+import ga4gh.server.datarepo as datarepo
+import ga4gh.server.paging as paging
+import tests.paths as paths
+
+import ga4gh.schemas.protocol as protocol
+
+
+class FailingIterator(object):
+    """
+    An iterator over search results that fails with a conversion error.
+    """
+    def __iter__(self):
+        return self
+
+    def next(self):
+        raise ValueError("conversion failed")
+
+
+class TestCursorCache(unittest.TestCase):
+    """
+    Tests the storage and eviction of cursors
+    """
+    def setUp(self):
+        self.cursorCache = paging.CursorCache(maxSize=2)
+        self.iterator = iter([])
+
+    def testStatelessToken(self):
+        iterator, pageToken = self.cursorCache.take("fingerprint", "10:2")
+        self.assertIsNone(iterator)
+        self.assertEqual(pageToken, "10:2")
+
+    def testPutTake(self):
+        token = self.cursorCache.put("fingerprint", self.iterator, "10:2")
+        self.assertNotEqual(token, "10:2")
+        self.assertEqual(len(self.cursorCache), 1)
+        iterator, pageToken = self.cursorCache.take("fingerprint", token)
+        self.assertIs(iterator, self.iterator)
+        self.assertEqual(pageToken, "10:2")
+        # Cursors can only be used once
+        self.assertEqual(len(self.cursorCache), 0)
+        iterator, pageToken = self.cursorCache.take("fingerprint", token)
+        self.assertIsNone(iterator)
+        self.assertEqual(pageToken, "10:2")
+
+    def testFingerprintMismatch(self):
+        token = self.cursorCache.put("fingerprint", self.iterator, "10:2")
+        iterator, pageToken = self.cursorCache.take("other", token)
+        self.assertIsNone(iterator)
+        self.assertEqual(pageToken, "10:2")
+
+    def testMaxSize(self):
+        tokens = [
+            self.cursorCache.put("fingerprint", self.iterator, str(j))
+            for j in range(3)]
+        self.assertEqual(len(self.cursorCache), 2)
+        iterator, pageToken = self.cursorCache.take("fingerprint", tokens[0])
+        self.assertIsNone(iterator)
+        self.assertEqual(pageToken, "0")
+        for token in tokens[1:]:
+            iterator, _ = self.cursorCache.take("fingerprint", token)
+            self.assertIs(iterator, self.iterator)
+
+    def testTimeToLive(self):
+        self.cursorCache.setTimeToLive(0)
+        token = self.cursorCache.put("fingerprint", self.iterator, "1")
+        iterator, pageToken = self.cursorCache.take("fingerprint", token)
+        self.assertIsNone(iterator)
+        self.assertEqual(pageToken, "1")
+
+    def testSetMaxSize(self):
+        self.assertTrue(self.cursorCache.isEnabled())
+        self.cursorCache.put("fingerprint", self.iterator, "1")
+        self.cursorCache.setMaxSize(0)
+        self.assertFalse(self.cursorCache.isEnabled())
+        self.assertEqual(len(self.cursorCache), 0)
+        with self.assertRaises(ValueError):
+            self.cursorCache.setMaxSize(-1)
+
+
+class TestCursorCacheSearches(unittest.TestCase):
+    """
+    Tests that searches resumed from cursors return the same results as
+    searches resumed from stateless page tokens.
+    """
+    def setUp(self):
+        dataRepository = datarepo.SqlDataRepository(paths.testDataRepo)
+        dataRepository.open(datarepo.MODE_READ)
+        self.backend = backend.Backend(dataRepository)
+        self.backend.setCursorCacheMaxSize(10)
+        dataset = dataRepository.getDatasets()[0]
+        self.variantSet = dataset.getVariantSets()[0]
+        self.readGroupSet = dataset.getReadGroupSetByName("HG00096")
+        self.fileHandleCache = datamodel.fileHandleCache
+        datamodel.fileHandleCache = datamodel.PysamFileHandleCache()
+
+    def tearDown(self):
+        datamodel.fileHandleCache = self.fileHandleCache
+
+    def _getVariantsRequest(self, pageSize):
+        request = protocol.SearchVariantsRequest()
+        request.variant_set_id = self.variantSet.getId()
+        request.reference_name = "1"
+        request.start = 0
+        request.end = 2**30
+        request.page_size = pageSize
+        return request
+
+    def _getReadsRequest(self, pageSize):
+        request = protocol.SearchReadsRequest()
+        request.read_group_ids.extend(self.readGroupSet.getReadGroupIds())
+        request.reference_id = self.readGroupSet.getReferenceSet(
+            ).getReferenceByName("1").getId()
+        request.start = 0
+        request.end = 2**30
+        request.page_size = pageSize
+        return request
+
+    def _runVariantsSearch(self, request):
+        responseStr = self.backend.runSearchRequest(
+            protocol.toJson(request), protocol.SearchVariantsRequest,
+            protocol.SearchVariantsResponse, self.backend.variantsGenerator)
+        return protocol.fromJson(
+            responseStr, protocol.SearchVariantsResponse)
+
+    def _runReadsSearch(self, request):
+        responseStr = self.backend.runSearchRequest(
+            protocol.toJson(request), protocol.SearchReadsRequest,
+            protocol.SearchReadsResponse, self.backend.readsGenerator)
+        return protocol.fromJson(responseStr, protocol.SearchReadsResponse)
+
+    def _getAllVariants(self):
+        request = self._getVariantsRequest(1000)
+        response = self._runVariantsSearch(request)
+        self.assertEqual(response.next_page_token, "")
+        return list(response.variants)
+
+    def testResumeFromCursors(self):
+        expected = self._getAllVariants()
+        request = self._getVariantsRequest(7)
+        variants = []
+        while True:
+            response = self._runVariantsSearch(request)
+            variants.extend(response.variants)
+            if not response.next_page_token:
+                break
+            self.assertIn(paging.CursorCache.separator,
+                          response.next_page_token)
+            request.page_token = response.next_page_token
+            # Interleave another search over the same file
+            self._getAllVariants()
+        self.assertEqual(variants, expected)
+        self.assertEqual(len(self.backend._cursorCache), 0)
+
+    def testResumeInterleavedReads(self):
+        requests = [self._getReadsRequest(3), self._getReadsRequest(4)]
+        results = [[], []]
+        while any(request is not None for request in requests):
+            for j, request in enumerate(requests):
+                if request is None:
+                    continue
+                response = self._runReadsSearch(request)
+                results[j].extend(response.alignments)
+                request.page_token = response.next_page_token
+                if not response.next_page_token:
+                    requests[j] = None
+        self.assertGreater(len(results[0]), 0)
+        self.assertEqual(results[0], results[1])
+
+    def testEvictedCursor(self):
+        expected = self._getAllVariants()
+        request = self._getVariantsRequest(7)
+        response = self._runVariantsSearch(request)
+        variants = list(response.variants)
+        self.backend.setCursorCacheMaxSize(0)
+        self.backend.setCursorCacheMaxSize(10)
+        request.page_token = response.next_page_token
+        response = self._runVariantsSearch(request)
+        variants.extend(response.variants)
+        self.assertEqual(variants, expected[:14])
+
+    def testClosedFileHandle(self):
+        expected = self._getAllVariants()
+        request = self._getVariantsRequest(7)
+        response = self._runVariantsSearch(request)
+        variants = list(response.variants)
+        # Close the variant file, as if evicted from the file handle cache
+        dataUrlIndexPair = self.variantSet.getReferenceToDataUrlIndexMap()[
+            "1"]
+        self.variantSet.getFileHandle(dataUrlIndexPair).close()
+        datamodel.fileHandleCache = datamodel.PysamFileHandleCache()
+        request.page_token = response.next_page_token
+        response = self._runVariantsSearch(request)
+        variants.extend(response.variants)
+        self.assertEqual(variants, expected[:14])
+
+    def testCursorErrorsRaised(self):
+        # Errors other than a closed file handle are not hidden by
+        # resuming the search from the stateless page token.
+        request = self._getVariantsRequest(7)
+        response = self._runVariantsSearch(request)
+        cursorId = response.next_page_token.split(
+            paging.CursorCache.separator)[0]
+        expiryTime, fingerprint, _ = self.backend._cursorCache._cursors[
+            cursorId]
+        self.backend._cursorCache._cursors[cursorId] = (
+            expiryTime, fingerprint, FailingIterator())
+        request.page_token = response.next_page_token
+        with self.assertRaises(ValueError):
+            self._runVariantsSearch(request)
+
+    def testCursorsDisabled(self):
+        self.backend.setCursorCacheMaxSize(0)
+        request = self._getVariantsRequest(7)
+        response = self._runVariantsSearch(request)
+        self.assertNotIn(paging.CursorCache.separator,
+                         response.next_page_token)
@@ -6,13 +6,17 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import distutils.version
 import os
 import shutil
 import tempfile
 import unittest
 import uuid
 
+import pysam
+
 import ga4gh.server.datamodel as datamodel
+import ga4gh.server.exceptions as exceptions
 
 
 class TestFileHandleCache(datamodel.PysamFileHandleCache, unittest.TestCase):
@@ -58,9 +62,92 @@ class TestFileHandleCache(datamodel.PysamFileHandleCache, unittest.TestCase):
         self.assertNotEqual(self._cache[topIndex][0], fileList[1])
         self.assertEquals(self._cache[0][0], fileList[1])
 
+    def testDecompressionThreads(self):
+        openedThreads = {}
+
+        def openMethod(dataFile, threads):
+            openedThreads[dataFile] = threads
+            return open(dataFile, 'w')
+
+        self.setMaxCacheSize(3)
+        self.setDecompressionThreads(4, 10)
+        fileList = [
+            os.path.join(self._tempdir, str(uuid.uuid4()))
+            for _ in range(5)]
+        for dataFile in fileList[:3]:
+            self.getFileHandle(dataFile, openMethod, True)
+        # The third file gets the two threads left in the budget
+        self.assertEqual(
+            [openedThreads[dataFile] for dataFile in fileList[:3]],
+            [4, 4, 2])
+        self.assertEqual(self.getThreadsInUse(), 10)
+        # Opening a fourth file evicts the first, but the budget is spent
+        # when the fourth is opened
+        self.getFileHandle(fileList[3], openMethod, True)
+        self.assertEqual(openedThreads[fileList[3]], 0)
+        self.assertEqual(self.getThreadsInUse(), 6)
+        self.getFileHandle(fileList[4], openMethod, True)
+        self.assertEqual(openedThreads[fileList[4]], 4)
+        self.assertEqual(self.getThreadsInUse(), 6)
+        # Opening a file without threads evicts the third file, releasing
+        # its threads
+        self._getFileHandle(fileList[0])
+        self.assertEqual(self.getThreadsInUse(), 4)
+
+    def testSharedDecompressionThreadBudget(self):
+        openedThreads = []
+
+        def openMethod(dataFile, threads):
+            openedThreads.append(threads)
+            return open(dataFile, 'w')
+
+        self.setDecompressionThreads(4, 6)
+        otherCache = datamodel.PysamFileHandleCache(
+            self.getDecompressionThreadBudget())
+        self.assertEqual(otherCache.getDecompressionThreads(), (4, 6))
+        dataFile = os.path.join(self._tempdir, str(uuid.uuid4()))
+        self.getFileHandle(dataFile, openMethod, True)
+        otherCache.getFileHandle(dataFile, openMethod, True)
+        self.assertEqual(openedThreads, [4, 2])
+        self.assertEqual(self.getThreadsInUse(), 4)
+        self.assertEqual(otherCache.getThreadsInUse(), 2)
+        self.assertEqual(
+            self.getDecompressionThreadBudget().getThreadsInUse(), 6)
+
+    def testFailedOpenReleasesThreads(self):
+        def openMethod(dataFile, threads):
+            raise ValueError()
+
+        self.setDecompressionThreads(4, 4)
+        dataFile = os.path.join(self._tempdir, str(uuid.uuid4()))
+        self.assertRaises(
+            exceptions.FileOpenFailedException, self.getFileHandle,
+            dataFile, openMethod, True)
+        self.assertEqual(
+            self.getDecompressionThreadBudget().getThreadsInUse(), 0)
+
+    def testSetDecompressionThreads(self):
+        self.assertEqual(self.getDecompressionThreads(), (0, 0))
+        self.assertRaises(ValueError, self.setDecompressionThreads, -1, 4)
+        self.assertRaises(ValueError, self.setDecompressionThreads, 4, -1)
+
     def testSetCacheMaxSize(self):
         self.assertRaises(ValueError, self.setMaxCacheSize, 0)
         self.assertRaises(ValueError, self.setMaxCacheSize, -1)
 
     def tearDown(self):
         shutil.rmtree(self._tempdir)
+
+
+class TestAcceptsThreadsArgument(unittest.TestCase):
+    """
+    Tests that the files of pysam accept the threads argument from the
+    release documented as the first to support it.
+    """
+    def testInstalledPysam(self):
+        expected = (
+            distutils.version.LooseVersion(pysam.__version__) >=
+            distutils.version.LooseVersion("0.15.0"))
+        for fileClass in [pysam.AlignmentFile, pysam.VariantFile]:
+            self.assertEqual(
+                datamodel.acceptsThreadsArgument(fileClass), expected)
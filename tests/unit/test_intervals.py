@@ -127,6 +127,48 @@ class TrivialIntervalIterator(paging.IntervalIterator):
         return interval[1]
 
 
+class SeekableIntervalIterator(TrivialIntervalIterator):
+    """
+    An interval iterator that uses the position of intervals within
+    the interval set as virtual offsets, so that iteration can be
+    resumed directly from seekable page tokens.
+    """
+    def __init__(self, intervalSet, start, end, pageToken=None):
+        self.intervalSet = intervalSet
+        self.numSeeks = 0
+        request = FakeRequest(start, end, pageToken)
+        super(TrivialIntervalIterator, self).__init__(
+            request, None, seekablePageTokens=True)
+
+    def _seekableSearch(self, start, end, virtualOffset=None):
+        intervals = self.intervalSet.intervals
+        if virtualOffset is None:
+            virtualOffset = 0
+        else:
+            self.numSeeks += 1
+        return (
+            (offset, intervals[offset])
+            for offset in range(virtualOffset, len(intervals))
+            if intervalsIntersect(start, end, *intervals[offset]))
+
+
+class UnreadableOffsetIntervalIterator(SeekableIntervalIterator):
+    """
+    A seekable interval iterator for which reading from any virtual
+    offset fails, as htslib does when an offset falls mid-record.
+    """
+    def _seekableSearch(self, start, end, virtualOffset=None):
+        if virtualOffset is None:
+            return super(UnreadableOffsetIntervalIterator,
+                         self)._seekableSearch(start, end, virtualOffset)
+        self.numSeeks += 1
+        return self._failingSearch()
+
+    def _failingSearch(self):
+        raise IOError("error reading record")
+        yield
+
+
 class TestIntervalIterator(unittest.TestCase):
     """
     A class to systematically test the paging code over interval search
@@ -155,12 +197,14 @@ class TestIntervalIterator(unittest.TestCase):
         self.testIntervalSets.append(
             IntervalSet(0, 100, randomIntervals(0, 100, 100)))
 
-    def verifyInterval(self, intervalSet, start, end):
+    def verifyInterval(
+            self, intervalSet, start, end,
+            iteratorClass=TrivialIntervalIterator):
         """
         Verify that we can pick up iteration of the interval from
         anywhere by starting a new iterator from every point.
         """
-        topIterator = list(TrivialIntervalIterator(intervalSet, start, end))
+        topIterator = list(iteratorClass(intervalSet, start, end))
         allIntervals = list(intervalSet.get(start, end))
         topIntervals = []
         for topInterval, topPageToken in topIterator[:-1]:
@@ -168,7 +212,7 @@ class TestIntervalIterator(unittest.TestCase):
             self.assertIsNotNone(topPageToken)
             # We should be able to pick the iteration up from here and go
             # forward, getting the same set of intervals
-            subIterator = TrivialIntervalIterator(
+            subIterator = iteratorClass(
                 intervalSet, start, end, topPageToken)
             subIntervals = list(topIntervals)
             for subInterval, subPageToken in subIterator:
@@ -252,3 +296,65 @@ class TestIntervalIterator(unittest.TestCase):
                     self.verifyEmptyInterval(intervalSet, start, end)
                 else:
                     self.verifyInterval(intervalSet, start, end)
+
+    def testSeekablePageTokens(self):
+        for intervalSet in self.testIntervalSets:
+            self.verifyInterval(
+                intervalSet, intervalSet.start, intervalSet.end,
+                SeekableIntervalIterator)
+            for _ in range(self.num_random_tests):
+                start = random.randrange(
+                    intervalSet.start, intervalSet.end - 1)
+                if len(list(intervalSet.get(start, intervalSet.end))) > 0:
+                    self.verifyInterval(
+                        intervalSet, start, intervalSet.end,
+                        SeekableIntervalIterator)
+
+    def testSeekablePageTokenFormat(self):
+        intervalSet = self.testIntervalSets[0]
+        iterator = SeekableIntervalIterator(intervalSet, 0, 10)
+        _, pageToken = next(iterator)
+        self.assertEqual(pageToken, "1:0:1")
+        resumed = SeekableIntervalIterator(intervalSet, 0, 10, pageToken)
+        self.assertEqual(resumed.numSeeks, 1)
+        self.assertEqual(next(resumed)[0], intervalSet.intervals[1])
+
+    def testSeekablePageTokensFallBack(self):
+        # Tokens from a seekable iterator are still valid for iterators
+        # that cannot seek, and vice versa.
+        intervalSet = self.testIntervalSets[0]
+        seekable = list(SeekableIntervalIterator(intervalSet, 0, 10))
+        trivial = list(TrivialIntervalIterator(intervalSet, 0, 10))
+        for (_, seekToken), (_, trivialToken) in zip(seekable, trivial):
+            if seekToken is None:
+                self.assertIsNone(trivialToken)
+                continue
+            self.assertEqual(
+                list(TrivialIntervalIterator(intervalSet, 0, 10, seekToken)),
+                list(TrivialIntervalIterator(
+                    intervalSet, 0, 10, trivialToken)))
+            self.assertEqual(
+                [obj for obj, _ in SeekableIntervalIterator(
+                    intervalSet, 0, 10, trivialToken)],
+                [obj for obj, _ in TrivialIntervalIterator(
+                    intervalSet, 0, 10, trivialToken)])
+
+    def testInconsistentVirtualOffset(self):
+        # An offset that does not agree with the search anchor is
+        # ignored in favour of skipping from the anchor.
+        intervalSet = self.testIntervalSets[0]
+        expected = list(TrivialIntervalIterator(intervalSet, 0, 10, "4:1"))
+        iterator = SeekableIntervalIterator(intervalSet, 0, 10, "4:1:0")
+        self.assertEqual(
+            [obj for obj, _ in iterator], [obj for obj, _ in expected])
+
+    def testUnreadableVirtualOffset(self):
+        # An offset at which no record can be read is ignored in favour
+        # of skipping from the anchor.
+        intervalSet = self.testIntervalSets[0]
+        expected = list(TrivialIntervalIterator(intervalSet, 0, 10, "4:1"))
+        iterator = UnreadableOffsetIntervalIterator(
+            intervalSet, 0, 10, "4:1:12345")
+        self.assertEqual(iterator.numSeeks, 1)
+        self.assertEqual(
+            [obj for obj, _ in iterator], [obj for obj, _ in expected])
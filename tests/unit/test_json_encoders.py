@@ -0,0 +1,104 @@
+"""
+Conformance tests for the specialised JSON encoders used when building
+search responses
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+import ga4gh.server.datarepo as datarepo
+import ga4gh.server.response_builder as response_builder
+import tests.paths as paths
+
+import ga4gh.schemas.protocol as protocol
+
+
+class TestJsonEncoders(unittest.TestCase):
+    """
+    Tests that the specialised JSON encoders produce output identical to
+    json_format.
+    """
+    def setUp(self):
+        dataRepository = datarepo.SqlDataRepository(paths.testDataRepo)
+        dataRepository.open(datarepo.MODE_READ)
+        self.dataset = dataRepository.getDatasets()[0]
+
+    def assertJsonEqual(self, protocolElement):
+        self.assertEqual(
+            response_builder.toJson(protocolElement),
+            protocol.toJson(protocolElement))
+
+    def testVariants(self):
+        for variantSet in self.dataset.getVariantSets():
+            callSetIds = [
+                callSet.getId() for callSet in variantSet.getCallSets()]
+            referenceName = sorted(
+                variantSet.getReferenceToDataUrlIndexMap().keys())[0]
+            for variant in variantSet.getVariants(
+                    referenceName, 0, 2**31, callSetIds):
+                self.assertJsonEqual(variant)
+
+    def testReadAlignments(self):
+        readGroupSet = self.dataset.getReadGroupSetByName("HG00096")
+        reference = readGroupSet.getReferenceSet().getReferenceByName("1")
+        for readGroup in readGroupSet.getReadGroups():
+            for readAlignment in readGroup.getReadAlignments(reference):
+                self.assertJsonEqual(readAlignment)
+
+    def testFeatures(self):
+        for featureSet in self.dataset.getFeatureSets():
+            for feature in featureSet.getFeatures():
+                self.assertJsonEqual(feature)
+
+    def testExpressionLevels(self):
+        for rnaQuantificationSet in self.dataset.getRnaQuantificationSets():
+            for rnaQuantification in (
+                    rnaQuantificationSet.getRnaQuantifications()):
+                for expressionLevel in (
+                        rnaQuantification.getExpressionLevels()):
+                    self.assertJsonEqual(
+                        expressionLevel.toProtocolElement())
+
+    def testAttributeValues(self):
+        variant = protocol.Variant()
+        attr = variant.attributes.attr
+        attr["string"].values.add().string_value = "abc"
+        attr["int64"].values.add().int64_value = 2**40
+        attr["int32"].values.add().int32_value = -1
+        attr["bool"].values.add().bool_value = False
+        attr["double"].values.add().double_value = float("nan")
+        attr["null"].values.add().null_value = protocol.NULL_VALUE
+        attr["list"].values.add().attribute_list.values.add().int32_value = 0
+        attr["term"].values.add().ontology_term.term = "term"
+        nested = attr["nested"].values.add().attributes.attr["key"]
+        nested.values.add().double_value = float("-inf")
+        attr["empty"].values.add()
+        self.assertJsonEqual(variant)
+        variant.attributes.Clear()
+        self.assertJsonEqual(variant)
+
+    def testCalls(self):
+        variant = protocol.Variant()
+        variant.start = 0
+        variant.svlen = -5
+        variant.cipos.extend([-1, 1])
+        variant.filters_applied = True
+        call = variant.calls.add()
+        call.genotype_likelihood.extend([0.5, float("inf")])
+        call.genotype.values.add().number_value = 1
+        call.genotype.values.add().null_value = 0
+        call.genotype.values.add().list_value.values.add().string_value = "a"
+        call.genotype.values.add().struct_value.fields["a"].bool_value = True
+        variant.calls.add().genotype.Clear()
+        self.assertJsonEqual(variant)
+
+    def testFallback(self):
+        reference = protocol.Reference()
+        reference.id = "id"
+        reference.length = 10
+        self.assertJsonEqual(reference)
+        self.assertEqual(
+            response_builder.serialize(reference, "application/protobuf"),
+            reference.SerializeToString())
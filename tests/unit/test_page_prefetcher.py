@@ -0,0 +1,155 @@
+"""
+Tests for the background prefetching of search result pages
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import threading
+import unittest
+
+import ga4gh.server.backend as backend
+import ga4gh.server.datarepo as datarepo
+import ga4gh.server.paging as paging
+import tests.paths as paths
+
+import ga4gh.schemas.protocol as protocol
+
+
+class TestPagePrefetcher(unittest.TestCase):
+    """
+    Tests the computation and caching of prefetched pages
+    """
+    def setUp(self):
+        self.prefetcher = paging.PagePrefetcher(numWorkers=1, maxBytes=10)
+
+    def testDisabled(self):
+        prefetcher = paging.PagePrefetcher()
+        self.assertFalse(prefetcher.isEnabled())
+        self.assertTrue(self.prefetcher.isEnabled())
+        with self.assertRaises(ValueError):
+            prefetcher.setNumWorkers(-1)
+
+    def testPrefetchTake(self):
+        self.prefetcher.prefetch("key", lambda x: (x, "1"), "abc")
+        self.assertEqual(self.prefetcher.take("key"), ("abc", "1"))
+        self.assertEqual(self.prefetcher.getNumHits(), 1)
+        self.assertEqual(self.prefetcher.getNumBytes(), 0)
+        self.assertIsNone(self.prefetcher.take("key"))
+        self.assertEqual(self.prefetcher.getNumMisses(), 1)
+
+    def testWaitForPendingPage(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def computePage():
+            started.set()
+            release.wait()
+            return "abc", None
+
+        self.prefetcher.prefetch("key", computePage)
+        started.wait()
+        threading.Timer(0.05, release.set).start()
+        self.assertEqual(self.prefetcher.take("key"), ("abc", None))
+
+    def testFailedPrefetch(self):
+        def computePage():
+            raise ValueError()
+
+        self.prefetcher.prefetch("key", computePage)
+        self.assertIsNone(self.prefetcher.take("key"))
+        self.assertEqual(self.prefetcher.getNumMisses(), 1)
+
+    def testFailedInitializer(self):
+        def initializer():
+            raise ValueError()
+
+        prefetcher = paging.PagePrefetcher(
+            numWorkers=1, initializer=initializer)
+        prefetcher.prefetch("key", lambda: ("abc", None))
+        self.assertIsNone(prefetcher.take("key"))
+        self.assertFalse(prefetcher.isEnabled())
+        self.assertEqual(len(prefetcher._pending), 0)
+
+    def testWaitTimeout(self):
+        release = threading.Event()
+
+        def computePage():
+            release.wait()
+            return "abc", None
+
+        prefetcher = paging.PagePrefetcher(numWorkers=1, waitTimeout=0.01)
+        prefetcher.prefetch("key", computePage)
+        self.assertIsNone(prefetcher.take("key"))
+        self.assertEqual(prefetcher.getNumMisses(), 1)
+        release.set()
+
+    def testMaxBytes(self):
+        for key in ["a", "b", "c"]:
+            self.prefetcher.prefetch(key, lambda: ("1234", None))
+            self.prefetcher._pending.get(key, threading.Event()).wait(1)
+        self.assertEqual(self.prefetcher.getNumBytes(), 8)
+        self.assertIsNone(self.prefetcher.take("a"))
+        self.assertIsNotNone(self.prefetcher.take("b"))
+        self.assertIsNotNone(self.prefetcher.take("c"))
+        self.prefetcher.prefetch("d", lambda: ("12345678901", None))
+        self.assertIsNone(self.prefetcher.take("d"))
+
+
+class TestPrefetchedSearches(unittest.TestCase):
+    """
+    Tests that pages served by the prefetcher are identical to those
+    computed on request.
+    """
+    def setUp(self):
+        dataRepository = datarepo.SqlDataRepository(paths.testDataRepo)
+        dataRepository.open(datarepo.MODE_READ)
+        self.backend = backend.Backend(dataRepository)
+        dataset = dataRepository.getDatasets()[0]
+        self.variantSet = dataset.getVariantSets()[0]
+
+    def _runSearchPages(self, pageSize):
+        request = protocol.SearchVariantsRequest()
+        request.variant_set_id = self.variantSet.getId()
+        request.reference_name = "1"
+        request.start = 0
+        request.end = 2**30
+        request.page_size = pageSize
+        pages = []
+        while True:
+            responseStr = self.backend.runSearchRequest(
+                protocol.toJson(request), protocol.SearchVariantsRequest,
+                protocol.SearchVariantsResponse,
+                self.backend.variantsGenerator)
+            response = protocol.fromJson(
+                responseStr, protocol.SearchVariantsResponse)
+            pages.append(list(response.variants))
+            if not response.next_page_token:
+                break
+            request.page_token = response.next_page_token
+        return pages
+
+    def testPrefetchedPages(self):
+        expected = self._runSearchPages(9)
+        self.backend.setPrefetchWorkers(2)
+        self.assertEqual(self._runSearchPages(9), expected)
+        prefetcher = self.backend.getPagePrefetcher()
+        self.assertEqual(prefetcher.getNumHits(), len(expected) - 1)
+        self.assertEqual(prefetcher.getNumMisses(), 0)
+
+    def testPrefetchedPagesWithCursors(self):
+        expected = self._runSearchPages(9)
+        self.backend.setPrefetchWorkers(1)
+        self.backend.setCursorCacheMaxSize(10)
+        self.assertEqual(self._runSearchPages(9), expected)
+        self.assertGreater(self.backend.getPagePrefetcher().getNumHits(), 0)
+        self.assertEqual(len(self.backend._cursorCache), 0)
+
+    def testPageSizeChange(self):
+        expected = self._runSearchPages(9)
+        self.backend.setPrefetchWorkers(1)
+        self._runSearchPages(5)
+        numHits = self.backend.getPagePrefetcher().getNumHits()
+        self.assertEqual(self._runSearchPages(9), expected)
+        self.assertGreater(
+            self.backend.getPagePrefetcher().getNumHits(), numHits)
@@ -6,9 +6,19 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import os
+import shutil
+import tempfile
 import unittest
 
+import mock
+import pysam
+
+import ga4gh.server.datamodel.datasets as datasets
 import ga4gh.server.datamodel.reads as reads
+import ga4gh.server.datamodel.references as references
+import ga4gh.server.exceptions as exceptions
+import tests.paths as paths
 
 import ga4gh.schemas.protocol as protocol
 
@@ -248,3 +258,315 @@ class TestSamFlags(unittest.TestCase):
             self.flag, reads.SamFlags.FIRST_IN_PAIR))
         self.assertTrue(reads.SamFlags.isFlagSet(
             self.flag, reads.SamFlags.FAILED_QUALITY_CHECK))
+
+    def testDecodeFlag(self):
+        samFlags = reads.SamFlags
+        for flag in range(4096):
+            flagFields = samFlags.decodeFlag(flag)
+            self.assertIs(samFlags.decodeFlag(flag), flagFields)
+            template = flagFields.template
+            self.assertEqual(
+                flagFields.readUnmapped,
+                samFlags.isFlagSet(flag, samFlags.READ_UNMAPPED))
+            self.assertEqual(
+                flagFields.mateUnmapped,
+                samFlags.isFlagSet(flag, samFlags.MATE_UNMAPPED))
+            self.assertEqual(
+                flagFields.strand == protocol.NEG_STRAND,
+                samFlags.isFlagSet(flag, samFlags.READ_REVERSE_STRAND))
+            self.assertEqual(
+                flagFields.mateStrand == protocol.NEG_STRAND,
+                samFlags.isFlagSet(flag, samFlags.MATE_REVERSE_STRAND))
+            self.assertEqual(
+                template.duplicate_fragment,
+                samFlags.isFlagSet(flag, samFlags.DUPLICATE_READ))
+            self.assertEqual(
+                template.number_reads,
+                2 if samFlags.isFlagSet(flag, samFlags.READ_PAIRED) else 1)
+            self.assertEqual(
+                template.improper_placement,
+                not samFlags.isFlagSet(flag, samFlags.READ_PROPER_PAIR))
+            self.assertEqual(
+                template.supplementary_alignment,
+                samFlags.isFlagSet(flag, samFlags.SUPPLEMENTARY_ALIGNMENT))
+        template = samFlags.decodeFlag(
+            samFlags.FIRST_IN_PAIR | samFlags.SECOND_IN_PAIR).template
+        self.assertEqual(template.read_number, 2)
+        self.assertEqual(
+            samFlags.decodeFlag(samFlags.SECOND_IN_PAIR).template.read_number,
+            1)
+        self.assertEqual(samFlags.decodeFlag(0).template.read_number, -1)
+
+
+class TestCramSliceCache(unittest.TestCase):
+    """
+    Tests the on-disk cache of decoded CRAM reads.
+    """
+    def setUp(self):
+        self._cacheDir = tempfile.mkdtemp(prefix="ga4gh_cram_slices")
+        self._cache = reads.CramSliceCache(self._cacheDir, 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self._cacheDir)
+
+    def testIsCramFile(self):
+        self.assertTrue(reads.isCramFile("sample.cram"))
+        self.assertTrue(reads.isCramFile("sample.CRAM"))
+        self.assertFalse(reads.isCramFile("sample.bam"))
+        self.assertEqual(
+            reads.getDefaultIndexFile("sample.cram"), "sample.cram.crai")
+        self.assertEqual(
+            reads.getDefaultIndexFile("sample.bam"), "sample.bam.bai")
+
+    def testSetBinSize(self):
+        self.assertRaises(ValueError, self._cache.setBinSize, 0)
+        self.assertRaises(ValueError, self._cache.setBinSize, -1)
+        self.assertTrue(self._cache.isEnabled())
+        self._cache.setCacheDir(None)
+        self.assertFalse(self._cache.isEnabled())
+
+    def testSlicePath(self):
+        args = (paths.bamPath, paths.bamPath + ".bai", paths.faPath)
+        path = self._cache.getSlicePath(*(args + (0, 1000)))
+        self.assertTrue(path.startswith(self._cacheDir))
+        self.assertEqual(path, self._cache.getSlicePath(*(args + (0, 1000))))
+        self.assertNotEqual(
+            path, self._cache.getSlicePath(*(args + (0, 2000))))
+        self.assertNotEqual(
+            path, self._cache.getSlicePath(*(args + (1, 1000))))
+        self._cache.setBinSize(2000)
+        self.assertNotEqual(
+            path, self._cache.getSlicePath(*(args + (0, 1000))))
+
+    def testWriteSlice(self):
+        samFile = pysam.AlignmentFile(paths.bamPath)
+        try:
+            referenceName = samFile.references[0]
+            expected = list(samFile.fetch(referenceName))
+            path = self._cache.getSlicePath(
+                paths.bamPath, paths.bamPath + ".bai", paths.faPath, 0, 0)
+            self._cache.writeSlice(
+                path, samFile, samFile.fetch(referenceName))
+        finally:
+            samFile.close()
+        self.assertEqual(os.listdir(os.path.dirname(path)), [
+            os.path.basename(path)])
+        sliceFile = pysam.AlignmentFile(path, "rb")
+        try:
+            readAlignments = list(sliceFile.fetch(until_eof=True))
+        finally:
+            sliceFile.close()
+        self.assertEqual(
+            [(read.query_name, read.reference_start) for read in expected],
+            [(read.query_name, read.reference_start)
+             for read in readAlignments])
+
+
+class TestCramReadGroupSet(unittest.TestCase):
+    """
+    Tests that the reads of a CRAM file, decoded in the bins of the
+    cramSliceCache, are the same as those of the BAM file it was
+    written from.
+    """
+    binSize = 20
+    intervals = [
+        (None, None), (0, 600), (15, 45), (19, 21), (39, 41), (40, 41),
+        (60, 61), (100, 130), (150, 600)]
+
+    def setUp(self):
+        self._tempDir = tempfile.mkdtemp(prefix="ga4gh_cram")
+        self._cacheDir = os.path.join(self._tempDir, "slices")
+        self._originalCacheDir = reads.cramSliceCache.getCacheDir()
+        self._originalBinSize = reads.cramSliceCache.getBinSize()
+        reads.cramSliceCache.setBinSize(self.binSize)
+        bamFile = pysam.AlignmentFile(paths.bamPath)
+        try:
+            # The test BAM file is aligned to a 599 base chr17 that is
+            # not in the test data, so any sequence of this length serves
+            # as its reference.
+            faPath = os.path.join(self._tempDir, "chr17.fa")
+            with open(faPath, "w") as faFile:
+                faFile.write(">chr17\n{}\n".format("ACGT" * 149 + "ACG"))
+            pysam.faidx(faPath.encode('utf-8'), catch_stdout=False)
+            cramPath = os.path.join(self._tempDir, "chr17.1-250.cram")
+            cramFile = pysam.AlignmentFile(
+                cramPath, "wc", header=bamFile.header,
+                reference_filename=faPath)
+            try:
+                for readAlignment in bamFile.fetch(until_eof=True):
+                    cramFile.write(readAlignment)
+            finally:
+                cramFile.close()
+        finally:
+            bamFile.close()
+        pysam.index(cramPath.encode('utf-8'), catch_stdout=False)
+        referenceSet = references.HtslibReferenceSet("chr17")
+        referenceSet.populateFromFile(faPath)
+        self._reference = referenceSet.getReferenceByName("chr17")
+        # Both read group sets have the same IDs, so that their read
+        # alignments can be compared directly.
+        self._bamReadGroupSet = self._makeReadGroupSet(
+            referenceSet, paths.bamPath)
+        self._cramReadGroupSet = self._makeReadGroupSet(
+            referenceSet, cramPath)
+
+    def tearDown(self):
+        reads.cramSliceCache.setCacheDir(self._originalCacheDir)
+        reads.cramSliceCache.setBinSize(self._originalBinSize)
+        shutil.rmtree(self._tempDir)
+
+    def _makeReadGroupSet(self, referenceSet, dataUrl):
+        dataset = datasets.Dataset("dataset")
+        readGroupSet = reads.HtslibReadGroupSet(dataset, "readGroupSet")
+        readGroupSet.setReferenceSet(referenceSet)
+        readGroupSet.populateFromFile(dataUrl)
+        return readGroupSet
+
+    def _getReadAlignments(self, readGroupSetOrGroup, start, end):
+        readAlignments = []
+        for readAlignment in readGroupSetOrGroup.getReadAlignments(
+                self._reference, start, end):
+            # htslib regenerates the MD and NM tags of CRAM reads.
+            attr = readAlignment.attributes.attr
+            for key in ["MD", "NM"]:
+                if key in attr:
+                    del attr[key]
+            readAlignments.append(protocol.toJson(readAlignment))
+        return readAlignments
+
+    def _assertReadAlignmentsEqual(self):
+        pairs = [(self._bamReadGroupSet, self._cramReadGroupSet)]
+        pairs.extend(zip(
+            self._bamReadGroupSet.getReadGroups(),
+            self._cramReadGroupSet.getReadGroups()))
+        for bamReads, cramReads in pairs:
+            for start, end in self.intervals:
+                expected = self._getReadAlignments(bamReads, start, end)
+                self.assertEqual(
+                    self._getReadAlignments(cramReads, start, end),
+                    expected)
+                # The second search reads any slices cached by the first.
+                self.assertEqual(
+                    self._getReadAlignments(cramReads, start, end),
+                    expected)
+
+    def testReadCounts(self):
+        self.assertTrue(self._cramReadGroupSet.isCram())
+        self.assertEqual(self._cramReadGroupSet.getNumAlignedReads(), -1)
+        self.assertEqual(self._cramReadGroupSet.getNumUnalignedReads(), -1)
+
+    def testReadAlignmentsWithoutSliceCache(self):
+        reads.cramSliceCache.setCacheDir(None)
+        self._assertReadAlignmentsEqual()
+
+    def testUncachedSliceClipped(self):
+        # Without a cache, only the reads overlapping the search within
+        # the bin are decoded.
+        reads.cramSliceCache.setCacheDir(None)
+        readGroupSet = self._cramReadGroupSet
+        samFile = readGroupSet.getFileHandle(readGroupSet.getDataUrl())
+        readAlignments = readGroupSet._getCramSlice(
+            samFile, b"chr17", 0, 0, 1000, 40, 41)
+        self.assertEqual(
+            [read.query_name for read in readAlignments], ["r002"])
+
+    def testReadAlignmentsWithSliceCache(self):
+        reads.cramSliceCache.setCacheDir(self._cacheDir)
+        self._assertReadAlignmentsEqual()
+        self.assertGreater(len(os.listdir(self._cacheDir)), 0)
+
+    def testReadAlignmentsWithReadGroupIndex(self):
+        reads.cramSliceCache.setCacheDir(self._cacheDir)
+        self._cramReadGroupSet.writeReadGroupIndex(self.binSize)
+        self.assertIsNotNone(self._cramReadGroupSet.getReadGroupIndex())
+        self._assertReadAlignmentsEqual()
+
+
+class TestCramReferencePath(unittest.TestCase):
+    """
+    Tests the configuration of the paths htslib looks up CRAM references
+    in.
+    """
+    def testPrivateReferencePath(self):
+        with mock.patch.dict(os.environ):
+            os.environ.pop("REF_PATH", None)
+            os.environ.pop("REF_CACHE", None)
+            reads.configureCramReferencePath()
+            directory = os.path.dirname(os.environ["REF_PATH"])
+            try:
+                self.assertEqual(os.stat(directory).st_mode & 0o077, 0)
+                self.assertEqual(
+                    os.environ["REF_CACHE"], os.environ["REF_PATH"])
+            finally:
+                os.rmdir(directory)
+
+    def testExistingReferencePath(self):
+        with mock.patch.dict(os.environ, {"REF_PATH": "/refs/%2s/%s"}):
+            reads.configureCramReferencePath()
+            self.assertEqual(os.environ["REF_PATH"], "/refs/%2s/%s")
+
+    def testUrlReferencePath(self):
+        for refPath in [
+                "http://www.ebi.ac.uk/ena/cram/md5/%s",
+                "/refs/%s:URL=http://www.ebi.ac.uk/ena/cram/md5/%s",
+                "/refs/%s:https://example.com/%s"]:
+            with mock.patch.dict(os.environ, {"REF_PATH": refPath}):
+                self.assertRaises(
+                    exceptions.ConfigurationException,
+                    reads.configureCramReferencePath)
+
+
+class TestReadSampler(unittest.TestCase):
+    """
+    Tests the selection of reads by a ReadSampler.
+    """
+    def _makeReadAlignments(self, positions):
+        readAlignments = []
+        for index, position in enumerate(positions):
+            readAlignment = protocol.ReadAlignment()
+            readAlignment.fragment_name = "fragment{}".format(index)
+            readAlignment.alignment.position.position = position
+            readAlignments.append(readAlignment)
+        return readAlignments
+
+    def testInvalidParameters(self):
+        for maxDepth, fraction in [(0, None), (None, 0), (None, 1.5)]:
+            self.assertRaises(
+                exceptions.BadReadSamplerException, reads.ReadSampler,
+                maxDepth, fraction)
+
+    def testMaxDepth(self):
+        readAlignments = self._makeReadAlignments([1, 1, 1, 2, 3, 3, 3, 3])
+        readSampler = reads.ReadSampler(maxDepth=2)
+        sampled = list(readSampler.sampleReadAlignments(readAlignments))
+        self.assertEqual(
+            [readAlignment.fragment_name for readAlignment in sampled],
+            ["fragment0", "fragment1", "fragment3", "fragment4",
+             "fragment5"])
+
+    def testFraction(self):
+        readAlignments = self._makeReadAlignments(range(1000))
+        readSampler = reads.ReadSampler(fraction=0.25)
+        sampled = list(readSampler.sampleReadAlignments(readAlignments))
+        self.assertGreater(len(sampled), 150)
+        self.assertLess(len(sampled), 350)
+        # Reads of the same fragments are selected every time
+        self.assertEqual(
+            sampled,
+            list(readSampler.sampleReadAlignments(readAlignments)))
+        for readAlignment in readAlignments:
+            self.assertEqual(
+                readAlignment in sampled,
+                readSampler.isFragmentSampled(
+                    readAlignment.fragment_name.encode()))
+        allSampled = list(reads.ReadSampler(fraction=1).sampleReadAlignments(
+            readAlignments))
+        self.assertEqual(allSampled, readAlignments)
+
+    def testEquality(self):
+        self.assertEqual(
+            reads.ReadSampler(10, 0.5), reads.ReadSampler(10, 0.5))
+        self.assertEqual(
+            hash(reads.ReadSampler(10, 0.5)),
+            hash(reads.ReadSampler(10, 0.5)))
+        self.assertNotEqual(reads.ReadSampler(10), reads.ReadSampler(11))
@@ -15,6 +15,8 @@ import ga4gh.server.exceptions as exceptions
 import ga4gh.server.datarepo as datarepo
 import ga4gh.server.cli.repomanager as cli_repomanager
 import ga4gh.server.datamodel as datamodel
+import ga4gh.server.datamodel.reads as reads
+import ga4gh.server.datamodel.variants as variants
 import tests.paths as paths
 
 
@@ -741,6 +743,35 @@ class TestAddReadGroupSet(AbstractRepoManagerTest):
             self.runCommand(cmd)
             self.verifyReadGroupSet(name, bamFile, indexFile)
 
+    def testReadGroupIndex(self):
+        bamFile = paths.bamPath
+        name = os.path.split(bamFile)[1].split(".")[0]
+        tempDir = tempfile.mkdtemp()
+        try:
+            indexFile = os.path.join(tempDir, name + ".bam.bai")
+            shutil.copyfile(bamFile + ".bai", indexFile)
+            cmd = (
+                "add-readgroupset {} {} {} -I {} -g --binSize=1000 "
+                "--referenceSetName={}").format(
+                    self._repoPath, self._datasetName, bamFile,
+                    indexFile, self._referenceSetName)
+            self.runCommand(cmd)
+            indexPath = reads.ReadGroupIndex.getIndexPath(indexFile)
+            self.assertTrue(os.path.exists(indexPath))
+            os.unlink(indexPath)
+            self.runCommand("index-readgroupset {} {} {}".format(
+                self._repoPath, self._datasetName, name))
+            repo = self.readRepo()
+            dataset = repo.getDatasetByName(self._datasetName)
+            readGroupSet = dataset.getReadGroupSetByName(name)
+            readGroupIndex = readGroupSet.getReadGroupIndex()
+            self.assertIsNotNone(readGroupIndex)
+            self.assertEqual(
+                readGroupIndex.getBinSize(),
+                datamodel.BinIndex.defaultBinSize)
+        finally:
+            shutil.rmtree(tempDir)
+
     def testLocalFileWithName(self):
         bamFile = paths.bamPath
         name = "test_rgs"
@@ -940,6 +971,42 @@ class TestAddAnnotatedVariantSet(AbstractRepoManagerTest):
         variantSet = dataset.getVariantSetByName(name)
         self.assertEqual(len(variantSet.getVariantAnnotationSets()), 1)
 
+    def testEffectIndex(self):
+        name = "test_vs_effect_index"
+        tempdir = tempfile.mkdtemp(prefix="ga4gh_test_effect_index")
+        try:
+            vcfDir = os.path.join(tempdir, "vcfs")
+            shutil.copytree(self.vcfDir, vcfDir)
+            indexFiles = glob.glob(os.path.join(vcfDir, "*.tbi"))
+            cmd = "add-variantset {} {} {} -R {} -n {} -aO {} -e".format(
+                self._repoPath, self._datasetName, vcfDir,
+                self._referenceSetName, name, self._ontologyName)
+            self.runCommand(cmd)
+            effectIndexFiles = [
+                variants.VariantEffectIndex.getIndexPath(
+                    indexFile)
+                for indexFile in indexFiles]
+            for effectIndexFile in effectIndexFiles:
+                self.assertTrue(os.path.exists(effectIndexFile))
+                os.unlink(effectIndexFile)
+            cmd = "index-variantset {} {} {} --binSize=1000".format(
+                self._repoPath, self._datasetName, name)
+            self.runCommand(cmd)
+            for indexFile in indexFiles:
+                effectIndex = variants.VariantEffectIndex.load(
+                    indexFile)
+                self.assertEqual(effectIndex.getBinSize(), 1000)
+        finally:
+            shutil.rmtree(tempdir)
+
+    def testEffectIndexNoAnnotations(self):
+        name = "test_vs_effect_index"
+        cmd = "add-variantset {} {} {} -R {} -n {} -e".format(
+            self._repoPath, self._datasetName, self.vcfDir,
+            self._referenceSetName, name)
+        self.assertRaises(
+            exceptions.RepoManagerException, self.runCommand, cmd)
+
     def testAnnotationsNoOntology(self):
         name = "test_vs_annotations"
         cmd = "add-variantset {} {} {} -R {} -n {} -a".format(
@@ -108,3 +108,73 @@ class SearchResponseBuilderTest(unittest.TestCase):
             instance = protocol.fromJson(builder.getSerializedResponse(),
                                          responseClass)
             self.assertEqual(nextPageToken, instance.next_page_token)
+
+    def testBinaryResponse(self):
+        # Verifies that binary responses assembled from pre-serialised
+        # values are identical to those of the equivalent message
+        responseClass = protocol.SearchVariantsResponse
+        for numValues in range(3):
+            for nextPageToken in [None, "", "string"]:
+                builder = response_builder.SearchResponseBuilder(
+                    responseClass, 100, 2 ** 32, "application/protobuf")
+                expected = responseClass()
+                for j in range(numValues):
+                    value = protocol.Variant()
+                    value.start = j
+                    value.reference_bases = "A" * j
+                    value.alternate_bases.append("T")
+                    builder.addValue(value)
+                    expected.variants.add().CopyFrom(value)
+                builder.setNextPageToken(nextPageToken)
+                if nextPageToken is not None:
+                    expected.next_page_token = nextPageToken
+                serialized = builder.getSerializedResponse()
+                self.assertEqual(serialized, expected.SerializeToString())
+                instance = responseClass()
+                instance.ParseFromString(serialized)
+                self.assertEqual(instance, expected)
+
+    def testBinaryBufferSize(self):
+        responseClass = protocol.SearchVariantsResponse
+        typicalValue = protocol.Variant()
+        typicalValue.reference_bases = "AAAAAAAA"
+        maxBufferSize = 3 * typicalValue.ByteSize()
+        builder = response_builder.SearchResponseBuilder(
+            responseClass, 1000, maxBufferSize, "application/x-protobuf")
+        while not builder.isFull():
+            builder.addValue(typicalValue)
+        instance = responseClass()
+        instance.ParseFromString(builder.getSerializedResponse())
+        self.assertEqual(len(instance.variants), 3)
+
+
+class PackedGenotypesTest(unittest.TestCase):
+    """
+    Tests the packing of genotype matrices into 2-bit codes.
+    """
+    def testPackUnpack(self):
+        names = [
+            'HOMOZYGOUS_REF', 'HETEROZYGOUS_ALT', 'HOMOZYGOUS_ALT', 'NA',
+            'OTHER', 'HEMIZYGOUS_REF', 'HEMIZYGOUS_ALT']
+        for numGenotypes in range(10):
+            genotypes = [
+                protocol.Genotype.Value(names[j % len(names)])
+                for j in range(numGenotypes)]
+            packed, otherGenotypes = response_builder.packGenotypes(
+                genotypes)
+            self.assertEqual(len(packed), (numGenotypes + 3) // 4)
+            self.assertEqual(
+                [index for index, _ in otherGenotypes],
+                [j for j in range(numGenotypes) if j % len(names) > 3])
+            self.assertEqual(
+                response_builder.unpackGenotypes(
+                    packed, otherGenotypes, numGenotypes), genotypes)
+
+    def testPackedCodes(self):
+        genotypes = [
+            protocol.Genotype.Value(name) for name in [
+                'HETEROZYGOUS_ALT', 'HOMOZYGOUS_ALT', 'NA',
+                'HOMOZYGOUS_REF', 'HOMOZYGOUS_ALT']]
+        packed, otherGenotypes = response_builder.packGenotypes(genotypes)
+        self.assertEqual(packed, b"\x39\x02")
+        self.assertEqual(otherGenotypes, [])
@@ -7,6 +7,9 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import hashlib
+import os
+import shutil
+import tempfile
 import unittest
 
 import ga4gh.server.datarepo as datarepo
@@ -103,3 +106,92 @@ class TestHtslibVariantAnnotationSet(unittest.TestCase):
         expected = hashlib.md5("\t\t[]\t").hexdigest()
         hashed = self._variantAnnotationSet.getTranscriptEffectId(effect)
         self.assertEqual(hashed, expected)
+
+    def testConvertTranscriptEffect(self):
+        annotationSet = self._variantAnnotationSet
+        annotationSet._setAnnotationType(variants.ANNOTATIONS_SNPEFF)
+        annStr = (
+            "T|missense_variant|MODERATE|OR4F5|ENSG00000186092|transcript|"
+            "ENST00000335137|protein_coding|1/1|c.338T>C|p.Phe113Ser|"
+            "338/918|338/918|113/305||")
+        effect = annotationSet.convertTranscriptEffect(annStr, "g.69428T>G")
+        self.assertEqual(effect.alternate_bases, "T")
+        self.assertEqual(effect.feature_id, "ENST00000335137")
+        self.assertEqual(effect.hgvs_annotation.genomic, "g.69428T>G")
+        self.assertEqual(effect.hgvs_annotation.transcript, "c.338T>C")
+        self.assertEqual(effect.hgvs_annotation.protein, "p.Phe113Ser")
+        self.assertEqual(
+            [term.term for term in effect.effects], ["missense_variant"])
+        self.assertEqual(effect.protein_location.start, 112)
+        self.assertEqual(effect.cds_location.start, 337)
+        self.assertEqual(list(effect.attributes.attr.keys()), ["impact"])
+        self.assertEqual(
+            effect.attributes.attr["impact"].values[0].string_value,
+            "MODERATE")
+        self.assertEqual(
+            effect.id, annotationSet.getTranscriptEffectId(effect))
+        # Truncated strings set the fields that are present
+        effect = annotationSet.convertTranscriptEffect(
+            "T|missense_variant|MODERATE", None)
+        self.assertEqual(effect.alternate_bases, "T")
+        self.assertEqual(effect.feature_id, "")
+        self.assertTrue(effect.HasField("hgvs_annotation"))
+
+
+class TestVariantEffectIndex(unittest.TestCase):
+    """
+    Unit tests for the sidecar index of the effects in annotated VCFs.
+    """
+    def setUp(self):
+        self._effectIndex = variants.VariantEffectIndex(10)
+        self._effectIndex.addRecord("1", 5, ["stop_gained"])
+        self._effectIndex.addRecord("1", 25, ["missense_variant"])
+        self._effectIndex.addRecord(
+            "1", 31, ["missense_variant", "stop_gained"])
+        self._effectIndex.addRecord("1", 52, ["stop_gained"])
+        self._effectIndex.addRecord("2", 15, ["stop_gained"])
+
+    def testGetRegions(self):
+        effectIndex = self._effectIndex
+        self.assertEqual(
+            effectIndex.getRegions("1", set(["stop_gained"]), 0, 100),
+            [(0, 10), (30, 40), (50, 60)])
+        self.assertEqual(
+            effectIndex.getRegions("1", set(["missense_variant"]), 0, 100),
+            [(20, 40)])
+        self.assertEqual(
+            effectIndex.getRegions(
+                "1", set(["missense_variant", "stop_gained"]), 3, 55),
+            [(3, 10), (20, 40), (50, 55)])
+        # Records beginning in earlier bins may overlap the search start
+        self.assertEqual(
+            effectIndex.getRegions("1", set(["stop_gained"]), 12, 35),
+            [(12, 20), (30, 35)])
+        self.assertEqual(
+            effectIndex.getRegions("1", set(["not_an_effect"]), 0, 100), [])
+        self.assertEqual(
+            effectIndex.getRegions("3", set(["stop_gained"]), 0, 100), [])
+
+    def testWriteAndLoad(self):
+        tempdir = tempfile.mkdtemp(prefix="ga4gh_test_effect_index")
+        try:
+            indexFile = os.path.join(tempdir, "test.vcf.gz.tbi")
+            with open(indexFile, "w") as indexFileHandle:
+                indexFileHandle.write("index")
+            self.assertIsNone(variants.VariantEffectIndex.load(indexFile))
+            self._effectIndex.write(indexFile)
+            self.assertTrue(os.path.exists(
+                os.path.join(tempdir, "test.vcf.gz.effidx")))
+            effectIndex = variants.VariantEffectIndex.load(indexFile)
+            self.assertEqual(effectIndex.getBinSize(), 10)
+            for effectNames in [["stop_gained"], ["missense_variant"]]:
+                self.assertEqual(
+                    effectIndex.getRegions("1", set(effectNames), 0, 100),
+                    self._effectIndex.getRegions(
+                        "1", set(effectNames), 0, 100))
+            # An index for a file that has been replaced is not used
+            with open(indexFile, "w") as indexFileHandle:
+                indexFileHandle.write("a new index")
+            self.assertIsNone(variants.VariantEffectIndex.load(indexFile))
+        finally:
+            shutil.rmtree(tempdir)
@@ -0,0 +1,209 @@
+"""
+Tests for the conversion of variants on a pool of worker processes
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import itertools
+import time
+import unittest
+
+import mock
+
+import ga4gh.server.backend as backend
+import ga4gh.server.datarepo as datarepo
+import ga4gh.server.exceptions as exceptions
+import ga4gh.server.paging as paging
+import tests.paths as paths
+
+import ga4gh.schemas.protocol as protocol
+
+
+def _convertVariantShardSlowly(*args):
+    """
+    Converts the specified variant shard after longer than the shard
+    timeout of the tests.
+    """
+    time.sleep(5)
+    return paging._convertVariantShard(*args)
+
+
+class TestVariantConversionPool(unittest.TestCase):
+    """
+    Tests that variants converted in shards are identical to those
+    converted serially.
+    """
+    def setUp(self):
+        dataRepository = datarepo.SqlDataRepository(paths.testDataRepo)
+        dataRepository.open(datarepo.MODE_READ)
+        self.backend = backend.Backend(dataRepository)
+        dataset = dataRepository.getDatasets()[0]
+        self.variantSet = dataset.getVariantSets()[0]
+        self.pool = paging.VariantConversionPool(dataRepository)
+
+    def tearDown(self):
+        self.backend.setVariantConversionWorkers(0)
+        self.pool.setNumWorkers(0)
+
+    def _runSearchPages(self, pageSize, callSetIds):
+        request = protocol.SearchVariantsRequest()
+        request.variant_set_id = self.variantSet.getId()
+        request.reference_name = "1"
+        request.start = 0
+        request.end = 2**30
+        request.page_size = pageSize
+        request.call_set_ids.extend(callSetIds)
+        pages = []
+        while True:
+            responseStr = self.backend.runSearchRequest(
+                protocol.toJson(request), protocol.SearchVariantsRequest,
+                protocol.SearchVariantsResponse,
+                self.backend.variantsGenerator)
+            response = protocol.fromJson(
+                responseStr, protocol.SearchVariantsResponse)
+            pages.append(
+                (list(response.variants), response.next_page_token))
+            if not response.next_page_token:
+                break
+            request.page_token = response.next_page_token
+        return pages
+
+    def _getPages(self, getVariants, pageSize):
+        """
+        Returns the lists of the IDs of the variants on each page of a
+        search of the specified page size. Like the page tokens of
+        variant searches, each page starts at the position of the variant
+        following the previous page, skipping the variants at this
+        position that were already returned; its variants are read from
+        getVariants(start, numVariants).
+        """
+        pages = []
+        start = 0
+        numSkipped = 0
+        while True:
+            variants = (
+                variant for variant in getVariants(
+                    start, numSkipped + pageSize + 1)
+                if variant.start >= start)
+            variants = list(itertools.islice(
+                variants, numSkipped, numSkipped + pageSize + 1))
+            pages.append([variant.id for variant in variants[:pageSize]])
+            if len(variants) <= pageSize:
+                return pages
+            nextStart = variants[pageSize].start
+            if nextStart != start:
+                numSkipped = 0
+            numSkipped += sum(
+                variant.start == nextStart for variant in variants[:pageSize])
+            start = nextStart
+
+    def testSettings(self):
+        self.assertFalse(self.pool.isEnabled())
+        with self.assertRaises(ValueError):
+            self.pool.setNumWorkers(-1)
+        with self.assertRaises(ValueError):
+            self.pool.setMinShardSize(0)
+        self.pool.setNumWorkers(1)
+        self.assertTrue(self.pool.isEnabled())
+
+    def testShardedVariants(self):
+        variants = self.variantSet.getVariants("1", 0, 2**30)
+        expected = [variant.id for variant in variants]
+        self.assertGreater(len(expected), 0)
+        self.pool.setNumWorkers(2)
+        for minShardSize in [1, 1000, 10**6]:
+            self.pool.setMinShardSize(minShardSize)
+            variants = self.pool.getVariants(
+                self.variantSet, "1", 0, 2**30, [])
+            self.assertEqual([variant.id for variant in variants], expected)
+
+    def testShardedPages(self):
+        callSetIds = [
+            callSet.getId() for callSet in self.variantSet.getCallSets()]
+        for pageSize, ids in [(9, []), (20, callSetIds[:1]), (7, callSetIds)]:
+            expected = self._runSearchPages(pageSize, ids)
+            self.backend.setVariantConversionWorkers(2)
+            self.backend.setVariantConversionMinShardSize(1000)
+            self.assertEqual(self._runSearchPages(pageSize, ids), expected)
+            self.backend.setVariantConversionWorkers(0)
+        pool = self.backend.getVariantConversionPool()
+        self.assertGreater(pool.getNumUsedWorkerVariants(), 0)
+
+    def testWorkerVariantsUsedAcrossPages(self):
+        pageSize = 9
+        expected = self._getPages(
+            lambda start, _: self.variantSet.getVariants("1", start, 2**30),
+            pageSize)
+        self.assertGreater(len(expected), 2)
+        self.pool.setNumWorkers(2)
+        self.pool.setMinShardSize(100)
+        numVariants = [0]
+
+        def getVariants(start, numPageVariants):
+            for variant in self.pool.getVariants(
+                    self.variantSet, "1", start, 2**30, [], None,
+                    numPageVariants):
+                numVariants[0] += 1
+                yield variant
+        self.assertEqual(self._getPages(getVariants, pageSize), expected)
+        # Every page, including its first variants, is converted by the
+        # workers, and the shards are sized from the density of the
+        # variants so that most of what the workers convert is used.
+        self.assertEqual(
+            self.pool.getNumUsedWorkerVariants(), numVariants[0])
+        self.assertLess(
+            self.pool.getNumWorkerVariants(), 2 * numVariants[0])
+
+    def testCallSetNotInVariantSet(self):
+        self.pool.setNumWorkers(1)
+        self.pool.setMinShardSize(1000)
+        variants = self.pool.getVariants(
+            self.variantSet, "1", 0, 2**30, ["unknown"])
+        with self.assertRaises(
+                exceptions.CallSetNotInVariantSetException):
+            list(variants)
+
+    def testWorkerTimeout(self):
+        # Shards that the workers do not convert in time are converted
+        # in this process.
+        variants = self.variantSet.getVariants("1", 0, 2**30)
+        expected = [variant.id for variant in variants]
+        with mock.patch.object(
+                paging, "_convertVariantShard", _convertVariantShardSlowly):
+            pool = paging.VariantConversionPool(
+                self.backend.getDataRepository(), shardTimeout=0.1)
+            pool.setNumWorkers(1)
+            pool.setMinShardSize(10**6)
+            try:
+                with mock.patch.object(paging, "_logger") as logger:
+                    variants = pool.getVariants(
+                        self.variantSet, "1", 0, 2**30, [])
+                    self.assertEqual(
+                        [variant.id for variant in variants], expected)
+                self.assertTrue(logger.warning.called)
+                self.assertIn(
+                    "Timed out", logger.warning.call_args[0][-1])
+                self.assertEqual(pool.getNumUsedWorkerVariants(), 0)
+            finally:
+                pool.setNumWorkers(0)
+
+    def testWorkerFailureLogged(self):
+        # The workers of this pool cannot find the variant set, so each
+        # shard is converted again in this process and the failure logged.
+        variants = self.variantSet.getVariants("1", 0, 2**30)
+        expected = [variant.id for variant in variants]
+        pool = paging.VariantConversionPool(datarepo.EmptyDataRepository())
+        pool.setNumWorkers(1)
+        pool.setMinShardSize(1000)
+        try:
+            with mock.patch.object(paging, "_logger") as logger:
+                variants = pool.getVariants(
+                    self.variantSet, "1", 0, 2**30, [])
+                self.assertEqual(
+                    [variant.id for variant in variants], expected)
+            self.assertTrue(logger.warning.called)
+            self.assertIn(
+                "Traceback", logger.warning.call_args[0][-1])
+        finally:
+            pool.setNumWorkers(0)
@@ -6,11 +6,24 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import ctypes
+import glob
+import os
+import shutil
+import tempfile
 import unittest
 
+import pysam
+
+import tests.paths as paths
+
 import ga4gh.server.exceptions as exceptions
+import ga4gh.server.datamodel as datamodel
 import ga4gh.server.datamodel.variants as variants
 import ga4gh.server.datamodel.datasets as datasets
+import ga4gh.server.paging as paging
+
+import ga4gh.schemas.protocol as protocol
 
 
 class TestAbstractVariantSet(unittest.TestCase):
@@ -72,6 +85,26 @@ class TestAbstractVariantSet(unittest.TestCase):
         self.assertRaises(AttributeError,
                           self._variantSet.getVariantId, "hola")
 
+    def testVariantIdsMatchCompoundIds(self):
+        # The prefix lengths cover each alignment of the base64 encoding
+        for variantSetName in ["a", "ab", "abc", 'q"uote', "\u00fcni"]:
+            variantSet = variants.AbstractVariantSet(
+                self._dataset, variantSetName)
+            for referenceName in ["1", 'chr"2', "\u00e9"]:
+                for alternateBases in [[], ["C"], ["C", "\u00c4T"]]:
+                    variant = protocol.Variant()
+                    variant.reference_name = referenceName
+                    variant.start = 12345
+                    variant.reference_bases = "A"
+                    variant.alternate_bases.extend(alternateBases)
+                    compoundId = datamodel.VariantCompoundId(
+                        variantSet.getCompoundId(), referenceName, "12345",
+                        variantSet.hashVariant(variant))
+                    # Repeat to use the memoized hash
+                    for _ in range(2):
+                        variantId = variantSet.getVariantId(variant)
+                        self.assertEqual(variantId, str(compoundId))
+
     def testHashVariant(self):
         self.assertRaises(AttributeError,
                           self._variantSet.hashVariant, None)
@@ -81,3 +114,309 @@ class TestAbstractVariantSet(unittest.TestCase):
     def testVariantSetProtocolElement(self):
         self.assertRaises(AttributeError,
                           self._variantSet.toProtocolElement)
+
+
+class TestVariantBlockCache(unittest.TestCase):
+    """
+    Tests the LRU cache of converted variant blocks.
+    """
+    def _makeBlock(self, numVariants):
+        block = []
+        for j in range(numVariants):
+            variant = protocol.Variant()
+            variant.start = j
+            variant.reference_bases = "ACGT"
+            block.append(variant)
+        return block
+
+    def testDisabled(self):
+        cache = variants.VariantBlockCache()
+        self.assertFalse(cache.isEnabled())
+        self.assertFalse(cache.isCacheable(0, 10))
+        cache.put("a", self._makeBlock(1))
+        self.assertIsNone(cache.get("a"))
+        with self.assertRaises(ValueError):
+            cache.setMaxBytes(-1)
+        with self.assertRaises(ValueError):
+            cache.setBinSize(0)
+
+    def testIsCacheable(self):
+        cache = variants.VariantBlockCache(maxBytes=1000, binSize=10)
+        maxLength = cache.maxSearchBins * 10
+        self.assertTrue(cache.isCacheable(0, maxLength))
+        self.assertTrue(cache.isCacheable(-5, maxLength))
+        self.assertFalse(cache.isCacheable(0, maxLength + 1))
+        self.assertFalse(cache.isCacheable(5, 5))
+        self.assertFalse(cache.isCacheable(0, None))
+
+    def testEviction(self):
+        block = self._makeBlock(4)
+        blockSize = sum(variant.ByteSize() for variant in block)
+        cache = variants.VariantBlockCache(maxBytes=2 * blockSize)
+        cache.put("a", block)
+        cache.put("b", self._makeBlock(4))
+        self.assertIs(cache.get("a"), block)
+        cache.put("c", self._makeBlock(4))
+        self.assertIsNone(cache.get("b"))
+        self.assertIs(cache.get("a"), block)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.getNumBytes(), 2 * blockSize)
+        self.assertEqual(cache.getNumHits(), 2)
+        self.assertEqual(cache.getNumMisses(), 1)
+        cache.put("d", self._makeBlock(12))
+        self.assertIsNone(cache.get("d"))
+        cache.setMaxBytes(blockSize)
+        self.assertEqual(len(cache), 1)
+        cache.setBinSize(5)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.getNumBytes(), 0)
+
+
+class TestVariantFilter(unittest.TestCase):
+    """
+    Tests the evaluation of variant filters on converted variants.
+    """
+    def _makeVariant(self, filters, info):
+        variant = protocol.Variant()
+        if len(filters) > 0:
+            variant.filters_applied = True
+            variant.filters_passed = filters == ["PASS"]
+            if not variant.filters_passed:
+                variant.filters_failed.extend(filters)
+        for key, value in info.items():
+            protocol.setAttribute(variant.attributes.attr[key].values, value)
+        return variant
+
+    def testMalformedPredicates(self):
+        for predicate in ["", "AF<", "<0.1", "AF<rare", "A F=1", "AF>=x"]:
+            with self.assertRaises(exceptions.BadVariantFilterException):
+                variants.VariantFilter([predicate])
+
+    def testPassOnly(self):
+        variantFilter = variants.VariantFilter(passOnly=True)
+        self.assertTrue(variantFilter.isPassOnly())
+        self.assertTrue(variantFilter.matchesVariant(
+            self._makeVariant(["PASS"], {})))
+        self.assertFalse(variantFilter.matchesVariant(
+            self._makeVariant(["q10"], {})))
+        self.assertFalse(variantFilter.matchesVariant(
+            self._makeVariant([], {})))
+
+    def testInfoPredicates(self):
+        variant = self._makeVariant([], {
+            "AF": [0.25, 0.005], "DP": [14], "DB": [True],
+            "SVTYPE": ["DEL"]})
+        for predicate, expected in [
+                ("AF<0.01", True), ("AF>0.5", False), ("AF=0.25", True),
+                ("DP>=14", True), ("DP<14", False), ("DP!=14", False),
+                ("DB", True), ("H2", False), ("H2>1", False),
+                ("SVTYPE=DEL", True), ("SVTYPE!=DEL", False),
+                ("SVTYPE=INS", False)]:
+            variantFilter = variants.VariantFilter([predicate])
+            self.assertEqual(
+                variantFilter.matchesVariant(variant), expected, predicate)
+        variantFilter = variants.VariantFilter(["AF<0.01", "DP>20"])
+        self.assertFalse(variantFilter.matchesVariant(variant))
+
+    def testStructuralVariantFields(self):
+        # The structural variant fields are read when the variant has no
+        # attribute of the same key.
+        variant = self._makeVariant([], {})
+        variant.variant_type = "DEL"
+        variant.svlen = -200
+        variant.cipos.extend([-10, 10])
+        variant.ciend.extend([-5, 5])
+        for predicate, expected in [
+                ("SVTYPE=DEL", True), ("SVTYPE", True), ("SVLEN<-100", True),
+                ("SVLEN>0", False), ("CIPOS<=-10", True), ("CIPOS>10", False),
+                ("CIEND=5", True), ("CIEND>5", False)]:
+            variantFilter = variants.VariantFilter([predicate])
+            self.assertEqual(
+                variantFilter.matchesVariant(variant), expected, predicate)
+        variant = self._makeVariant([], {})
+        for predicate in ["SVTYPE", "SVLEN", "CIPOS", "CIEND"]:
+            self.assertFalse(
+                variants.VariantFilter([predicate]).matchesVariant(variant))
+
+    def testEquality(self):
+        self.assertEqual(
+            variants.VariantFilter(["AF<0.01"], True),
+            variants.VariantFilter(["AF<0.01"], True))
+        self.assertNotEqual(
+            variants.VariantFilter(["AF<0.01"], True),
+            variants.VariantFilter(["AF<0.01"]))
+        self.assertEqual(
+            len(set([variants.VariantFilter(["DB"]),
+                     variants.VariantFilter(["DB"])])), 1)
+
+
+class TestStructuralVariantFilter(unittest.TestCase):
+    """
+    Tests that filters on the structural variant INFO keys select the
+    same variants from the records as from the cached variants.
+    """
+    vcf = """\
+##fileformat=VCFv4.2
+##contig=<ID=1,length=100000>
+##INFO=<ID=SVTYPE,Number=1,Type=String,Description="Type">
+##INFO=<ID=SVLEN,Number=.,Type=Integer,Description="Length">
+##INFO=<ID=CIPOS,Number=2,Type=Integer,Description="CI start">
+##INFO=<ID=CIEND,Number=2,Type=Integer,Description="CI end">
+##INFO=<ID=END,Number=1,Type=Integer,Description="End">
+##INFO=<ID=IMPRECISE,Number=0,Type=Flag,Description="Imprecise">
+##FILTER=<ID=q10,Description="Quality below 10">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1
+1\t100\t.\tA\tG\t50\tPASS\t.\tGT\t0/1
+1\t200\t.\tA\t<DEL>\t50\tPASS\t\
+SVTYPE=DEL;SVLEN=-300;END=500;CIPOS=-10,10;CIEND=-20,20\tGT\t1/1
+1\t650\t.\tC\t<DUP>\t50\tPASS\t\
+SVTYPE=DUP;SVLEN=80;END=730;CIPOS=-5,5;CIEND=-5,5\tGT\t0/1
+1\t900\t.\tG\t<INS>\t50\tq10\t\
+SVTYPE=INS;SVLEN=45;CIPOS=0,30;IMPRECISE\tGT\t0/1
+1\t1200\t.\tT\t<DEL>\t50\tPASS\t\
+SVTYPE=DEL;SVLEN=-1500;END=2700;CIEND=-100,100\tGT\t0/1
+"""
+    predicates = [
+        ["SVTYPE"], ["SVTYPE=DEL"], ["SVTYPE!=DEL"], ["SVLEN<-100"],
+        ["SVLEN>0", "SVTYPE=DUP"], ["CIPOS<=-10"], ["CIPOS>=30"],
+        ["CIEND>50"], ["CIEND"], ["IMPRECISE"], ["IMPRECISE<=1"]]
+
+    def setUp(self):
+        self._tempDir = tempfile.mkdtemp(prefix="ga4gh_sv_filter")
+        vcfPath = os.path.join(self._tempDir, "sv.vcf")
+        with open(vcfPath, "w") as vcfFile:
+            vcfFile.write(self.vcf)
+        dataUrl = pysam.tabix_index(vcfPath.encode("utf-8"), preset="vcf")
+        self._variantSet = variants.HtslibVariantSet(
+            datasets.Dataset("dataset"), "sv")
+        self._variantSet.populateFromFile([dataUrl], [dataUrl + ".tbi"])
+        self._cache = variants.variantBlockCache
+
+    def tearDown(self):
+        self._cache.setMaxBytes(0)
+        self._cache.setBinSize(10000)
+        shutil.rmtree(self._tempDir)
+
+    def _getStarts(self, variantFilter):
+        return [
+            variant.start for variant in self._variantSet.getVariants(
+                "1", 0, 3000, [], variantFilter)]
+
+    def testRecordAndCachedFilters(self):
+        allStarts = [99, 199, 649, 899, 1199]
+        for infoPredicates in self.predicates:
+            for passOnly in [False, True]:
+                variantFilter = variants.VariantFilter(
+                    infoPredicates, passOnly)
+                self._cache.setMaxBytes(0)
+                expected = self._getStarts(variantFilter)
+                self._cache.setMaxBytes(2**20)
+                self._cache.setBinSize(1000)
+                for _ in range(2):
+                    self.assertEqual(
+                        self._getStarts(variantFilter), expected,
+                        infoPredicates)
+        self.assertGreater(self._cache.getNumHits(), 0)
+        self._cache.setMaxBytes(0)
+        self.assertEqual(self._getStarts(None), allStarts)
+        for infoPredicates, expected in [
+                (["SVTYPE=DEL"], [199, 1199]), (["SVLEN<-100"], [199, 1199]),
+                (["SVLEN>0", "SVTYPE=DUP"], [649]), (["CIPOS>=30"], [899]),
+                (["CIEND>50"], [1199]), (["IMPRECISE<=1"], [899])]:
+            self.assertEqual(
+                self._getStarts(variants.VariantFilter(infoPredicates)),
+                expected)
+
+
+class TestBcfSeekablePageTokens(unittest.TestCase):
+    """
+    Tests that resuming a search of a BCF file from the virtual offsets
+    in its page tokens returns the same variants as resuming it from
+    the search anchors.
+    """
+    def setUp(self):
+        self._tempDir = tempfile.mkdtemp(prefix="ga4gh_bcf_tokens")
+        vcfPath = os.path.join(
+            paths.testDataDir, "datasets/dataset1/variants/1kgPhase1",
+            "chr1.vcf.gz")
+        bcfPath = os.path.join(self._tempDir, "chr1.bcf")
+        vcfFile = pysam.VariantFile(vcfPath.encode("utf-8"))
+        bcfFile = pysam.VariantFile(
+            bcfPath.encode("utf-8"), b"wb", header=vcfFile.header)
+        for record in vcfFile:
+            bcfFile.write(record)
+        bcfFile.close()
+        vcfFile.close()
+        self._buildCsiIndex(bcfPath)
+        self._variantSet = variants.HtslibVariantSet(
+            datasets.Dataset("dataset"), "bcf")
+        self._variantSet.populateFromFile([bcfPath], [bcfPath + ".csi"])
+
+    def tearDown(self):
+        shutil.rmtree(self._tempDir)
+
+    def _buildCsiIndex(self, bcfPath):
+        # pysam 0.9.0 cannot index BCF files, so the htslib it bundles is
+        # called directly.
+        libraries = glob.glob(os.path.join(
+            os.path.dirname(pysam.__file__), "libchtslib*.so"))
+        if len(libraries) == 0:
+            self.skipTest("pysam does not bundle libchtslib")
+        library = ctypes.CDLL(libraries[0])
+        self.assertEqual(
+            library.bcf_index_build(bcfPath.encode("utf-8"), 14), 0)
+
+    def _getVariants(self, pageToken, seekablePageTokens):
+        request = protocol.SearchVariantsRequest()
+        request.reference_name = "1"
+        request.start = 0
+        request.end = datamodel.PysamDatamodelMixin.vcfMax
+        request.page_token = pageToken
+        return list(paging.VariantsIntervalIterator(
+            request, self._variantSet, seekablePageTokens))
+
+    def testResumeFromVirtualOffsets(self):
+        seekable = self._getVariants("", True)
+        anchored = self._getVariants("", False)
+        self.assertEqual(len(seekable), 100)
+        self.assertEqual(
+            [variant for variant, _ in seekable],
+            [variant for variant, _ in anchored])
+        for index, ((_, seekToken), (_, anchorToken)) in enumerate(
+                zip(seekable[:-1], anchored[:-1])):
+            self.assertEqual(seekToken.count(":"), 2)
+            self.assertTrue(seekToken.startswith(anchorToken + ":"))
+            remaining = [variant for variant, _ in seekable[index + 1:]]
+            self.assertEqual(
+                [variant for variant, _ in self._getVariants(
+                    seekToken, True)],
+                remaining)
+            self.assertEqual(
+                [variant for variant, _ in self._getVariants(
+                    anchorToken, False)],
+                remaining)
+        self.assertIsNone(seekable[-1][1])
+
+
+class TestGenotypeConversion(unittest.TestCase):
+    """
+    Tests that genotypes converted in blocks match those converted
+    one at a time.
+    """
+    @unittest.skipIf(variants.numpy is None, "numpy not installed")
+    def testConvertGenotypeArray(self):
+        alleleValues = [None, 0, 1, 2, 200]
+        genotypes = [()] + [(allele,) for allele in alleleValues]
+        for first in alleleValues:
+            for second in alleleValues:
+                genotypes.append((first, second))
+                genotypes.append((first, second, 0))
+        alleles = variants.numpy.array(
+            [variants.getGenotypeAllelePair(genotype)
+             for genotype in genotypes],
+            dtype=variants.numpy.int8).reshape(1, len(genotypes), 2)
+        self.assertEqual(
+            variants.convertGenotypeArray(alleles).tolist(),
+            [[variants.convertGenotypeAlleles(genotype)
+              for genotype in genotypes]])
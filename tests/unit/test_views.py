@@ -5,13 +5,18 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import base64
+import json
 import unittest
 import logging
 
+import mock
+
 import tests.paths as paths
 
 import ga4gh.server.datamodel as datamodel
 import ga4gh.server.frontend as frontend
+import ga4gh.server.response_builder as response_builder
 import ga4gh.schemas.protocol as protocol
 import ga4gh.server.exceptions as exceptions
 
@@ -347,6 +352,186 @@ class TestFrontend(unittest.TestCase):
             response, protocol.SearchVariantsResponse)
         self.assertEqual(len(responseData.variants), 1)
 
+    def sendStreamRequest(self, path, request):
+        headers = {
+            'Content-type': 'application/json',
+            'Origin': self.exampleUrl,
+            'Accept': frontend.NDJSON_MIMETYPE,
+        }
+        return self.app.post(
+            path, headers=headers, data=protocol.toJson(request))
+
+    def testVariantsSearchStream(self):
+        request = protocol.SearchVariantsRequest()
+        request.variant_set_id = self.variantSetId
+        request.reference_name = "1"
+        request.start = 0
+        request.end = 100
+        request.page_size = 1
+        response = self.sendStreamRequest('/variants/search', request)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(frontend.NDJSON_MIMETYPE, response.mimetype)
+        lines = response.get_data().splitlines()
+        variants = [
+            protocol.fromJson(line, protocol.Variant) for line in lines]
+        expected = list(self.variantSet.getVariants("1", 0, 100))
+        self.assertGreater(len(expected), 1)
+        self.assertEqual(variants, expected)
+
+    def testVariantsSearchFilter(self):
+        request = protocol.SearchVariantsRequest()
+        request.variant_set_id = self.variantSetId
+        request.reference_name = "1"
+        request.start = 0
+        request.end = 100
+        request.page_size = 2
+        expected = [
+            variant for variant in self.variantSet.getVariants("1", 0, 100)
+            if variant.filters_passed]
+        self.assertGreater(len(expected), 2)
+        filtered = []
+        while True:
+            response = self.sendPostRequest(
+                '/variants/search?filter=PASS', request)
+            self.assertEqual(200, response.status_code)
+            responseData = self.deserialize(
+                response, protocol.SearchVariantsResponse)
+            filtered.extend(responseData.variants)
+            if not responseData.next_page_token:
+                break
+            request.page_token = responseData.next_page_token
+        self.assertEqual(filtered, expected)
+        request.page_token = ""
+        for query in ["filter=q10", "info=AF<", "info=AF>rare"]:
+            response = self.sendPostRequest(
+                '/variants/search?' + query, request)
+            self.assertEqual(400, response.status_code)
+
+    def testGenotypesSearchPacked(self):
+        # Every genotype value is present, including OTHER and the
+        # hemizygous values that have no 2-bit code, in a matrix whose
+        # size is not a multiple of four.
+        genotypeValues = sorted(protocol.Genotype.values())
+        callSetIds = ["cs{}".format(index) for index in range(5)]
+        rows = [
+            [genotypeValues[(row * 3 + column) % len(genotypeValues)]
+             for column in range(len(callSetIds))]
+            for row in range(3)]
+
+        def genotypeMatrixGenerator(request):
+            for row, genotypes in enumerate(rows):
+                gtmatrix = protocol.GenotypeMatrix()
+                gtmatrix.nvariants = 1
+                gtmatrix.nindividuals = len(genotypes)
+                gtmatrix.genotypes.extend(genotypes)
+                variant = protocol.Variant()
+                variant.id = "variant{}".format(row)
+                variant.reference_name = "1"
+                variant.start = row
+                variant.end = row + 1
+                yield (gtmatrix, variant, callSetIds), None
+
+        request = protocol.SearchGenotypesRequest()
+        request.variant_set_id = self.variantSetId
+        request.reference_name = "1"
+        request.start = 0
+        request.end = 100
+        headers = {
+            'Content-type': 'application/json',
+            'Origin': self.exampleUrl,
+        }
+        with mock.patch.object(
+                self.backend, "genotypeMatrixGenerator",
+                genotypeMatrixGenerator):
+            headers['Accept'] = "application/json"
+            response = self.app.post(
+                '/genotypes/search', headers=headers,
+                data=protocol.toJson(request))
+            self.assertEqual(200, response.status_code)
+            plain = self.deserialize(
+                response, protocol.SearchGenotypesResponse)
+            headers['Accept'] = response_builder.PACKED_GENOTYPES_MIMETYPE
+            response = self.app.post(
+                '/genotypes/search', headers=headers,
+                data=protocol.toJson(request))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            response_builder.PACKED_GENOTYPES_MIMETYPE, response.mimetype)
+        self.assertEqual(
+            list(plain.genotypes.genotypes), sum(rows, []))
+        packed = json.loads(response.get_data())
+        genotypeMatrix = packed.pop("genotypes")
+        packedGenotypes = base64.b64decode(
+            genotypeMatrix.pop("packedGenotypes"))
+        otherGenotypes = genotypeMatrix.pop("otherGenotypes")
+        self.assertEqual(
+            response_builder.unpackGenotypes(
+                packedGenotypes, otherGenotypes,
+                len(plain.genotypes.genotypes)),
+            list(plain.genotypes.genotypes))
+        self.assertEqual(
+            sorted(set(name for _, name in otherGenotypes)),
+            ["HEMIZYGOUS_ALT", "HEMIZYGOUS_REF", "OTHER"])
+        # The rest of the response is unchanged.
+        packed["genotypes"] = genotypeMatrix
+        unpacked = protocol.fromJson(
+            json.dumps(packed), protocol.SearchGenotypesResponse)
+        plain.genotypes.ClearField(b"genotypes")
+        self.assertEqual(unpacked, plain)
+
+    def testReadsSearchStream(self):
+        request = protocol.SearchReadsRequest()
+        request.read_group_ids.extend([self.readGroupId])
+        request.reference_id = self.referenceId
+        response = self.sendStreamRequest('/reads/search', request)
+        self.assertEqual(200, response.status_code)
+        lines = response.get_data().splitlines()
+        self.assertEqual(len(lines), 2)
+        readAlignment = protocol.fromJson(lines[0], protocol.ReadAlignment)
+        self.assertEqual(readAlignment.id, self.readAlignmentId)
+
+    def testReadsSearchSampled(self):
+        request = protocol.SearchReadsRequest()
+        request.read_group_ids.extend([self.readGroupId])
+        request.reference_id = self.referenceId
+        response = self.sendPostRequest('/reads/search', request)
+        self.assertEqual(200, response.status_code)
+        responseData = self.deserialize(
+            response, protocol.SearchReadsResponse)
+        self.assertGreater(len(responseData.alignments), 1)
+        # The simulated reads all begin at the same position
+        response = self.sendPostRequest(
+            '/reads/search?maxDepth=1', request)
+        self.assertEqual(200, response.status_code)
+        sampledData = self.deserialize(
+            response, protocol.SearchReadsResponse)
+        self.assertEqual(
+            list(sampledData.alignments), list(responseData.alignments[:1]))
+        response = self.sendPostRequest(
+            '/reads/search?sampleFraction=1', request)
+        self.assertEqual(200, response.status_code)
+        sampledData = self.deserialize(
+            response, protocol.SearchReadsResponse)
+        self.assertEqual(sampledData.alignments, responseData.alignments)
+        for query in [
+                "maxDepth=0", "maxDepth=deep", "sampleFraction=0",
+                "sampleFraction=1.5", "sampleFraction=half"]:
+            response = self.sendPostRequest('/reads/search?' + query, request)
+            self.assertEqual(400, response.status_code)
+
+    def testSearchStreamErrors(self):
+        request = protocol.SearchVariantsRequest()
+        request.variant_set_id = "not a valid id"
+        response = self.sendStreamRequest('/variants/search', request)
+        self.assertEqual(404, response.status_code)
+
+    def testSearchStreamNotSupported(self):
+        request = protocol.SearchVariantSetsRequest()
+        request.dataset_id = self.datasetId
+        response = self.sendStreamRequest('/variantsets/search', request)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("application/json", response.mimetype)
+
     def testVariantSetsSearch(self):
         response = self.sendVariantSetsSearch()
         self.assertEqual(200, response.status_code)